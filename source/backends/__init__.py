@@ -0,0 +1,96 @@
+r"""
+Registry of the native primitives used by the MoE dispatch path.
+
+The counting, positioning, grouped linear and capacity primitives used in
+`functions.py`, `linear.py` and `gates/` are looked up through `fmoe_native`,
+which forwards every attribute to the currently selected backend.
+* `cuda` is the compiled `fmoe_cuda` extension, registered when it can be
+imported.
+* `torch` is a pure-PyTorch implementation that runs on any device.
+The backend defaults to `cuda` when available and falls back to `torch`
+otherwise. It can be forced with the `FMOE_BACKEND` environment variable or
+with `set_backend`.
+
+The expert exchange primitives (`_comm_functions`) can be taken from another
+backend with `FMOE_COMM_BACKEND` or `set_comm_backend`, e.g. the
+`torch.distributed` all-to-all of the `torch` backend together with the
+`cuda` kernels.
+"""
+import os
+
+from . import torch_backend
+
+_backends = dict()
+_active_backend = None
+_active_comm_backend = None
+
+_comm_functions = ('ensure_nccl', 'expert_exchange', 'global_scatter',
+        'global_gather')
+
+def register_backend(name, module):
+    r"""
+    Register `module` as a backend. The module is expected to provide the same
+    functions as the `fmoe_cuda` extension.
+    """
+    _backends[name] = module
+
+def available_backends():
+    return list(_backends.keys())
+
+def set_backend(name):
+    global _active_backend
+    if name not in _backends:
+        raise ValueError('Unknown MoE backend {}, available: {}'.format(
+            name, available_backends()))
+    _active_backend = name
+
+def get_backend_name():
+    if _active_backend is None:
+        if 'FMOE_BACKEND' in os.environ:
+            set_backend(os.environ['FMOE_BACKEND'])
+        elif 'cuda' in _backends:
+            set_backend('cuda')
+        else:
+            set_backend('torch')
+    return _active_backend
+
+def get_backend():
+    return _backends[get_backend_name()]
+
+def set_comm_backend(name):
+    global _active_comm_backend
+    if name not in _backends:
+        raise ValueError('Unknown MoE backend {}, available: {}'.format(
+            name, available_backends()))
+    _active_comm_backend = name
+
+def get_comm_backend_name():
+    if _active_comm_backend is None:
+        if 'FMOE_COMM_BACKEND' in os.environ:
+            set_comm_backend(os.environ['FMOE_COMM_BACKEND'])
+        else:
+            return get_backend_name()
+    return _active_comm_backend
+
+def get_comm_backend():
+    return _backends[get_comm_backend_name()]
+
+class _NativeProxy(object):
+    r"""
+    Forward attribute lookups to the active backend, so that call sites can
+    keep using `fmoe_native.<primitive>(...)`.
+    """
+
+    def __getattr__(self, name):
+        if name in _comm_functions:
+            return getattr(get_comm_backend(), name)
+        return getattr(get_backend(), name)
+
+fmoe_native = _NativeProxy()
+
+register_backend('torch', torch_backend)
+try:
+    import fmoe_cuda
+    register_backend('cuda', fmoe_cuda)
+except ImportError:
+    pass
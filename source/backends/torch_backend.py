@@ -0,0 +1,277 @@
+r"""
+Pure-PyTorch implementation of the `fmoe_cuda` primitives.
+
+Every function keeps the signature of its CUDA counterpart so that the two
+backends are interchangeable. The implementations are vectorized and free of
+host synchronizations, except for the grouped linear operators, which need the
+expert counts on the host to split the buffer (exactly as the CUDA kernels do).
+The expert exchange is built on `torch.distributed.all_to_all_single`, so it
+works with any process group supporting it, including gloo on CPU.
+"""
+import torch
+import torch.distributed as dist
+
+_group = None
+
+def _counts_to_list(fwd_expert_count):
+    if isinstance(fwd_expert_count, torch.Tensor):
+        return fwd_expert_count.tolist()
+    return [int(c) for c in fwd_expert_count]
+
+def ensure_nccl(comm, t):
+    r"""
+    Remember `comm` as the process group of the expert exchange. No
+    communicator needs to be extracted from it.
+    """
+    global _group
+    _group = comm
+
+def _worker_splits(expert_count, world_size):
+    r"""
+    Split the `world_size x num_expert` counts into the number of samples of
+    every worker and the (worker-major) sizes of the (worker, expert) chunks.
+    """
+    counts = _counts_to_list(expert_count)
+    num_expert = len(counts) // world_size
+    splits = [sum(counts[w * num_expert : (w + 1) * num_expert])
+            for w in range(world_size)]
+    return splits, counts, num_expert
+
+def _transpose_chunks(buf, counts, num_expert, world_size, to_expert_major):
+    r"""
+    Reorder the (worker, expert) chunks of `buf` between the worker-major
+    layout of the exchange and the expert-major layout of the experts.
+    """
+    if to_expert_major:
+        chunks = buf.split(counts)
+        order = [w * num_expert + e for e in range(num_expert)
+                for w in range(world_size)]
+    else:
+        expert_major = [counts[w * num_expert + e] for e in range(num_expert)
+                for w in range(world_size)]
+        chunks = buf.split(expert_major)
+        order = [e * world_size + w for w in range(world_size)
+                for e in range(num_expert)]
+    return torch.cat([chunks[i] for i in order], dim=0)
+
+def expert_count(gate_idx, expert_count):
+    r"""
+    Count the number of samples routed to each expert into `expert_count`.
+    Samples whose index is -1 are dropped.
+    """
+    idx = gate_idx.reshape(-1)
+    valid = (idx > -1).to(expert_count.dtype)
+    expert_count.index_add_(0, idx.clamp(min=0), valid)
+
+def assign_pos(lec_cum, gate_idx, pos):
+    r"""
+    Fill `pos` with the indices of the samples ordered by their expert, so that
+    the samples of each expert are contiguous. A stable sort keeps the original
+    order within an expert. The dropped samples (-1) sort last, so that `pos`
+    may be larger than the number of valid samples, as with the CUDA kernel.
+    """
+    idx = gate_idx.reshape(-1)
+    key = torch.where(idx < 0, torch.full_like(idx, lec_cum.numel()), idx)
+    order = torch.sort(key, stable=True)[1]
+    pos.copy_(order[:pos.numel()])
+
+def _rank_in_expert(sorted_idx):
+    r"""
+    Rank of every element of a sorted index tensor within its run of equal
+    values.
+    """
+    first = torch.searchsorted(sorted_idx, sorted_idx)
+    return torch.arange(sorted_idx.numel(), device=sorted_idx.device) - first
+
+def expert_exchange(local_expert_count, num_expert, world_size):
+    r"""
+    Send to every worker the number of samples routed to each of its experts.
+    """
+    global_expert_count = torch.empty_like(local_expert_count)
+    dist.all_to_all_single(global_expert_count, local_expert_count.contiguous(),
+            group=_group)
+    return global_expert_count
+
+def global_scatter(local_input_buf, local_expert_count, global_expert_count,
+        fwd_batch_size, world_size):
+    r"""
+    Send the samples to the workers of their experts. The received samples
+    are ordered by local expert, then by source worker.
+    """
+    send_splits, _, _ = _worker_splits(local_expert_count, world_size)
+    recv_splits, recv_counts, num_expert = _worker_splits(global_expert_count,
+            world_size)
+    recv_buf = local_input_buf.new_empty(
+            (fwd_batch_size,) + tuple(local_input_buf.shape[1:]))
+    dist.all_to_all_single(recv_buf, local_input_buf.contiguous(),
+            recv_splits, send_splits, group=_group)
+    return _transpose_chunks(recv_buf, recv_counts, num_expert, world_size,
+            to_expert_major=True)
+
+def global_gather(global_output_buf, local_expert_count, global_expert_count,
+        local_batch_size, world_size):
+    r"""
+    Send the outputs of the experts back to the workers of their samples, the
+    reverse of `global_scatter`.
+    """
+    recv_splits, _, _ = _worker_splits(local_expert_count, world_size)
+    send_splits, send_counts, num_expert = _worker_splits(global_expert_count,
+            world_size)
+    send_buf = _transpose_chunks(global_output_buf, send_counts, num_expert,
+            world_size, to_expert_major=False)
+    recv_buf = global_output_buf.new_empty(
+            (local_batch_size,) + tuple(global_output_buf.shape[1:]))
+    dist.all_to_all_single(recv_buf, send_buf, recv_splits, send_splits,
+            group=_group)
+    return recv_buf
+
+def linear_forward(input_buf, fwd_expert_count, weight, bias=None):
+    r"""
+    Grouped matrix multiplication: the rows of `input_buf` are split by
+    `fwd_expert_count` and each group is multiplied by its expert's weight.
+    """
+    counts = _counts_to_list(fwd_expert_count)
+    output_buf = input_buf.new_empty(input_buf.shape[0], weight.shape[1])
+    for i, (inp, out) in enumerate(zip(input_buf.split(counts),
+            output_buf.split(counts))):
+        if inp.shape[0] == 0:
+            continue
+        if bias is not None:
+            torch.addmm(bias[i], inp, weight[i].t(), out=out)
+        else:
+            torch.mm(inp, weight[i].t(), out=out)
+    return output_buf
+
+def linear_backward(grad_out, input_buf, fwd_expert_count, weight, bias=None):
+    counts = _counts_to_list(fwd_expert_count)
+    grad_inp_buf = grad_out.new_empty(input_buf.shape)
+    grad_weight = torch.zeros_like(weight)
+    if bias is not None:
+        grad_bias = torch.zeros_like(bias)
+    else:
+        grad_bias = grad_out.new_zeros(weight.shape[0], weight.shape[1])
+    for i, (g, inp, gi) in enumerate(zip(grad_out.split(counts),
+            input_buf.split(counts), grad_inp_buf.split(counts))):
+        if g.shape[0] == 0:
+            continue
+        torch.mm(g, weight[i], out=gi)
+        torch.mm(g.t(), inp, out=grad_weight[i])
+        torch.sum(g, dim=0, out=grad_bias[i])
+    return grad_inp_buf, grad_weight, grad_bias
+
+def limit_by_capacity(expert_count, capacity, num_expert, world_size):
+    r"""
+    Clip the number of samples each worker sends to each expert, so that the
+    samples of all workers fit in the capacity of the expert. Workers with a
+    lower rank are served first.
+    """
+    ec = expert_count.view(world_size, num_expert)
+    cap = capacity.view(1, num_expert).to(ec.dtype)
+    sent_before = torch.cumsum(ec, dim=0) - ec
+    new_ec = torch.minimum(ec, (cap - sent_before).clamp(min=0))
+    return new_ec.reshape(-1)
+
+def prune_by_capacity(gate_idx, capacity, num_expert, priority=None):
+    r"""
+    Set the index of the samples exceeding the `capacity` of their expert to
+    -1. `capacity` is an int or a tensor with the capacity of every expert.
+    The samples of an expert are kept in the order they appear in `gate_idx`,
+    or by decreasing `priority`, e.g. the gate scores, with the ties in order
+    of appearance.
+    Returns the pruned indices and the number of samples kept per expert.
+    """
+    idx = gate_idx.reshape(-1)
+    if priority is None:
+        sorted_idx, order = torch.sort(idx, stable=True)
+    else:
+        order = torch.sort(priority.reshape(-1), descending=True, stable=True)[1]
+        sorted_idx, by_expert = torch.sort(idx[order], stable=True)
+        order = order[by_expert]
+
+    if not torch.is_tensor(capacity):
+        capacity = torch.full((num_expert,), capacity, dtype=torch.long,
+                device=idx.device)
+    capacity = capacity.to(torch.long)
+    cap = capacity[sorted_idx.clamp(min=0)]
+    keep = (sorted_idx > -1) & (_rank_in_expert(sorted_idx) < cap)
+    new_sorted_idx = torch.where(keep, sorted_idx, torch.full_like(idx, -1))
+    new_idx = torch.empty_like(idx).scatter_(0, order, new_sorted_idx)
+
+    count = torch.zeros(num_expert, dtype=torch.long, device=idx.device)
+    count.index_add_(0, idx.clamp(min=0), (idx > -1).to(torch.long))
+    return new_idx.view_as(gate_idx), torch.minimum(count, capacity)
+
+def prune_gate_by_capacity(gate_idx, expert_count, num_expert, world_size):
+    r"""
+    Set the index of the samples exceeding `expert_count` of their expert to
+    -1. Samples are kept in the order they appear in `gate_idx`.
+    """
+    return prune_by_capacity(gate_idx, expert_count,
+            num_expert * world_size)[0]
+
+def _all_gather_counts(count, world_size):
+    out = [torch.empty_like(count) for _ in range(world_size)]
+    dist.all_gather(out, count, group=_group)
+    return torch.stack(out)
+
+def swipe_once(gate_idx, capacity, num_expert, world_size, bias):
+    r"""
+    One round of the SWIPE balancing of the samples of `gate_idx` over the
+    workers, each of which takes at most `capacity` more samples.
+    Every worker first takes the samples sent to its experts by the workers in
+    rank order, each in order, until its capacity is full. The rejected
+    samples of all the workers are then handed out, in the same order, to the
+    workers with capacity left, on their expert `bias`, and stay dropped (-1)
+    once all the capacity is used. Returns the new indices and the capacity
+    left on this worker.
+    """
+    idx = gate_idx.reshape(-1)
+    valid = idx > -1
+    worker = torch.where(valid, torch.div(idx, num_expert, rounding_mode='floor'),
+            torch.full_like(idx, world_size))
+    send_count = torch.bincount(worker, minlength=world_size + 1)[:world_size]
+    cap = int(capacity)
+
+    # the samples every worker takes from every source, in rank order
+    if world_size > 1:
+        recv_count = torch.empty_like(send_count)
+        dist.all_to_all_single(recv_count, send_count.contiguous(), group=_group)
+    else:
+        recv_count = send_count
+    sent_before = torch.cumsum(recv_count, dim=0) - recv_count
+    taken = torch.minimum(recv_count, (cap - sent_before).clamp(min=0))
+    cap_left = cap - int(taken.sum())
+    if world_size > 1:
+        accepted = torch.empty_like(taken)
+        dist.all_to_all_single(accepted, taken, group=_group)
+    else:
+        accepted = taken
+
+    # the samples beyond what their worker accepted are rejected
+    sorted_worker, order = torch.sort(worker, stable=True)
+    limit = torch.cat([accepted, accepted.new_zeros(1)])[sorted_worker]
+    rejected = torch.zeros_like(valid)
+    rejected[order] = (sorted_worker < world_size) \
+            & (_rank_in_expert(sorted_worker) >= limit)
+    num_rejected = rejected.sum().view(1)
+
+    # hand them out over the capacity left, which all the workers agree on
+    if world_size > 1:
+        rank = dist.get_rank(group=_group)
+        stats = _all_gather_counts(torch.stack([num_rejected[0],
+            num_rejected.new_tensor(cap_left)]), world_size)
+        drops, caps = stats[:, 0], stats[:, 1]
+    else:
+        rank = 0
+        drops, caps = num_rejected, num_rejected.new_tensor([cap_left])
+    slot = int(drops[:rank].sum()) + torch.cumsum(rejected.long(), dim=0) - 1
+    cap_end = torch.cumsum(caps, dim=0)
+    target = torch.searchsorted(cap_end, slot, right=True)
+    new_idx = torch.where(target < world_size, target * num_expert + bias,
+            torch.full_like(idx, -1))
+    new_idx = torch.where(rejected, new_idx, idx)
+
+    received = min(max(int(drops.sum()) - int(cap_end[rank] - caps[rank]), 0),
+            cap_left)
+    capacity_new = torch.scalar_tensor(cap_left - received, dtype=torch.long)
+    return new_idx.view_as(gate_idx), capacity_new
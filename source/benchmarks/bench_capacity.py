@@ -0,0 +1,56 @@
+r"""
+Benchmark of the capacity limiting of `GShardGate` and `SwitchGate`: the
+plain tensor `prune_by_capacity`, first-come and by score, against the
+counting, `limit_by_capacity` and `prune_gate_by_capacity` kernels of every
+available backend.
+
+Usage (from `source/`):
+    python benchmarks/bench_capacity.py --tokens 16384 --num_expert 64
+"""
+import math
+
+import torch
+
+from common import make_parser, timeit
+from backends import set_backend, available_backends, fmoe_native
+from functions import count_by_gate
+from backends.torch_backend import prune_by_capacity
+
+parser = make_parser('MoE capacity limiting benchmark', tokens=16384,
+        num_expert=64)
+parser.add_argument('--capacity_factor', type=float, default=1.2)
+args = parser.parse_args()
+
+def native_limit(topk_idx, capacity):
+    capacity = torch.ones(args.num_expert, dtype=torch.int32,
+            device=topk_idx.device) * capacity
+    _, _, gec = count_by_gate(topk_idx, args.num_expert, 1, require_pos=False)
+    new_gec = fmoe_native.limit_by_capacity(gec, capacity, args.num_expert, 1)
+    return fmoe_native.prune_gate_by_capacity(topk_idx,
+            new_gec.to(torch.int32), args.num_expert, 1)
+
+if __name__ == '__main__':
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    # skewed routing, so that the hot experts overflow
+    logits = torch.randn(args.tokens, args.num_expert, device=device)
+    logits += torch.linspace(0, 2, args.num_expert, device=device)
+    score, topk_idx = torch.topk(logits.softmax(dim=-1), k=args.top_k, dim=-1)
+    capacity = math.ceil(args.capacity_factor * args.tokens * args.top_k
+            / args.num_expert)
+
+    with torch.no_grad():
+        for backend in available_backends():
+            if backend != 'torch' and not args.cuda:
+                continue
+            set_backend(backend)
+            print('| native ({:5s})  | {:8.3f} ms'.format(backend,
+                timeit(lambda: native_limit(topk_idx, capacity), args.repeat,
+                    args.cuda)))
+        pruned, _ = prune_by_capacity(topk_idx, capacity, args.num_expert)
+        print('| tensor, first   | {:8.3f} ms | dropped {:6d}'.format(
+            timeit(lambda: prune_by_capacity(topk_idx, capacity,
+                args.num_expert), args.repeat, args.cuda),
+            int((pruned == -1).sum())))
+        print('| tensor, score   | {:8.3f} ms'.format(
+            timeit(lambda: prune_by_capacity(topk_idx, capacity,
+                args.num_expert, priority=score), args.repeat, args.cuda)))
@@ -0,0 +1,59 @@
+r"""
+Benchmark of the MoE dispatch path (counting, positioning, scatter, expert
+computation and gather) of a single `FMoETransformerMLP` layer.
+
+Usage (from `source/`):
+    python benchmarks/bench_dispatch.py --backend torch --tokens 4096
+"""
+import torch
+
+from common import make_parser, timeit
+from backends import set_backend, available_backends
+from custom_transformer import FMoETransformerMLP
+from custom_gate import CustomNaiveGate
+from functions import prepare_forward, get_host_sync_count
+
+parser = make_parser('MoE dispatch benchmark', tokens=4096, num_expert=16,
+        repeat=20)
+parser.add_argument('--backend', type=str, default=None,
+                    help='one of {}'.format(available_backends()))
+parser.add_argument('--d_model', type=int, default=256)
+parser.add_argument('--d_hidden', type=int, default=512)
+parser.add_argument('--sync_free', action='store_true',
+                    help='copy the expert counts to the host once per layer')
+parser.add_argument('--dispatch_mode', type=str, default='sparse',
+                    choices=['sparse', 'einsum', 'auto'])
+parser.add_argument('--capacity_factor', type=float, default=1.25)
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    if args.backend is not None:
+        set_backend(args.backend)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    layer = FMoETransformerMLP(num_expert=args.num_expert, d_model=args.d_model,
+            d_hidden=args.d_hidden, top_k=args.top_k, gate=CustomNaiveGate,
+            activation=torch.nn.ReLU(), sync_free=args.sync_free,
+            dispatch_mode=args.dispatch_mode,
+            capacity_factor=args.capacity_factor).to(device)
+    inp = torch.randn(args.tokens, args.d_model, device=device,
+            requires_grad=True)
+    gate_idx, _ = layer.gate(inp)
+
+    def run_prepare():
+        prepare_forward(gate_idx, args.num_expert, 1, sync_free=args.sync_free)
+
+    def run_forward():
+        with torch.no_grad():
+            layer(inp)
+
+    def run_backward():
+        layer(inp).sum().backward()
+
+    get_host_sync_count(reset=True)
+    run_forward()
+    syncs = get_host_sync_count(reset=True)
+    print('| prepare_forward {:8.3f} ms | forward {:8.3f} ms '
+          '| forward + backward {:8.3f} ms | host syncs/forward {}'.format(
+        timeit(run_prepare, args.repeat, args.cuda),
+        timeit(run_forward, args.repeat, args.cuda),
+        timeit(run_backward, args.repeat, args.cuda), syncs))
@@ -0,0 +1,94 @@
+r"""
+Benchmark of the custom gates: wall-clock time of the forward and backward of
+every `Custom*Gate`, and of the HyperNet gate with and without its cached
+router weight. Also the forward of the routing alone against the per-gate
+routing used before `fused_route` (topk, view and softmax, a topk over a
+tensor of ones in the dense mode, and the counts of the dispatcher).
+
+Usage (from `source/`):
+    python benchmarks/bench_gates.py --tokens 8192 --num_expert 16 --top_k 2
+"""
+import torch
+import torch.nn.functional as F
+
+from common import make_parser, timeit
+import custom_gate
+from custom_gate import fused_route
+from backends import fmoe_native
+
+parser = make_parser('MoE gate benchmark', tokens=8192, num_expert=16)
+parser.add_argument('--d_model', type=int, default=512)
+parser.add_argument('--gates', type=str, default='CustomDenseGate,CustomDropGate,'
+                    'CustomNaiveGate,CustomNaiveGate_Attn,CustomNaiveGate_Balance,'
+                    'CustomNaiveGate_XMoE,CustomNaiveGate_Distill,'
+                    'CustomNaiveGate_HyperNet')
+args = parser.parse_args()
+
+def legacy_route(gate, top_k, dense=False):
+    num_expert = gate.shape[-1]
+    if dense:
+        gate = torch.ones_like(gate)
+        top_k = num_expert
+    gate_top_k_val, gate_top_k_idx = torch.topk(
+        gate, k=top_k, dim=-1, largest=True, sorted=False
+    )
+    gate_top_k_val = gate_top_k_val.view(-1, top_k)
+    gate_score = F.softmax(gate_top_k_val, dim=-1)
+    expert_count = torch.zeros(num_expert, device=gate.device, dtype=torch.int32)
+    fmoe_native.expert_count(gate_top_k_idx, expert_count)
+    return gate_top_k_idx, gate_score, expert_count.long()
+
+if __name__ == '__main__':
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    inp = torch.randn(args.tokens, args.d_model, device=device,
+            requires_grad=True)
+    logits = torch.randn(args.tokens, args.num_expert, device=device)
+
+    for mode, top_k, dense in [('top-{}'.format(args.top_k), args.top_k, False),
+            ('top-1', 1, False), ('dense', args.top_k, True)]:
+        with torch.no_grad():
+            t_legacy = timeit(lambda: legacy_route(logits, top_k, dense),
+                    args.repeat, args.cuda)
+            t_fused = timeit(lambda: fused_route(logits, top_k, dense,
+                    return_count=True), args.repeat, args.cuda)
+        print('| routing {:6s} | legacy {:8.3f} ms | fused {:8.3f} ms'.format(
+            mode, t_legacy, t_fused))
+
+    for name in args.gates.split(','):
+        gate = getattr(custom_gate, name)(args.d_model, args.num_expert, 1,
+                args.top_k).to(device)
+        gate.fused_count = True
+
+        def run_forward():
+            with torch.no_grad():
+                gate(inp)
+
+        def run_backward():
+            gate(inp)[1].sum().backward()
+
+        print('| {:24s} | forward {:8.3f} ms | forward + backward {:8.3f} ms'.format(
+            name, timeit(run_forward, args.repeat, args.cuda),
+            timeit(run_backward, args.repeat, args.cuda)))
+
+    # the HyperNet gate with its generated weight cached, as in training with a
+    # frozen hypernetwork, and regenerated on every call
+    gate = custom_gate.CustomNaiveGate_HyperNet(args.d_model, args.num_expert,
+            1, args.top_k).to(device)
+    for p in gate.hypernet.parameters():
+        p.requires_grad = False
+    for cached in [True, False]:
+
+        def run_forward():
+            if not cached:
+                gate._weight_cache = None
+            with torch.no_grad():
+                gate(inp)
+
+        def run_backward():
+            if not cached:
+                gate._weight_cache = None
+            gate(inp)[1].sum().backward()
+
+        print('| HyperNet, cached = {:d}     | forward {:8.3f} ms | forward + backward {:8.3f} ms'.format(
+            cached, timeit(run_forward, args.repeat, args.cuda),
+            timeit(run_backward, args.repeat, args.cuda)))
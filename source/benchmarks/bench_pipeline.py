@@ -0,0 +1,71 @@
+r"""
+Benchmark of the chunked expert-parallel pipeline: wall-clock time of the
+forward and backward of one `FMoETransformerMLP` layer, whose experts are
+sharded over several gloo processes, for a number of chunks.
+
+Usage (from `source/`):
+    python benchmarks/bench_pipeline.py --world_size 4 --chunks 1,2,4,8
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+parser = argparse.ArgumentParser(description='MoE pipeline benchmark')
+parser.add_argument('--world_size', type=int, default=4)
+parser.add_argument('--tokens', type=int, default=4096,
+                    help='tokens on each worker')
+parser.add_argument('--d_model', type=int, default=256)
+parser.add_argument('--d_hidden', type=int, default=1024)
+parser.add_argument('--num_expert', type=int, default=4,
+                    help='experts on each worker')
+parser.add_argument('--top_k', type=int, default=2)
+parser.add_argument('--chunks', type=str, default='1,2,4,8')
+parser.add_argument('--repeat', type=int, default=10)
+parser.add_argument('--threads', type=int, default=2,
+                    help='intra-op threads of each worker')
+parser.add_argument('--port', type=int, default=29511)
+
+def run(rank, args):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    torch.set_num_threads(args.threads)
+    dist.init_process_group('gloo', rank=rank, world_size=args.world_size)
+
+    from custom_transformer import FMoETransformerMLP
+    from custom_gate import CustomNaiveGate
+
+    torch.manual_seed(rank)
+    layer = FMoETransformerMLP(num_expert=args.num_expert, d_model=args.d_model,
+            d_hidden=args.d_hidden, top_k=args.top_k, world_size=args.world_size,
+            gate=CustomNaiveGate, activation=torch.nn.ReLU())
+    inp = torch.randn(args.tokens, args.d_model, requires_grad=True)
+
+    for num_chunks in [int(c) for c in args.chunks.split(',')]:
+        layer.pipeline_chunks = num_chunks
+
+        def step():
+            layer(inp).sum().backward()
+
+        step()
+        dist.barrier()
+        start = time.time()
+        for _ in range(args.repeat):
+            step()
+        dist.barrier()
+        elapsed = torch.tensor((time.time() - start) * 1000 / args.repeat)
+        dist.all_reduce(elapsed, op=dist.ReduceOp.MAX)
+        if rank == 0:
+            print('| world size {} | chunks {:2d} | forward + backward {:8.3f} ms'.format(
+                args.world_size, num_chunks, elapsed.item()))
+    dist.destroy_process_group()
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    mp.spawn(run, args=(args,), nprocs=args.world_size)
@@ -0,0 +1,64 @@
+r"""
+Benchmark of the routing trace recorder: wall-clock time of the forward of a
+stack of MoE layers without and with a `RoutingTraceRecorder` attached, and
+the size of the written trace.
+
+Usage (from `source/`):
+    python benchmarks/bench_trace.py --tokens 8192 --num_expert 16 --cuda
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+
+from common import make_parser, timeit
+from custom_gate import CustomNaiveGate
+from custom_transformer import FMoETransformerMLP
+from latest_utils import set_routing_trace
+from routing_trace import RoutingTraceRecorder
+
+parser = make_parser('MoE routing trace benchmark', tokens=8192, num_expert=16)
+parser.add_argument('--d_model', type=int, default=512)
+parser.add_argument('--d_hidden', type=int, default=1024)
+parser.add_argument('--n_layer', type=int, default=4)
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    model = nn.Sequential(*[FMoETransformerMLP(num_expert=args.num_expert,
+        d_model=args.d_model, d_hidden=args.d_hidden, top_k=args.top_k,
+        gate=CustomNaiveGate, activation=nn.GELU())
+        for _ in range(args.n_layer)]).to(device).eval()
+    # a few batches in turn, so that the trace does not compress away
+    inps = [torch.randn(args.tokens, args.d_model, device=device)
+            for _ in range(8)]
+    count = [0]
+
+    def forward():
+        count[0] += 1
+        return model(inps[count[0] % len(inps)])
+
+    with torch.no_grad():
+        base = timeit(forward, args.repeat, args.cuda)
+        print('| no trace        | {:8.3f} ms'.format(base))
+
+        path = tempfile.mkdtemp()
+        recorder = RoutingTraceRecorder(path, chunk_steps=16)
+        set_routing_trace(model, recorder)
+
+        def step():
+            forward()
+            recorder.step()
+        traced = timeit(step, args.repeat, args.cuda)
+        start = time.time()
+        set_routing_trace(model, None)
+        recorder.close()
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        print('| trace           | {:8.3f} ms | overhead {:.1%} | close {:.1f} ms '
+              '| {:.1f} bytes/token/layer'.format(traced, traced / base - 1,
+              (time.time() - start) * 1000,
+              size / ((args.repeat + 1) * args.tokens * args.n_layer)))
+        shutil.rmtree(path)
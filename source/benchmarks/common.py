@@ -0,0 +1,40 @@
+r"""
+Setup shared by the benchmarks: `source/` on the import path, the common
+command line options and the timer.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def make_parser(description, tokens, num_expert, top_k=2, repeat=50):
+    r"""
+    An argument parser with the `--tokens`, `--num_expert`, `--top_k`,
+    `--repeat` and `--cuda` options, and the given defaults.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--tokens', type=int, default=tokens)
+    parser.add_argument('--num_expert', type=int, default=num_expert)
+    parser.add_argument('--top_k', type=int, default=top_k)
+    parser.add_argument('--repeat', type=int, default=repeat)
+    parser.add_argument('--cuda', action='store_true')
+    return parser
+
+def timeit(fn, repeat, cuda=False):
+    r"""
+    Mean wall-clock time in ms of `repeat` calls of `fn`, after one warm-up
+    call, waiting for the device with `cuda`.
+    """
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) * 1000 / repeat
@@ -0,0 +1,128 @@
+r"""
+Distill the routing of a trained StableMoE model into a frozen lookup table.
+
+Every `CustomNaiveGate_Distill` of the model is run over the training corpus,
+and the experts it picks for every token id are counted. Each token id is then
+assigned the `top_k` experts it was routed to most often, with their mean
+scores, and the gate is replaced by a `CustomTableGate` that routes with a
+single lookup. The token ids never seen go to the most used experts.
+
+Usage (from `source/`):
+    python build_routing_table.py --data ../data/enwik8/ --dataset enwik8 \
+        --work_dir <dir of model.pt> --max_batches 1000 --cuda
+"""
+import argparse
+import os
+
+import torch
+
+from data_utils import get_lm_corpus
+from custom_gate import CustomNaiveGate_Distill, CustomTableGate
+
+parser = argparse.ArgumentParser(description='StableMoE routing table')
+parser.add_argument('--data', type=str, default='../data/enwik8',
+                    help='location of the data corpus')
+parser.add_argument('--dataset', type=str, default='enwik8',
+                    choices=['wt103', 'lm1b', 'enwik8', 'text8'],
+                    help='dataset name')
+parser.add_argument('--work_dir', type=str, required=True,
+                    help='directory of the trained model.pt')
+parser.add_argument('--output', type=str, default='model-table.pt',
+                    help='file name of the model with the table gates, in work_dir')
+parser.add_argument('--batch_size', type=int, default=22)
+parser.add_argument('--tgt_len', type=int, default=512)
+parser.add_argument('--mem_len', type=int, default=512)
+parser.add_argument('--ext_len', type=int, default=0)
+parser.add_argument('--max_batches', type=int, default=-1,
+                    help='number of training batches to count, -1 for all')
+parser.add_argument('--cuda', action='store_true')
+
+def build_table(expert_count, score_sum, top_k):
+    r"""
+    Build the `n_token x top_k` experts and scores of every token id from the
+    `n_token x num_expert` number of routings and sum of their scores.
+    """
+    expert_table = torch.topk(expert_count, k=top_k, dim=-1)[1]
+    score_table = (score_sum.gather(1, expert_table)
+            / expert_count.gather(1, expert_table).clamp(min=1))
+    score_table = score_table / score_table.sum(dim=-1, keepdim=True).clamp(
+            min=1e-9)
+
+    unseen = expert_count.sum(dim=-1) == 0
+    fallback = torch.topk(expert_count.sum(dim=0), k=top_k)[1]
+    expert_table[unseen] = fallback
+    score_table[unseen] = 1.0 / top_k
+    return expert_table, score_table
+
+def main(args):
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    corpus = get_lm_corpus(args.data, args.dataset)
+    n_token = len(corpus.vocab)
+    tr_iter = corpus.get_iterator('train', args.batch_size, args.tgt_len,
+            device=device, ext_len=args.ext_len)
+
+    with open(os.path.join(args.work_dir, 'model.pt'), 'rb') as f:
+        model = torch.load(f, map_location=device)
+    model.reset_length(args.tgt_len, args.ext_len, args.mem_len)
+    model.eval()
+
+    gates = [(name, m) for name, m in model.named_modules()
+            if isinstance(m, CustomNaiveGate_Distill)]
+    assert len(gates) > 0, 'the model has no CustomNaiveGate_Distill'
+    stats = {}
+    current = {}
+
+    def count_hook(name):
+        def hook(module, inp, out):
+            gate_top_k_idx, gate_score = out[0], out[1]
+            token_ids = current['token_ids'].reshape(-1, 1).expand_as(
+                    gate_top_k_idx)
+            flat_idx = (token_ids * module.tot_expert + gate_top_k_idx).reshape(-1)
+            expert_count, score_sum = stats[name]
+            expert_count.index_add_(0, flat_idx,
+                    torch.ones_like(flat_idx, dtype=expert_count.dtype))
+            score_sum.index_add_(0, flat_idx,
+                    gate_score.reshape(-1).to(score_sum.dtype))
+        return hook
+
+    handles = []
+    for name, gate in gates:
+        stats[name] = (
+            torch.zeros(n_token * gate.tot_expert, device=device),
+            torch.zeros(n_token * gate.tot_expert, device=device),
+        )
+        handles.append(gate.register_forward_hook(count_hook(name)))
+
+    with torch.no_grad():
+        mems = tuple()
+        for i, (data, target, seq_len) in enumerate(tr_iter):
+            if args.max_batches > 0 and i >= args.max_batches:
+                break
+            current['token_ids'] = data
+            ret = model(data, target, *mems)
+            mems = ret[1:]
+            if i % 100 == 0:
+                print('| counted {:>6d} batches'.format(i))
+    for handle in handles:
+        handle.remove()
+
+    modules = dict(model.named_modules())
+    for name, gate in gates:
+        expert_count, score_sum = stats[name]
+        expert_table, score_table = build_table(
+                expert_count.view(n_token, gate.tot_expert),
+                score_sum.view(n_token, gate.tot_expert), gate.top_k)
+        table_gate = CustomTableGate(None, gate.num_expert, gate.world_size,
+                gate.top_k).to(device)
+        table_gate.set_table(expert_table, score_table)
+        parent, attr = name.rsplit('.', 1)
+        setattr(modules[parent], attr, table_gate)
+        print('Layer name: {}, tokens seen = {}'.format(name,
+            int((expert_count.view(n_token, -1).sum(dim=-1) > 0).sum())))
+    model.index_moe_gates()
+
+    with open(os.path.join(args.work_dir, args.output), 'wb') as f:
+        torch.save(model, f)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -1,13 +1,16 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd import Function
 
-from fmoe.gates.base_gate import BaseGate
+from gates.base_gate import BaseGate
 
 import pdb
 import numpy as np 
 
 __all__ = [
+    'CustomBaseGate', 
     'CustomDenseGate', 
     'CustomDropGate', 
     'CustomNaiveGate', 
@@ -15,45 +18,178 @@ __all__ = [
     'CustomNaiveGate_Balance', 
     'CustomNaiveGate_XMoE', 
     'CustomNaiveGate_Distill', 
-    # 'CustomNaiveGate_HyperNet', 
+    'CustomTableGate', 
+    'CustomExpertChoiceGate', 
+    'CustomDTSGate', 
+    'CustomNaiveGate_HyperNet', 
+    'HyperRouterGenerator', 
 ]
 
-class CustomDenseGate(BaseGate):
+def fused_route(gate, top_k, dense=False, return_count=False):
     r"""
-    Dense Gate
+    The routing core shared by the custom gates. It selects `top_k` experts for
+    every token from the `tokens x experts` logits `gate`, and returns their
+    indices and softmax scores.
+    * `dense` routes every token to every expert with uniform scores.
+    * When `top_k` covers all the experts, the indices are built with `arange`
+    and the scores are the softmax over all the logits.
+    * `top_k == 1` takes the argmax instead of a topk.
+    * `return_count` also returns the number of tokens routed to each expert,
+    so that the dispatcher does not count them again.
     """
+    num_token, num_expert = gate.shape
+    if dense or top_k >= num_expert:
+        gate_top_k_idx = torch.arange(num_expert, device=gate.device).repeat(
+                num_token, 1)
+        if dense:
+            gate_score = gate.new_full((num_token, num_expert), 1.0 / num_expert)
+        else:
+            gate_score = F.softmax(gate, dim=-1)
+    elif top_k == 1:
+        gate_top_k_idx = gate.argmax(dim=-1, keepdim=True)
+        gate_score = F.softmax(gate.gather(1, gate_top_k_idx), dim=-1)
+    else:
+        gate_top_k_val, gate_top_k_idx = torch.topk(
+            gate, k=top_k, dim=-1, largest=True, sorted=False
+        )  # [.. x top_k]
+        gate_score = F.softmax(gate_top_k_val, dim=-1)
 
-    def __init__(self, d_model, num_expert, world_size, top_k=2):
+    if not return_count:
+        return gate_top_k_idx, gate_score
+    if gate_top_k_idx.shape[1] == num_expert:
+        expert_count = torch.full((num_expert,), num_token, dtype=torch.long,
+                device=gate.device)
+    else:
+        expert_count = _count_experts(gate_top_k_idx, num_expert)
+    return gate_top_k_idx, gate_score, expert_count
+
+def _count_experts(gate_top_k_idx, num_expert):
+    idx = gate_top_k_idx.reshape(-1)
+    return torch.zeros(num_expert, dtype=torch.long,
+            device=idx.device).scatter_add_(0, idx, torch.ones_like(idx))
+
+class CustomBaseGate(BaseGate):
+    r"""
+    Base of the custom gates, which compute their logits and route the tokens
+    with `fused_route`.
+    * `dense_moe_flag` routes every token to every expert with uniform scores.
+    * `fused_count` also counts the tokens of every expert while routing, and
+    leaves the counts in `expert_count` for the dispatcher.
+    * The gates with a `balance_temperature` compute a load-balance loss in
+    training mode, whose statistics are kept in a preallocated buffer.
+    * `count_non_finite` accumulates the number of non-finite scores replaced
+    by `_make_finite` in training mode in `non_finite_count` on the device,
+    for debugging.
+    The class attributes are the defaults of the models pickled before them.
+    """
+
+    balance_temperature = None
+    fused_count = False
+    expert_count = None
+    count_non_finite = False
+    non_finite_count = None
+    _embedding_cache = None
+
+    def __init__(self, num_expert, world_size, top_k=2):
         super().__init__(num_expert, world_size)
-        self.gate = nn.Linear(d_model, self.tot_expert)
         self.top_k = top_k
         self.dense_moe_flag = False
+        self.fused_count = False
+        self.expert_count = None
+        if self.balance_temperature is not None:
+            self.register_buffer("fraction_expert", torch.zeros(self.tot_expert),
+                    persistent=False)
+
+    def route(self, gate, top_k=None):
+        outs = fused_route(
+            gate,
+            self.top_k if top_k is None else top_k,
+            dense=self.dense_moe_flag,
+            return_count=self.fused_count,
+        )
+        if self.fused_count:
+            self.expert_count = outs[2]
+        return outs[0], outs[1]
 
-    def forward(self, inp, return_all_scores=False):
+    def set_load_balance(self, gate, gate_top_k_idx):
+        # gate_top_k_idx (tokens_number, top-k)
+        # gate (tokens_number, tot_expert)
+        if not self.training:
+            self.loss = None
+            return
+        if not hasattr(self, "fraction_expert"):
+            self.register_buffer("fraction_expert",
+                    torch.zeros(self.tot_expert, device=gate.device),
+                    persistent=False)
+
+        score = F.softmax(gate / self.balance_temperature, dim=-1)
+        with torch.no_grad():
+            valid = gate_top_k_idx > -1
+            num_valid = valid.sum()
+            self.fraction_expert.zero_().scatter_add_(
+                0,
+                gate_top_k_idx.clamp(min=0).view(-1),
+                valid.view(-1).to(self.fraction_expert.dtype),
+            ).div_(num_valid)
+        prob_expert = score.sum(dim=0) / num_valid
 
-        gate = self.gate(inp)
-        repeat_shape = list(gate.shape[:-1])
-        repeat_shape.append(1)
+        loss = (self.fraction_expert * prob_expert).sum() * self.tot_expert
+        self.loss = loss
 
-        gate_top_k_idx = torch.arange(self.tot_expert).repeat(repeat_shape).to(gate.device)
+    def _normalized_embeddings(self, eps=1e-4):
+        r"""
+        The transposed, L2-normalized float `expert_embeddings` of the cosine
+        gates. Unless it needs a gradient, it is cached until the version
+        counter or the storage of the parameter changes, e.g. by an optimizer
+        step or a load.
+        """
+        weight = self.expert_embeddings
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return F.normalize(weight.float(), p=2.0, dim=1, eps=eps).t()
+        key = (weight._version, weight.data_ptr(), eps)
+        if self._embedding_cache is None or self._embedding_cache[0] != key:
+            with torch.no_grad():
+                normalized = F.normalize(weight.float(), p=2.0, dim=1, eps=eps)
+            self._embedding_cache = (key, normalized.t().contiguous())
+        return self._embedding_cache[1]
 
-        gate_top_k_val = gate.view(-1, self.tot_expert)
-        gate_score = F.softmax(gate_top_k_val, dim=-1)
+    def _make_finite(self, scores):
+        ok = scores.isfinite()
+        if self.count_non_finite and self.training:
+            num_bad = (~ok).sum()
+            self.non_finite_count = num_bad if self.non_finite_count is None \
+                    else self.non_finite_count + num_bad
+        # NaNs here can break the assignment algorithm, replace them with the
+        # smallest finite score without reading it back to the host
+        min_finite = torch.where(ok, scores, scores.new_tensor(float("inf"))).min()
+        return torch.where(ok, scores, min_finite)
+
+class CustomDenseGate(CustomBaseGate):
+    r"""
+    Dense Gate
+    """
+
+    def __init__(self, d_model, num_expert, world_size, top_k=2):
+        super().__init__(num_expert, world_size, top_k)
+        self.gate = nn.Linear(d_model, self.tot_expert)
+
+    def forward(self, inp, return_all_scores=False):
+
+        gate = self.gate(inp)
+        gate_top_k_idx, gate_score = self.route(gate, top_k=self.tot_expert)
 
         if return_all_scores:
             return gate_top_k_idx, gate_score, gate
         return gate_top_k_idx, gate_score
 
-class CustomDropGate(BaseGate):
+class CustomDropGate(CustomBaseGate):
     r"""
     Dropout Gate
     """
 
     def __init__(self, d_model, num_expert, world_size, top_k=2):
-        super().__init__(num_expert, world_size)
+        super().__init__(num_expert, world_size, top_k)
         self.gate = nn.Linear(d_model, self.tot_expert)
-        self.top_k = top_k
-        self.dense_moe_flag = False
         self.dropout = nn.Dropout(p=0.5)
 
     def forward(self, inp, return_all_scores=False):
@@ -63,140 +199,67 @@ class CustomDropGate(BaseGate):
         if self.training:
             gate = self.dropout(gate)
 
-        if self.dense_moe_flag:
-            gate = torch.ones_like(gate) # average the importance of all experts
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.tot_expert, dim=-1, largest=True, sorted=False
-            )
-            gate_top_k_val = gate_top_k_val.view(-1, self.tot_expert)
-        else:
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.top_k, dim=-1, largest=True, sorted=False
-            )  # [.. x top_k]
-            gate_top_k_val = gate_top_k_val.view(-1, self.top_k)
-        # (BxL) x 1 x top_k
-
-        gate_score = F.softmax(gate_top_k_val, dim=-1)
+        gate_top_k_idx, gate_score = self.route(gate)
 
         if return_all_scores:
             return gate_top_k_idx, gate_score, gate
         return gate_top_k_idx, gate_score
 
-class CustomNaiveGate(BaseGate):
+class CustomNaiveGate(CustomBaseGate):
     r"""
     Naive Gate
     """
 
     def __init__(self, d_model, num_expert, world_size, top_k=2):
-        super().__init__(num_expert, world_size)
+        super().__init__(num_expert, world_size, top_k)
         self.gate = nn.Linear(d_model, self.tot_expert)
-        self.top_k = top_k
-        self.dense_moe_flag = False
 
     def forward(self, inp, return_all_scores=False):
 
         gate = self.gate(inp)
 
-        if self.dense_moe_flag:
-            gate = torch.ones_like(gate) # average the importance of all experts
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.tot_expert, dim=-1, largest=True, sorted=False
-            )
-            gate_top_k_val = gate_top_k_val.view(-1, self.tot_expert)
-        else:
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.top_k, dim=-1, largest=True, sorted=False
-            )  # [.. x top_k]
-            gate_top_k_val = gate_top_k_val.view(-1, self.top_k)
-        # (BxL) x 1 x top_k
-
-        gate_score = F.softmax(gate_top_k_val, dim=-1)
+        gate_top_k_idx, gate_score = self.route(gate)
 
         if return_all_scores:
             return gate_top_k_idx, gate_score, gate
         return gate_top_k_idx, gate_score
 
-class CustomNaiveGate_Attn(BaseGate):
+class CustomNaiveGate_Attn(CustomBaseGate):
     r"""
     Naive Gate Attention
     """
 
     def __init__(self, d_model, num_expert, world_size, top_k=2):
-        super().__init__(num_expert, world_size)
+        super().__init__(num_expert, world_size, top_k)
         self.gate = nn.Linear(d_model, self.tot_expert)
-        self.top_k = top_k
-        self.dense_moe_flag = False
 
     def forward(self, inp, return_all_scores=False):
 
         gate = self.gate(inp)
 
-        if self.dense_moe_flag:
-            gate = torch.ones_like(gate) # average the importance of all experts
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.tot_expert, dim=-1, largest=True, sorted=False
-            )
-            gate_top_k_val = gate_top_k_val.view(-1, self.tot_expert)
-        else:
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.top_k, dim=-1, largest=True, sorted=False
-            )  # [.. x top_k]
-            gate_top_k_val = gate_top_k_val.view(-1, self.top_k)
-        # (BxL) x 1 x top_k
-
-        gate_score = F.softmax(gate_top_k_val, dim=-1)
+        gate_top_k_idx, gate_score = self.route(gate)
 
         if return_all_scores:
             return gate_top_k_idx, gate_score, gate
         return gate_top_k_idx, gate_score
 
-class CustomNaiveGate_Balance(BaseGate):
+class CustomNaiveGate_Balance(CustomBaseGate):
     r"""
     Naive Gate with Balance loss
     """
 
+    balance_temperature = 1.0
+
     def __init__(self, d_model, num_expert, world_size, top_k=2):
-        super().__init__(num_expert, world_size)
+        super().__init__(num_expert, world_size, top_k)
         self.gate = nn.Linear(d_model, self.tot_expert)
-        self.top_k = top_k
-        self.dense_moe_flag = False
         self.loss = None
 
-    def set_load_balance(self, gate, gate_top_k_idx):
-        # gate_top_k_idx (tokens_number, top-k)
-        # gate_top_k_val (tokens_number, top-k)
-
-        score = F.softmax(gate, dim=-1)
-        valid_idx = gate_top_k_idx[gate_top_k_idx > -1]
-        fraction_expert = torch.scatter_add(
-                torch.zeros(self.tot_expert, device=valid_idx.device),
-                0,
-                valid_idx,
-                torch.ones_like(valid_idx, dtype=torch.float),
-            ) / valid_idx.numel()
-        prob_expert = score.sum(dim=0) / valid_idx.numel()
-
-        loss = (fraction_expert * prob_expert).sum() * self.tot_expert
-        self.loss = loss
-
     def forward(self, inp, return_all_scores=False):
 
         gate = self.gate(inp)
 
-        if self.dense_moe_flag:
-            gate = torch.ones_like(gate) # average the importance of all experts
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.tot_expert, dim=-1, largest=True, sorted=False
-            )
-            gate_top_k_val = gate_top_k_val.view(-1, self.tot_expert)
-        else:
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.top_k, dim=-1, largest=True, sorted=False
-            )  # [.. x top_k]
-            gate_top_k_val = gate_top_k_val.view(-1, self.top_k)
-        # (BxL) x 1 x top_k
-
-        gate_score = F.softmax(gate_top_k_val, dim=-1)
+        gate_top_k_idx, gate_score = self.route(gate)
 
         self.set_load_balance(gate, gate_top_k_idx)
 
@@ -204,15 +267,16 @@ class CustomNaiveGate_Balance(BaseGate):
             return gate_top_k_idx, gate_score, gate
         return gate_top_k_idx, gate_score
 
-class CustomNaiveGate_XMoE(BaseGate):
+class CustomNaiveGate_XMoE(CustomBaseGate):
     r"""
     Naive Gate XMoE
     """
 
+    balance_temperature = 0.3
+    _rescale_key = None
+
     def __init__(self, d_model, num_expert, world_size, top_k=2):
-        super().__init__(num_expert, world_size)
-        self.top_k = top_k
-        self.dense_moe_flag = False
+        super().__init__(num_expert, world_size, top_k)
         self.loss = None
 
         expert_embeddings = torch.empty(num_expert, 16)
@@ -221,47 +285,22 @@ class CustomNaiveGate_XMoE(BaseGate):
 
         self.inp_reduction = torch.nn.Linear(d_model, 16, bias=False)
 
-    def set_load_balance(self, gate, gate_top_k_idx):
-        # gate_top_k_idx (tokens_number, top-k)
-        # gate_top_k_val (tokens_number, top-k)
-
-        score = F.softmax(gate/0.3, dim=-1)
-        valid_idx = gate_top_k_idx[gate_top_k_idx > -1]
-        fraction_expert = torch.scatter_add(
-                torch.zeros(self.tot_expert, device=valid_idx.device),
-                0,
-                valid_idx,
-                torch.ones_like(valid_idx, dtype=torch.float),
-            ) / valid_idx.numel()
-        prob_expert = score.sum(dim=0) / valid_idx.numel()
-
-        loss = (fraction_expert * prob_expert).sum() * self.tot_expert
-        self.loss = loss
-
     def forward(self, inp, return_all_scores=False):
 
         reduced_inp = self.inp_reduction(inp)
-        with torch.no_grad():
-            expert_embeddings_norm = self.expert_embeddings.norm(p=2.0, dim=1, keepdim=True)
-            self.expert_embeddings.mul_(1.5 / expert_embeddings_norm)
-
-        gate = self._cosine(reduced_inp, self.expert_embeddings)
+        # rescale the embeddings only when they changed since the last rescale
+        key = (self.expert_embeddings._version, self.expert_embeddings.data_ptr())
+        if self._rescale_key != key:
+            with torch.no_grad():
+                expert_embeddings_norm = self.expert_embeddings.norm(p=2.0, dim=1, keepdim=True)
+                self.expert_embeddings.mul_(1.5 / expert_embeddings_norm)
+            self._rescale_key = (self.expert_embeddings._version,
+                    self.expert_embeddings.data_ptr())
+
+        gate = self._cosine(reduced_inp)
         gate = self._make_finite(gate)
 
-        if self.dense_moe_flag:
-            gate = torch.ones_like(gate) # average the importance of all experts
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.tot_expert, dim=-1, largest=True, sorted=False
-            )
-            gate_top_k_val = gate_top_k_val.view(-1, self.tot_expert)
-        else:
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.top_k, dim=-1, largest=True, sorted=False
-            )  # [.. x top_k]
-            gate_top_k_val = gate_top_k_val.view(-1, self.top_k)
-        # (BxL) x 1 x top_k
-
-        gate_score = F.softmax(gate_top_k_val, dim=-1)
+        gate_top_k_idx, gate_score = self.route(gate)
 
         self.set_load_balance(gate, gate_top_k_idx)
 
@@ -269,71 +308,34 @@ class CustomNaiveGate_XMoE(BaseGate):
             return gate_top_k_idx, gate_score, gate
         return gate_top_k_idx, gate_score
 
-    def _cosine(self, mat1, mat2, eps=1e-4):
+    def _cosine(self, mat1, eps=1e-4):
         assert mat1.dim() == 2
-        assert mat2.dim() == 2
         # mat1 = F.normalize(mat1, p=2.0, dim=1, eps=eps)
-        mat2 = F.normalize(mat2.float(), p=2.0, dim=1, eps=eps)
-        return mat1.float().matmul(mat2.transpose(0, 1)).type_as(mat1)
+        mat2 = self._normalized_embeddings(eps)
+        return mat1.float().matmul(mat2).type_as(mat1)
 
-    def _make_finite(self, scores):
-        ok = scores.isfinite()
-        if not ok.all():
-            # NaNs here can break the assignment algorithm
-            scores[~ok] = scores[ok].min()
-        return scores
 
-class CustomNaiveGate_Distill(BaseGate):
+class CustomNaiveGate_Distill(CustomBaseGate):
     r"""
     Naive Gate StableMoE
     """
 
+    balance_temperature = 0.3
+
     def __init__(self, d_model, num_expert, world_size, top_k=2):
-        super().__init__(num_expert, world_size)
-        self.top_k = top_k
-        self.dense_moe_flag = False
+        super().__init__(num_expert, world_size, top_k)
         self.loss = None
 
         expert_embeddings = torch.empty(num_expert, d_model)
         torch.nn.init.orthogonal_(expert_embeddings, gain=0.32)
         self.register_parameter("expert_embeddings", torch.nn.Parameter(expert_embeddings))
 
-    def set_load_balance(self, gate, gate_top_k_idx):
-        # gate_top_k_idx (tokens_number, top-k)
-        # gate_top_k_val (tokens_number, top-k)
-
-        score = F.softmax(gate/0.3, dim=-1)
-        valid_idx = gate_top_k_idx[gate_top_k_idx > -1]
-        fraction_expert = torch.scatter_add(
-                torch.zeros(self.tot_expert, device=valid_idx.device),
-                0,
-                valid_idx,
-                torch.ones_like(valid_idx, dtype=torch.float),
-            ) / valid_idx.numel()
-        prob_expert = score.sum(dim=0) / valid_idx.numel()
-
-        loss = (fraction_expert * prob_expert).sum() * self.tot_expert
-        self.loss = loss
-
     def forward(self, inp, return_all_scores=False):
 
-        gate = self._cosine(inp, self.expert_embeddings)
+        gate = self._cosine(inp)
         gate = self._make_finite(gate)
 
-        if self.dense_moe_flag:
-            gate = torch.ones_like(gate) # average the importance of all experts
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.tot_expert, dim=-1, largest=True, sorted=False
-            )
-            gate_top_k_val = gate_top_k_val.view(-1, self.tot_expert)
-        else:
-            gate_top_k_val, gate_top_k_idx = torch.topk(
-                gate, k=self.top_k, dim=-1, largest=True, sorted=False
-            )  # [.. x top_k]
-            gate_top_k_val = gate_top_k_val.view(-1, self.top_k)
-        # (BxL) x 1 x top_k
-
-        gate_score = F.softmax(gate_top_k_val, dim=-1)
+        gate_top_k_idx, gate_score = self.route(gate)
 
         self.set_load_balance(gate, gate_top_k_idx)
 
@@ -341,16 +343,338 @@ class CustomNaiveGate_Distill(BaseGate):
             return gate_top_k_idx, gate_score, gate
         return gate_top_k_idx, gate_score
 
-    def _cosine(self, mat1, mat2, eps=1e-4):
+    def _cosine(self, mat1, eps=1e-4):
         assert mat1.dim() == 2
-        assert mat2.dim() == 2
         # mat1 = F.normalize(mat1, p=2.0, dim=1, eps=eps)
-        mat2 = F.normalize(mat2.float(), p=2.0, dim=1, eps=eps)
-        return mat1.float().matmul(mat2.transpose(0, 1)).type_as(mat1)
+        mat2 = self._normalized_embeddings(eps)
+        return mat1.float().matmul(mat2).type_as(mat1)
 
-    def _make_finite(self, scores):
-        ok = scores.isfinite()
-        if not ok.all():
-            # NaNs here can break the assignment algorithm
-            scores[~ok] = scores[ok].min()
-        return scores
\ No newline at end of file
+class _CachedWeight(Function):
+    r"""
+    Return a cached generated weight, detached from its generation graph, and
+    back-propagate into `inputs` through that graph, which is retained so that
+    the weight can be used by several backward passes.
+    * `holder` is a one-element list with the generated weight, which is not
+    passed as a tensor to keep autograd from freeing its graph.
+    """
+
+    @staticmethod
+    def forward(ctx, holder, *inputs):
+        ctx.holder = holder
+        ctx.save_for_backward(*inputs)
+        return holder[0].detach()
+
+    @staticmethod
+    def backward(ctx, grad_weight):
+        inputs = ctx.saved_tensors
+        grads = torch.autograd.grad(ctx.holder[0], inputs, grad_weight,
+                retain_graph=True, allow_unused=True)
+        return (None,) + tuple(grads)
+
+class _WeightCache(object):
+    r"""
+    Cache of a weight generated by `generate_weight` from the parameters
+    `inputs`. The weight is generated again only when the version counter or
+    the storage of one of them changes, i.e. once per optimizer step, or once
+    in eval.
+    """
+
+    _weight_cache = None
+
+    def _cached_weight(self, inputs):
+        need_graph = torch.is_grad_enabled() and any(p.requires_grad for p in inputs)
+        key = tuple((p._version, p.data_ptr()) for p in inputs)
+        cache = self._weight_cache
+        if cache is None or cache[0] != key or (need_graph and not cache[1]):
+            with torch.set_grad_enabled(need_graph):
+                weight = self.generate_weight()
+            self._weight_cache = cache = (key, need_graph, [weight])
+        if need_graph:
+            return _CachedWeight.apply(cache[2], *[p for p in inputs
+                if p.requires_grad])
+        return cache[2][0].detach()
+
+    def __getstate__(self):
+        # the cached weight may hold a generation graph, which is not copied
+        state = self.__dict__.copy()
+        state["_weight_cache"] = None
+        return state
+
+class CustomNaiveGate_HyperNet(_WeightCache, CustomBaseGate):
+    r"""
+    Naive Gate HyperRouter, whose router weight is generated from a trainable
+    embedding `hyper_embedding` by a hypernetwork `hypernet`, which is kept
+    fixed (train.py freezes the parameters named `hypernet`).
+    The generated weight is cached (see `_WeightCache`). When the gate is
+    attached to a `HyperRouterGenerator`, it has no hypernetwork of its own
+    and only keeps its `router_index` in the generator. Its weight is then
+    taken from the generated weights passed to `router_weight`, or set in
+    `generated_weights` by the forward of the model that owns the generator.
+    """
+
+    router_index = None
+    generated_weights = None
+
+    def __init__(self, d_model, num_expert, world_size, top_k=2, hyper_size=64):
+        super().__init__(num_expert, world_size, top_k)
+        self.d_model = d_model
+        self.hyper_embedding = nn.Parameter(torch.empty(hyper_size))
+        nn.init.normal_(self.hyper_embedding, std=1.0)
+        self.hypernet = nn.Sequential(
+            nn.Linear(hyper_size, hyper_size),
+            nn.ReLU(),
+            nn.Linear(hyper_size, self.tot_expert * d_model),
+        )
+        self.bias = nn.Parameter(torch.zeros(self.tot_expert))
+
+    def generate_weight(self):
+        r"""
+        Generate the `tot_expert x d_model` router weight, without the cache.
+        """
+        return self.hypernet(self.hyper_embedding).view(self.tot_expert, self.d_model)
+
+    def router_weight(self, generated_weights=None):
+        if self.router_index is not None:
+            if generated_weights is None:
+                generated_weights = self.generated_weights
+            assert generated_weights is not None, \
+                'the weights of the router generator are set by the model forward'
+            return generated_weights[self.router_index]
+        return self._cached_weight([self.hyper_embedding]
+                + [p for p in self.hypernet.parameters() if p.requires_grad])
+
+    def forward(self, inp, return_all_scores=False):
+
+        gate = F.linear(inp, self.router_weight().to(inp.dtype), self.bias)
+
+        gate_top_k_idx, gate_score = self.route(gate)
+
+        if return_all_scores:
+            return gate_top_k_idx, gate_score, gate
+        return gate_top_k_idx, gate_score
+
+class HyperRouterGenerator(_WeightCache, nn.Module):
+    r"""
+    Generator of the router weights of `num_layer` HyperNet gates at once.
+    The embeddings of the layers are stacked in `hyper_embedding`, and every
+    layer of the hypernetworks is a single batched matmul over all the gates,
+    whose results are cached together (see `_WeightCache`).
+    * `rank` factorizes the output head: it generates a `tot_expert x rank`
+    and a `rank x d_model` factor per layer, whose product is the weight, so
+    the head has `rank * (tot_expert + d_model)` outputs instead of
+    `tot_expert * d_model`.
+    Use `from_gates` to build a generator from existing gates and attach them
+    to it. The generator holds no reference to the gates, nor they to it, so
+    that `nn.DataParallel` replicates both; the model passes the output of
+    `router_weights` to the gates on every forward.
+    """
+
+    def __init__(self, num_layer, d_model, tot_expert, hyper_size=64, rank=None):
+        super().__init__()
+        self.num_layer = num_layer
+        self.d_model = d_model
+        self.tot_expert = tot_expert
+        self.rank = rank
+        num_out = tot_expert * d_model if rank is None \
+                else rank * (tot_expert + d_model)
+
+        self.hyper_embedding = nn.Parameter(torch.empty(num_layer, hyper_size))
+        nn.init.normal_(self.hyper_embedding, std=1.0)
+        bound = 1.0 / hyper_size ** 0.5
+        self.hypernet_weight1 = nn.Parameter(
+                torch.empty(num_layer, hyper_size, hyper_size).uniform_(-bound, bound))
+        self.hypernet_bias1 = nn.Parameter(
+                torch.empty(num_layer, hyper_size).uniform_(-bound, bound))
+        self.hypernet_weight2 = nn.Parameter(
+                torch.empty(num_layer, num_out, hyper_size).uniform_(-bound, bound))
+        self.hypernet_bias2 = nn.Parameter(
+                torch.empty(num_layer, num_out).uniform_(-bound, bound))
+
+    @classmethod
+    def from_gates(cls, gates, rank=None):
+        r"""
+        Build a generator for the HyperNet `gates` and attach them to it. The
+        embeddings, and the hypernetworks unless `rank` is given, are copied
+        from the gates, which then drop their own.
+        """
+        first = gates[0]
+        hyper_size = first.hyper_embedding.shape[0]
+        generator = cls(len(gates), first.d_model, first.tot_expert,
+                hyper_size=hyper_size, rank=rank).to(first.hyper_embedding.device)
+        with torch.no_grad():
+            for i, gate in enumerate(gates):
+                generator.hyper_embedding[i].copy_(gate.hyper_embedding)
+                if rank is None:
+                    generator.hypernet_weight1[i].copy_(gate.hypernet[0].weight)
+                    generator.hypernet_bias1[i].copy_(gate.hypernet[0].bias)
+                    generator.hypernet_weight2[i].copy_(gate.hypernet[2].weight)
+                    generator.hypernet_bias2[i].copy_(gate.hypernet[2].bias)
+        for i, gate in enumerate(gates):
+            del gate.hyper_embedding
+            del gate.hypernet
+            gate._weight_cache = None
+            gate.router_index = i
+        return generator
+
+    def generate_weight(self):
+        r"""
+        Generate the `num_layer x tot_expert x d_model` router weights, without
+        the cache.
+        """
+        hidden = torch.baddbmm(self.hypernet_bias1.unsqueeze(1),
+                self.hyper_embedding.unsqueeze(1),
+                self.hypernet_weight1.transpose(1, 2)).relu()
+        out = torch.baddbmm(self.hypernet_bias2.unsqueeze(1), hidden,
+                self.hypernet_weight2.transpose(1, 2)).squeeze(1)
+        if self.rank is None:
+            return out.view(self.num_layer, self.tot_expert, self.d_model)
+        factor1, factor2 = out.split([self.tot_expert * self.rank,
+            self.rank * self.d_model], dim=-1)
+        return torch.bmm(
+            factor1.view(self.num_layer, self.tot_expert, self.rank),
+            factor2.view(self.num_layer, self.rank, self.d_model),
+        )
+
+    def router_weights(self):
+        return self._cached_weight([p for p in self.parameters()
+            if p.requires_grad or p is self.hyper_embedding])
+
+class CustomTableGate(CustomBaseGate):
+    r"""
+    Frozen router of the StableMoE stage 2, which routes every token to the
+    experts of its token id in a lookup table, as built by
+    `build_routing_table.py` from a trained `CustomNaiveGate_Distill`.
+    The ids of the routed tokens are read from `token_ids`, which
+    `MemTransformerLM` sets before every forward. As the routing only depends
+    on the ids, `lookup` can also be called before the layer runs, e.g. to
+    prefetch the experts.
+    """
+
+    def __init__(self, d_model, num_expert, world_size, top_k=2):
+        super().__init__(num_expert, world_size, top_k)
+        self.register_buffer("expert_table", torch.zeros(0, top_k, dtype=torch.long))
+        self.register_buffer("score_table", torch.zeros(0, top_k))
+        self.token_ids = None
+
+    def set_table(self, expert_table, score_table):
+        r"""
+        Set the `n_token x top_k` experts and scores of every token id.
+        """
+        assert expert_table.shape == score_table.shape
+        self.expert_table = expert_table.long()
+        self.score_table = score_table.float()
+        self.top_k = expert_table.shape[1]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the tables are empty until they are set or loaded
+        for name in ["expert_table", "score_table"]:
+            if prefix + name in state_dict:
+                setattr(self, name, torch.empty_like(state_dict[prefix + name],
+                        device=getattr(self, name).device))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def lookup(self, token_ids):
+        token_ids = token_ids.reshape(-1)
+        return self.expert_table[token_ids], self.score_table[token_ids]
+
+    def forward(self, inp, return_all_scores=False):
+        assert self.token_ids is not None, "token_ids are not set"
+        gate_top_k_idx, gate_score = self.lookup(self.token_ids)
+        gate_score = gate_score.to(inp.dtype)
+        if self.fused_count:
+            self.expert_count = _count_experts(gate_top_k_idx, self.tot_expert)
+
+        if return_all_scores:
+            gate = gate_score.new_zeros(gate_score.shape[0], self.tot_expert)
+            gate = gate.scatter(1, gate_top_k_idx, gate_score)
+            return gate_top_k_idx, gate_score, gate
+        return gate_top_k_idx, gate_score
+
+class CustomExpertChoiceGate(CustomBaseGate):
+    r"""
+    Expert Choice Gate, in which every expert picks the tokens with the highest
+    scores for it, instead of every token picking its experts. Each expert
+    takes `capacity_factor * top_k` times the average number of tokens per
+    expert, so the load is perfectly balanced, and a token is routed to any
+    number of experts, including none.
+    The experts and scores are returned as flat lists, expert by expert, and
+    `token_idx` holds the token of every entry.
+    """
+
+    def __init__(self, d_model, num_expert, world_size, top_k=2,
+            capacity_factor=1.0):
+        super().__init__(num_expert, world_size, top_k)
+        self.gate = nn.Linear(d_model, self.tot_expert)
+        self.capacity_factor = capacity_factor
+        self.token_idx = None
+
+    def forward(self, inp, return_all_scores=False):
+
+        gate = self.gate(inp)
+        score = F.softmax(gate, dim=-1)
+
+        num_token = score.shape[0]
+        capacity = min(num_token, max(1, math.ceil(
+            self.capacity_factor * num_token * self.top_k / self.tot_expert)))
+        gate_score, token_idx = torch.topk(score.t(), k=capacity, dim=-1)
+        gate_top_k_idx = torch.arange(self.tot_expert,
+                device=gate.device).repeat_interleave(capacity)
+        gate_score = gate_score.reshape(-1)
+        self.token_idx = token_idx.reshape(-1)
+        if self.fused_count:
+            self.expert_count = torch.full((self.tot_expert,), capacity,
+                    dtype=torch.long, device=gate.device)
+
+        if return_all_scores:
+            return gate_top_k_idx, gate_score, gate
+        return gate_top_k_idx, gate_score
+
+class CustomDTSGate(CustomBaseGate):
+    r"""
+    Dense-to-Sparse Gate, which routes every token to all the experts whose
+    probability, a softmax of the logits (with Gumbel noise in training)
+    divided by `temperature`, is above `threshold`, and at least to its best
+    expert. As `temperature` is annealed by `set_temperature`, the gate goes
+    from dense to sparse.
+    The experts and scores are returned as flat lists, and `token_idx` holds
+    the token of every entry, so each token only runs on its own experts.
+    `sum_top_k / forward_n` is the mean number of experts per token.
+    """
+
+    def __init__(self, d_model, num_expert, world_size, top_k=2):
+        super().__init__(num_expert, world_size, top_k)
+        self.gate = nn.Linear(d_model, self.tot_expert)
+        self.temperature = 1.0
+        self.threshold = 0.001
+        self.sum_top_k = 0
+        self.forward_n = 0
+        self.token_idx = None
+
+    def forward(self, inp, return_all_scores=False):
+
+        gate = self.gate(inp)
+
+        logits = gate
+        if self.training:
+            uniform = torch.rand_like(gate).clamp(min=1e-9, max=1 - 1e-9)
+            logits = gate - torch.log(-torch.log(uniform))
+        score = F.softmax(logits / self.temperature, dim=-1)
+
+        if self.dense_moe_flag:
+            keep = torch.ones_like(score, dtype=torch.bool)
+        else:
+            keep = score > self.threshold
+            keep.scatter_(1, score.argmax(dim=-1, keepdim=True), True)
+        token_idx, gate_top_k_idx = keep.nonzero(as_tuple=True)
+        gate_score = score[token_idx, gate_top_k_idx]
+        self.token_idx = token_idx
+        if self.fused_count:
+            self.expert_count = keep.sum(dim=0)
+
+        with torch.no_grad():
+            self.sum_top_k = self.sum_top_k + keep.sum(dim=-1).float().mean()
+        self.forward_n += 1
+
+        if return_all_scores:
+            return gate_top_k_idx, gate_score, gate
+        return gate_top_k_idx, gate_score
@@ -1,14 +1,17 @@
 import tree
 import os
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from functions import prepare_forward, ensure_comm
-from functions import MOEScatter, MOEGather
+from functions import prepare_forward, ensure_comm, record_host_sync
+from functions import MOEScatter, MOEGather, MOEGatherCombine
 from functions import AllGather, Slice
+from pipeline import _fmoe_pipeline_forward
 from gates import NaiveGate
 
-from fastermoe.config import switch_from_env
+from fastermoe.config import switch_from_env, float_from_env
 
 def mark_module_parallel_comm(module, comm):
     r"""
@@ -20,7 +23,9 @@ def mark_module_parallel_comm(module, comm):
     for p in module.parameters():
         setattr(p, "dp_comm", comm)
 
-def _fmoe_general_global_forward(inp, gate, expert_fn, num_expert, world_size, **kwargs):
+def _fmoe_general_global_forward(inp, gate, expert_fn, num_expert, world_size,
+        sync_free=False, gate_score=None, expert_count=None, token_idx=None,
+        dispatch_cache=None, **kwargs):
     r"""
     A private function that performs the following steps to complete the MoE
     computation.
@@ -31,22 +36,51 @@ def _fmoe_general_global_forward(inp, gate, expert_fn, num_expert, world_size, *
     * Gather the output features of experts back, and reorder them as sentences.
     Intermediate results like expert counts are hidden from users by this
     function.
+    If `gate_score` is given, the outputs of the experts are combined with it
+    while being gathered, and one row per token is returned instead of one row
+    per (token, expert) pair.
+    If `expert_count` is given, it is used as the number of tokens routed to
+    each expert instead of counting them again.
+    If `token_idx` is given, `gate` is a flat list of experts, any number per
+    token, and `token_idx` holds the token of every entry of `gate`.
+    If `dispatch_cache` is given, it is a dict holding the positions and
+    counts computed from the same `gate` by an earlier call, which are reused,
+    or an empty dict in which they are stored.
     """
-    (
-        pos,
-        local_expert_count,
-        global_expert_count,
-        fwd_expert_count,
-        fwd_batch_size,
-    ) = prepare_forward(gate, num_expert, world_size)
-    topk = 1
-    if len(gate.shape) == 2:
-        topk = gate.shape[1]
+    if dispatch_cache:
+        (
+            pos,
+            local_expert_count,
+            global_expert_count,
+            fwd_expert_count,
+            fwd_batch_size,
+            token_pos,
+        ) = dispatch_cache['dispatch']
+    else:
+        (
+            pos,
+            local_expert_count,
+            global_expert_count,
+            fwd_expert_count,
+            fwd_batch_size,
+        ) = prepare_forward(gate, num_expert, world_size, sync_free=sync_free,
+                expert_count=expert_count)
+        if token_idx is not None:
+            token_pos = token_idx[pos]
+        else:
+            topk = 1
+            if len(gate.shape) == 2:
+                topk = gate.shape[1]
+            token_pos = torch.div(pos, topk, rounding_mode='floor')
+        if dispatch_cache is not None:
+            dispatch_cache['dispatch'] = (pos, local_expert_count,
+                    global_expert_count, fwd_expert_count, fwd_batch_size,
+                    token_pos)
 
     def scatter_func(tensor):
         return MOEScatter.apply(
             tensor,
-            torch.div(pos, topk, rounding_mode='floor'),
+            token_pos,
             local_expert_count,
             global_expert_count,
             fwd_batch_size,
@@ -58,6 +92,24 @@ def _fmoe_general_global_forward(inp, gate, expert_fn, num_expert, world_size, *
     x = expert_fn(x, fwd_expert_count)
 
     out_batch_size = tree.flatten(inp)[0].shape[0]
+
+    if gate_score is not None:
+        gate_score = gate_score.reshape(-1)
+
+        def gather_combine_func(tensor):
+            return MOEGatherCombine.apply(
+                tensor,
+                gate_score,
+                pos,
+                token_pos,
+                local_expert_count,
+                global_expert_count,
+                out_batch_size,
+                world_size,
+            )
+
+        return tree.map_structure(gather_combine_func, x)
+
     if len(gate.shape) == 2:
         out_batch_size *= gate.shape[1]
 
@@ -74,11 +126,91 @@ def _fmoe_general_global_forward(inp, gate, expert_fn, num_expert, world_size, *
     outp = tree.map_structure(gather_func, x)
     return outp
 
+def _fmoe_einsum_forward(inp, gate, gate_score, experts, num_expert,
+        capacity):
+    r"""
+    A private function that performs the MoE computation with GShard-style
+    one-hot dispatch and combine tensors of shape `N x num_expert x capacity`.
+    * Each (token, expert) pair gets a slot in the buffer of its expert. The
+    slots are given in order of the top-k rank and then of the token, and the
+    pairs beyond `capacity` are dropped, as are the -1 indices of the gate.
+    * The samples are moved to a `capacity x num_expert x d_model` buffer
+    with one einsum, the experts run on it as batched matmuls through
+    `experts.forward_dense`, and another einsum weights and combines the
+    outputs.
+    All the shapes only depend on the number of tokens, so that no host
+    synchronization is needed.
+    """
+    gate = gate.view(gate.shape[0], -1)
+    gate_score = gate_score.reshape(gate.shape)
+    valid = gate > -1
+    # N x top_k x num_expert
+    expert_mask = F.one_hot(gate.clamp(min=0), num_expert) * valid.unsqueeze(-1)
+    # rank of every pair in its expert, top-1 choices first
+    mask_flat = expert_mask.transpose(0, 1).reshape(-1, num_expert)
+    loc = (torch.cumsum(mask_flat, dim=0) - mask_flat) * mask_flat
+    loc = loc.sum(dim=-1).view(gate.shape[1], gate.shape[0]).t()
+    keep = valid & (loc < capacity)
+    # N x top_k x capacity
+    loc_mask = F.one_hot(loc.clamp(max=capacity - 1), capacity) \
+            * keep.unsqueeze(-1)
+    dispatch_mask = torch.einsum("nke,nkc->nec",
+            expert_mask.to(gate_score.dtype), loc_mask.to(gate_score.dtype))
+    combine_weight = torch.einsum("nk,nke,nkc->nec", gate_score,
+            expert_mask.to(gate_score.dtype), loc_mask.to(gate_score.dtype))
+
+    def einsum_func(tensor):
+        x = torch.einsum("nec,nd->ced", dispatch_mask.to(tensor.dtype), tensor)
+        x = experts.forward_dense(x)
+        return torch.einsum("nec,ced->nd", combine_weight.to(x.dtype), x)
+
+    return tree.map_structure(einsum_func, inp)
+
 fmoe_faster_schedule = False
 if switch_from_env('FMOE_FASTER_SCHEDULE_ENABLE', False):
     fmoe_faster_schedule = True
     from .fastermoe.schedule import _fmoe_general_global_forward
 
+fmoe_sync_free = switch_from_env('FMOE_SYNC_FREE', False)
+fmoe_dispatch_mode = os.environ.get('FMOE_DISPATCH_MODE', 'sparse')
+fmoe_pipeline_chunks = int(float_from_env('FMOE_PIPELINE_CHUNKS', 1))
+# largest tokens x experts x capacity x d_model for which `auto` picks the
+# einsum engine, the capacity of `auto` being the number of tokens
+fmoe_einsum_max_cost = float_from_env('FMOE_EINSUM_MAX_COST', 2 ** 29)
+
+class SharedRouting(object):
+    r"""
+    The routing shared by a group of consecutive `FMoE` layers: the first
+    layer of the group, whose `routing_group_index` is 0, runs its gate and
+    the later layers reuse its indices and scores, and the positions and
+    counts of the sparse dispatch, instead of computing them again.
+    The routing of the last forward of the first layer is kept per device, as
+    the replicas of `nn.DataParallel` share this object and run in threads.
+    """
+
+    def __init__(self):
+        self._routing = {}
+
+    def reset(self):
+        self._routing = {}
+
+    def get(self, device):
+        return self._routing.get(device)
+
+    def set(self, device, num_token, gate_top_k_idx, gate_score, token_idx,
+            top_k):
+        routing = dict(num_token=num_token, gate_top_k_idx=gate_top_k_idx,
+                gate_score=gate_score, token_idx=token_idx, top_k=top_k,
+                dispatch_cache={})
+        self._routing[device] = routing
+        return routing
+
+    def __getstate__(self):
+        # the routing of the last forward is not saved with the model
+        state = self.__dict__.copy()
+        state['_routing'] = {}
+        return state
+
 class FMoE(nn.Module):
     r"""
     A general moe implementation that supports an arbitrary module as the
@@ -93,9 +225,39 @@ class FMoE(nn.Module):
     slice of the input batch, and will all-gather the outputs after
     computation.
     * `top_k` stands for the number of experts each token is going to.
-    * `gate` is a gate class which can found in `fmoe.gates`.
+    * `gate` is a gate class which can found in `fmoe.gates`. A gate that
+    routes each token to a variable number of experts returns flat lists of
+    experts and scores, and sets its `token_idx` attribute to the token of
+    every entry. These are always dispatched by the sparse path.
     * `expert` can be specified as a module class, it is used to generate
     `num_expert` expert modules.
+    * `gate_hook` is called after the gate with the indices and the scores of
+    the routing, and the `token_idx` of a gate routing to a variable number of
+    experts, or None.
+    * `sync_free` keeps the expert counts on the device and copies them to the
+    host once per forward, instead of synchronizing at every step of the
+    dispatch. It defaults to the `FMOE_SYNC_FREE` environment variable.
+    * `mask` is a tensor with one entry per input sample, which can also be
+    set before each forward. The samples with a non-zero mask, e.g. padding,
+    are dropped before the gate and their output is filled with zeros, or
+    with `mask_dict[k]` for the samples whose mask is `k`.
+    * `dispatch_mode` selects how the samples are sent to the experts:
+    `sparse` sorts and indexes them, `einsum` uses one-hot dispatch and combine
+    tensors whose expert capacity is `capacity_factor` times the average load
+    (GShard style, the overflow is dropped), and `auto` picks `einsum` with a
+    capacity of the number of tokens, the worst-case load of an expert, so
+    that no token is dropped, when tokens x experts x capacity x d_model, the
+    size of the dispatch einsum, is below `FMOE_EINSUM_MAX_COST`, and `sparse`
+    otherwise. It defaults to the `FMOE_DISPATCH_MODE` environment variable,
+    or `sparse`.
+    * `pipeline_chunks` splits the samples exchanged between the workers into
+    chunks, so that the exchange of a chunk overlaps with the computation of
+    the experts on the previous one (see `pipeline.py`). It only applies with
+    `world_size > 1` and defaults to the `FMOE_PIPELINE_CHUNKS` environment
+    variable, or 1.
+    * `shared_routing` is a `SharedRouting` whose first layer takes the
+    routing decision of this layer, which is at `routing_group_index` in the
+    group, see `set_shared_routing`.
     """
 
     def __init__(
@@ -112,6 +274,10 @@ class FMoE(nn.Module):
         gate_hook=None,
         mask=None,
         mask_dict=None,
+        sync_free=None,
+        dispatch_mode=None,
+        capacity_factor=1.25,
+        pipeline_chunks=None,
     ):
         super().__init__()
         self.num_expert = num_expert
@@ -145,6 +311,16 @@ class FMoE(nn.Module):
         self.mask = mask
         self.mask_dict = mask_dict
         self.moe_group = moe_group
+        self.sync_free = fmoe_sync_free if sync_free is None else sync_free
+        self.dispatch_mode = fmoe_dispatch_mode if dispatch_mode is None \
+                else dispatch_mode
+        assert self.dispatch_mode in ['sparse', 'einsum', 'auto'], \
+                "Unknown dispatch mode {}".format(self.dispatch_mode)
+        self.capacity_factor = capacity_factor
+        self.pipeline_chunks = fmoe_pipeline_chunks if pipeline_chunks is None \
+                else pipeline_chunks
+        self.shared_routing = None
+        self.routing_group_index = 0
 
     def expert_fn(self, inp, fwd_expert_count):
         r"""
@@ -154,6 +330,7 @@ class FMoE(nn.Module):
         if self.experts_fused:
             return self.experts(inp, fwd_expert_count)
         if isinstance(fwd_expert_count, torch.Tensor):
+            record_host_sync(fwd_expert_count)
             fwd_expert_count = fwd_expert_count.cpu().numpy()
         outputs = []
         base_idx = 0
@@ -179,6 +356,132 @@ class FMoE(nn.Module):
                 mark_module_parallel_comm(self.experts, comm)
         mark_module_parallel_comm(self.gate, "gate")
 
+    def _use_dense_forward(self, gate_top_k_idx):
+        r"""
+        Every sample is routed to every expert, which happens in dense
+        evaluation or when the dynamic top-k reaches the number of experts.
+        """
+        return (
+            self.world_size == 1
+            and hasattr(self.experts, "forward_dense")
+            and gate_top_k_idx.dim() == 2
+            and gate_top_k_idx.shape[1] == self.num_expert
+        )
+
+    def _dense_forward(self, moe_inp, gate_top_k_idx, gate_score):
+        r"""
+        Run all experts on the whole batch as batched matmuls and combine their
+        outputs with one weighted sum, without counting, positioning or
+        duplicating the samples. The scores are scattered to a dense
+        `N x num_expert` matrix, dropped (-1) selections get a zero weight.
+        """
+        valid = gate_top_k_idx > -1
+        score = gate_score.reshape(gate_top_k_idx.shape).masked_fill(~valid, 0)
+        dense_score = torch.zeros_like(score).scatter_add(
+            1, gate_top_k_idx.clamp(min=0), score
+        )
+
+        def dense_func(tensor):
+            x = self.experts.forward_dense(tensor)
+            return torch.einsum("ned,ne->nd", x, dense_score.to(x.dtype))
+
+        return tree.map_structure(dense_func, moe_inp)
+
+    def _use_einsum_forward(self, gate_top_k_idx):
+        if self.dispatch_mode == 'sparse':
+            return False
+        if (
+            self.world_size > 1
+            or not hasattr(self.experts, "forward_dense")
+        ):
+            return False
+        if self.dispatch_mode == 'einsum':
+            return True
+        # the one-hot dispatch tensor is N x E x capacity, i.e. O(N^2 E)
+        cost = (gate_top_k_idx.shape[0] * self.num_expert
+                * self._einsum_capacity(gate_top_k_idx) * self.d_model)
+        return cost <= fmoe_einsum_max_cost
+
+    def _einsum_capacity(self, gate_top_k_idx):
+        num_token = gate_top_k_idx.shape[0]
+        if self.dispatch_mode == 'auto':
+            # every token goes at most once to an expert, none is dropped
+            return max(num_token, 1)
+        top_k = gate_top_k_idx.numel() // max(num_token, 1)
+        return max(
+            math.ceil(self.capacity_factor * num_token * top_k / self.num_expert),
+            1,
+        )
+
+    def _einsum_forward(self, moe_inp, gate_top_k_idx, gate_score):
+        capacity = self._einsum_capacity(gate_top_k_idx)
+        return _fmoe_einsum_forward(moe_inp, gate_top_k_idx, gate_score,
+                self.experts, self.num_expert, capacity)
+
+    def _sparse_forward(self, moe_inp, gate_top_k_idx, gate_score,
+            expert_count=None, token_idx=None, dispatch_cache=None):
+        r"""
+        Dispatch the samples to their experts, and gather and combine the
+        outputs of the experts. `expert_count` is the number of tokens of
+        every expert, if the gate has counted them. `token_idx` is the token
+        of every routing of a gate with a variable number of experts per
+        token. `dispatch_cache` keeps the positions and counts of a routing
+        shared with other layers.
+        """
+        if token_idx is not None:
+            assert not fmoe_faster_schedule, \
+                    "Variable experts per token need the general dispatcher"
+        if (
+            self.world_size > 1
+            and self.pipeline_chunks > 1
+            and not fmoe_faster_schedule
+            and token_idx is None
+        ):
+            assert dispatch_cache is None, \
+                    "The pipelined forward does not support a shared routing"
+            return _fmoe_pipeline_forward(
+                moe_inp, gate_top_k_idx, gate_score, self.expert_fn,
+                self.num_expert, self.world_size, self.pipeline_chunks,
+                experts=self.experts, sync_free=self.sync_free,
+            )
+
+        fuse_combine = not fmoe_faster_schedule
+        dispatch_kwargs = dict(experts=self.experts)
+        if not fmoe_faster_schedule:
+            dispatch_kwargs['sync_free'] = self.sync_free
+            dispatch_kwargs['expert_count'] = expert_count
+            dispatch_kwargs['token_idx'] = token_idx
+            dispatch_kwargs['dispatch_cache'] = dispatch_cache
+        if fuse_combine:
+            dispatch_kwargs['gate_score'] = gate_score
+        fwd = _fmoe_general_global_forward(
+            moe_inp, gate_top_k_idx, self.expert_fn,
+            self.num_expert, self.world_size,
+            **dispatch_kwargs
+        )
+
+        if fuse_combine:
+            moe_outp = fwd
+        else:
+
+            def view_func(tensor):
+                dim = tensor.shape[-1]
+                tensor = tensor.view(-1, self.top_k, dim)
+                return tensor
+
+            moe_outp = tree.map_structure(view_func, fwd)
+
+            gate_score = gate_score.view(-1, 1, self.top_k)
+
+            def bmm_func(tensor):
+                dim = tensor.shape[-1]
+                tensor = torch.bmm(gate_score, tensor).reshape(-1, dim)
+                return tensor
+
+            moe_outp = tree.map_structure(bmm_func, moe_outp)
+
+        return moe_outp
+
     def forward(self, moe_inp):
 
         r"""
@@ -209,71 +512,85 @@ class FMoE(nn.Module):
 
             moe_inp = tree.map_structure(slice_func, moe_inp)
 
-        gate_top_k_idx, gate_score = self.gate(moe_inp)
+        # delete masked tokens
+        if self.mask is not None:
+            mask = self.mask.reshape(-1)
+            if self.slice_size > 1:
+                batch_size = mask.shape[0] // self.slice_size
+                mask = mask[
+                    self.slice_rank * batch_size : (self.slice_rank + 1) * batch_size
+                ]
+            keep_idx = torch.nonzero(mask == 0).view(-1)
+            record_host_sync(keep_idx)
 
-        if hasattr(self.gate, 'dynamic_top_k'):
-            self.top_k = self.gate.dynamic_top_k
-
-        if self.gate_hook is not None:
-            self.gate_hook(gate_top_k_idx, gate_score, None)
-
-        # delete masked tensors
-        if self.mask is not None and self.mask_dict is not None:
-            # TODO: to fix
             def delete_mask_func(tensor):
                 # to: (BxL') x d_model
-                tensor = tensor[mask == 0, :]
-                return tensor
+                return tensor.index_select(0, keep_idx)
 
-            mask = self.mask.view(-1)
             moe_inp = tree.map_structure(delete_mask_func, moe_inp)
-            gate_top_k_idx = gate_top_k_idx[mask == 0, :]
-
-        fwd = _fmoe_general_global_forward(
-            moe_inp, gate_top_k_idx, self.expert_fn,
-            self.num_expert, self.world_size,
-            experts=self.experts
-        )
-
-        # recover deleted tensors
-        if self.mask is not None and self.mask_dict is not None:
-
-            def recover_func(tensor):
-                # to: (BxL') x top_k x dim
-                dim = tensor.shape[-1]
-                tensor = tensor.view(-1, self.top_k, dim)
-                # to: (BxL) x top_k x d_model
-                x = torch.zeros(
-                    mask.shape[0],
-                    self.top_k,
-                    dim,
-                    device=tensor.device,
-                    dtype=tensor.dtype,
-                )
-                # recover
-                x[mask == 0] = tensor
-                for k, v in self.mask_dict.items():
-                    x[mask == k] = v
-                return x
 
-            moe_outp = tree.map_structure(recover_func, fwd)
+        shared = getattr(self, 'shared_routing', None)
+        dispatch_cache = None
+        if shared is not None:
+            # the tokens left after the mask, on the device of this replica
+            inp = tree.flatten(moe_inp)[0]
+            num_token, device = inp.shape[0], inp.device
+        if shared is not None and getattr(self, 'routing_group_index', 0) > 0:
+            routing = shared.get(device)
+            assert routing is not None and routing['num_token'] == num_token, \
+                    "The first layer of a shared routing must run first on the same tokens"
+            gate_top_k_idx, gate_score = routing['gate_top_k_idx'], routing['gate_score']
+            token_idx = routing['token_idx']
+            expert_count = None
+            self.top_k = routing['top_k']
+            dispatch_cache = routing['dispatch_cache']
         else:
+            gate_top_k_idx, gate_score = self.gate(moe_inp)
+
+            if hasattr(self.gate, 'dynamic_top_k'):
+                self.top_k = self.gate.dynamic_top_k
+
+            # counts of the tokens per expert, if the gate counted them in routing
+            expert_count = getattr(self.gate, 'expert_count', None)
+            if expert_count is not None:
+                self.gate.expert_count = None
+            # token of every routing, if the gate routes the tokens to a variable
+            # number of experts, given as flat lists
+            token_idx = getattr(self.gate, 'token_idx', None)
+            if token_idx is not None:
+                self.gate.token_idx = None
+            if shared is not None:
+                dispatch_cache = shared.set(device, num_token, gate_top_k_idx,
+                        gate_score, token_idx, self.top_k)['dispatch_cache']
 
-            def view_func(tensor):
-                dim = tensor.shape[-1]
-                tensor = tensor.view(-1, self.top_k, dim)
-                return tensor
-
-            moe_outp = tree.map_structure(view_func, fwd)
+        if self.gate_hook is not None:
+            self.gate_hook(gate_top_k_idx, gate_score, token_idx)
+
+        if token_idx is not None:
+            moe_outp = self._sparse_forward(moe_inp, gate_top_k_idx, gate_score,
+                    expert_count=expert_count, token_idx=token_idx,
+                    dispatch_cache=dispatch_cache)
+        elif self._use_dense_forward(gate_top_k_idx):
+            moe_outp = self._dense_forward(moe_inp, gate_top_k_idx, gate_score)
+        elif self._use_einsum_forward(gate_top_k_idx):
+            moe_outp = self._einsum_forward(moe_inp, gate_top_k_idx, gate_score)
+        else:
+            moe_outp = self._sparse_forward(moe_inp, gate_top_k_idx, gate_score,
+                    expert_count=expert_count, dispatch_cache=dispatch_cache)
 
-        gate_score = gate_score.view(-1, 1, self.top_k)
+        # recover masked tokens
+        if self.mask is not None:
 
-        def bmm_func(tensor):
-            dim = tensor.shape[-1]
-            tensor = torch.bmm(gate_score, tensor).reshape(-1, dim)
-            return tensor
+            def recover_func(tensor):
+                # to: (BxL) x d_model
+                x = tensor.new_zeros(mask.shape[0], tensor.shape[-1])
+                x = x.index_copy(0, keep_idx, tensor)
+                if self.mask_dict is not None:
+                    for k, v in self.mask_dict.items():
+                        x[mask == k] = v.to(x.dtype)
+                return x
 
-        moe_outp = tree.map_structure(bmm_func, moe_outp)
+            moe_outp = tree.map_structure(recover_func, moe_outp)
 
         if self.slice_size > 1:
 
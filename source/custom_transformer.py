@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from custom_layers import FMoE
 from linear import FMoELinear
 
@@ -14,22 +15,50 @@ class _Expert(nn.Module):
         self.htoh4 = FMoELinear(num_expert, d_model, d_hidden, bias=True, rank=rank)
         self.h4toh = FMoELinear(num_expert, d_hidden, d_model, bias=True, rank=rank)
         self.activation = activation
+        self.checkpoint = False
 
     def forward(self, inp, fwd_expert_count):
         r"""
         First expand input to 4h (the hidden size is variable, but is called h4
         for convenience). Then perform activation. Finally shirink back to h.
+        With `checkpoint` set, only the input is kept for backward and the 4h
+        activations are recomputed.
         """
+        if self.checkpoint and torch.is_grad_enabled():
+            return checkpoint(self._forward, inp, fwd_expert_count,
+                    use_reentrant=False)
+        return self._forward(inp, fwd_expert_count)
+
+    def _forward(self, inp, fwd_expert_count):
         x = self.htoh4(inp, fwd_expert_count)
         x = self.activation(x)
         x = self.h4toh(x, fwd_expert_count)
         return x
 
+    def forward_dense(self, inp):
+        r"""
+        Run all the experts on all the samples, which is used when every
+        sample is routed to every expert. The output is
+        `N x num_expert x d_model`.
+        """
+        if self.checkpoint and torch.is_grad_enabled():
+            return checkpoint(self._forward_dense, inp, use_reentrant=False)
+        return self._forward_dense(inp)
+
+    def _forward_dense(self, inp):
+        x = self.htoh4.forward_dense(inp)
+        x = self.activation(x)
+        x = self.h4toh.forward_dense(x)
+        return x
+
 class FMoETransformerMLP(FMoE):
     r"""
     A complete MoE MLP module in a Transformer block.
     * `activation` is the activation function to be used in MLP in each expert.
     * `d_hidden` is the dimension of the MLP layer.
+    * `expert_checkpoint` recomputes the hidden activations of the experts in
+    backward instead of keeping them, trading one more expert forward for
+    memory.
     """
 
     def __init__(
@@ -40,12 +69,14 @@ class FMoETransformerMLP(FMoE):
         activation=torch.nn.GELU(),
         expert_dp_comm="none",
         expert_rank=0,
+        expert_checkpoint=False,
         **kwargs
     ):
         super().__init__(num_expert=num_expert, d_model=d_model, **kwargs)
         self.experts = _Expert(
             num_expert, d_model, d_hidden, activation, rank=expert_rank
         )
+        self.experts.checkpoint = expert_checkpoint
         self.mark_parallel_comm(expert_dp_comm)
 
     def forward(self, inp: torch.Tensor):
@@ -76,6 +107,9 @@ class _Expert2(nn.Module):
         x = self.htoh4(inp, fwd_expert_count)
         return x
 
+    def forward_dense(self, inp):
+        return self.htoh4.forward_dense(inp)
+
 class FMoETransformerMLP2(FMoE):
     r"""
     A complete MoE MLP module in a Transformer block.
@@ -0,0 +1,149 @@
+r"""
+Supportive modules to conduct distributed training
+"""
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+from custom_utils import get_torch_default_comm
+
+class DistributedGroupedDataParallel(nn.Module):
+    r"""
+    A customized DDP module to support different all-reduce regions in the
+    model. The all-reduce region is defined as an attribution `dp_comm` in the
+    weight object, as set by `mark_parallel_comm`.
+    The grads of the weights are identified to be reduced in different groups
+    according to the weigths' `dp_comm` attribute.
+    If it is set to `dp`, it will only be reduced across the data-parallel
+    groups, which means that in the model parallel group, they are not
+    synchronized.
+    If it is set to `world`, the gradients is synchronized across all workers,
+    regardless their model or data parallel group. This is extremely useful for
+    shared layers like the gate.
+    If it is set to `none`, e.g. for the experts sharded across the workers,
+    the gradients are not synchronized. The experts of a MoE layer with
+    `world_size` 1 are held in full by every worker, and must not be tagged
+    `none`, or their copies drift apart (see `set_expert_dp_comm`).
+    The process group of a region is given as the keyword argument
+    `<region>_group`, and defaults to the world group.
+    The gradients of a region are flattened into buckets of at most
+    `bucket_size` elements, one per dtype, and every bucket is all-reduced
+    asynchronously.
+    """
+
+    def __init__(
+        self,
+        module,
+        auto_allreduce=False,
+        need_sync=True,
+        bucket_size=2 ** 24,
+        **kwargs
+    ):
+        assert not auto_allreduce, "Automatic all-reduce is not implemented yet"
+
+        super().__init__()
+        self.module = module
+        self.bucket_size = bucket_size
+
+        self.comms = dict()
+        for k in kwargs:
+            if k.endswith("_group"):
+                self.comms[k[:-6]] = kwargs[k]
+        for k in ["dp", "gate", "moe", "world"]:
+            if k not in self.comms:
+                self.comms[k] = get_torch_default_comm()
+
+        for name, m in module.named_modules():
+            experts = getattr(m, "experts", None)
+            if getattr(m, "world_size", None) == 1 and isinstance(experts, nn.Module):
+                assert all(getattr(p, "dp_comm", "dp") != "none"
+                        for p in experts.parameters()), \
+                        "the experts of {} are replicated on every worker but " \
+                        "never synchronized, tag them with set_expert_dp_comm".format(
+                                name or "the model")
+
+        if need_sync:
+            self._sync_params()
+
+    def _buckets(self, tensors_of):
+        r"""
+        Group the parameters by `dp_comm` and dtype, and split every group
+        into buckets of at most `bucket_size` elements. `tensors_of` returns
+        the tensor of a parameter to be communicated, or None to skip it.
+        """
+        groups = dict()
+        for p in self.module.parameters():
+            t = tensors_of(p)
+            if t is None:
+                continue
+            dp_comm = getattr(p, "dp_comm", "dp")
+            if dp_comm not in self.comms:
+                continue
+            groups.setdefault((dp_comm, t.dtype), []).append(t)
+
+        buckets = []
+        for (dp_comm, _), tensors in groups.items():
+            bucket, numel = [], 0
+            for t in tensors:
+                if bucket and numel + t.numel() > self.bucket_size:
+                    buckets.append((self.comms[dp_comm], bucket))
+                    bucket, numel = [], 0
+                bucket.append(t)
+                numel += t.numel()
+            if bucket:
+                buckets.append((self.comms[dp_comm], bucket))
+        return buckets
+
+    def allreduce_params(self, no_scale=False, reduce_after=False,
+            fp32_allreduce=False):
+        r"""
+        All-reduce the gradients of every `dp_comm` region in its process
+        group, and average them unless `no_scale` is set.
+        """
+        def grad_of(p):
+            if not p.requires_grad or p.grad is None:
+                return None
+            return p.grad.data
+
+        pending = []
+        for comm, grads in self._buckets(grad_of):
+            coalesced = _flatten_dense_tensors(grads)
+            if fp32_allreduce and coalesced.dtype != torch.float32:
+                coalesced = coalesced.float()
+            if not no_scale and not reduce_after:
+                coalesced /= comm.size()
+            work = dist.all_reduce(coalesced, group=comm, async_op=True)
+            pending.append((work, comm, coalesced, grads))
+
+        for work, comm, coalesced, grads in pending:
+            work.wait()
+            if not no_scale and reduce_after:
+                coalesced /= comm.size()
+            synced = _unflatten_dense_tensors(coalesced, grads)
+            for g, s in zip(grads, synced):
+                g.copy_(s)
+
+    def _sync_params(self):
+        r"""
+        Broadcast the parameters of every `dp_comm` region from the first
+        worker of its process group.
+        """
+        pending = []
+        for comm, datas in self._buckets(lambda p: p.data):
+            coalesced = _flatten_dense_tensors(datas)
+            work = dist.broadcast(coalesced, dist.get_global_rank(comm, 0),
+                    group=comm, async_op=True)
+            pending.append((work, coalesced, datas))
+
+        for work, coalesced, datas in pending:
+            work.wait()
+            synced = _unflatten_dense_tensors(coalesced, datas)
+            for d, s in zip(datas, synced):
+                d.copy_(s)
+
+    def forward(self, *args, **kwargs):
+        r"""
+        Directly call the module's forward function.
+        """
+        return self.module(*args, **kwargs)
@@ -16,8 +16,8 @@ from data_utils import get_lm_corpus
 from mem_transformer import MemTransformerLM
 from utils.exp_utils import create_exp_dir
 from utils.data_parallel import BalancedDataParallel
-from fmoe.gates.base_gate import BaseGate
-from custom_gate import CustomNaiveGate_Balance
+from gates.base_gate import BaseGate
+from routing_trace import RoutingTraceRecorder
 from latest_utils import *
 
 import warnings 
@@ -42,6 +42,9 @@ parser.add_argument('--d_model', type=int, default=500,
 parser.add_argument('--d_inner', type=int, default=1000,
                     help='inner dimension in FF')
 parser.add_argument('--load_balance', type=float, default=0)
+parser.add_argument('--load_balance_all_gates', action='store_true',
+                    help='also add the load-balance losses of the XMoE and '
+                    'StableMoE gates, not only of CustomNaiveGate_Balance')
 parser.add_argument('--dropout', type=float, default=0.0,
                     help='global dropout rate')
 parser.add_argument('--dropatt', type=float, default=0.0,
@@ -177,9 +180,9 @@ parser.add_argument('--moe-top-k-min', type=int, default=2)
 parser.add_argument('--moe-top-k-max', type=int, default=16)
 
 ## Dense to Sparse
-parser.add_argument('--min_temp', type=int, default=0.3)
-parser.add_argument('--max_temp', type=int, default=2)
-parser.add_argument('--threshold', type=int, default=0.001)
+parser.add_argument('--min_temp', type=float, default=0.3)
+parser.add_argument('--max_temp', type=float, default=2)
+parser.add_argument('--threshold', type=float, default=0.001)
 ## Dense Dropout
 parser.add_argument('--dense_drop', action='store_true')
 parser.add_argument('--expert_drop', type=float, default=0.5)
@@ -190,6 +193,11 @@ parser.add_argument('--swad_start', type=int, default=0)
 parser.add_argument('--swad_end', type=int, default=400000)
 ## Dynamic Routing
 parser.add_argument('--dynamic_router_start', type=int, default=-1)
+## Routing Trace
+parser.add_argument('--routing_trace', type=str, default=None,
+                    help='directory of the routing traces of the test set')
+parser.add_argument('--trace_chunk_steps', type=int, default=256,
+                    help='steps per compressed chunk of the routing traces')
 
 args = parser.parse_args()
 args.tied = not args.not_tied
@@ -322,6 +330,8 @@ else:
 if args.restart:
     with open(os.path.join(args.restart_dir, 'model.pt'), 'rb') as f:
         model = torch.load(f)
+    # the gates are indexed on the model, not in the replicas of DataParallel
+    model.index_moe_gates()
     if not args.fp16:
         model = model.float()
     model.apply(update_dropout)
@@ -341,6 +351,8 @@ else:
 args.n_all_param = sum([p.nelement() for p in model.parameters()])
 args.n_nonemb_param = sum([p.nelement() for p in model.layers.parameters()])
 
+model.aux_loss_all_gates = args.load_balance_all_gates
+
 # for Dense to Sparse Method
 set_threshold(model, args)
 freeze_part_weight(model, args)
@@ -462,7 +474,7 @@ print('#non emb params = {}'.format(args.n_nonemb_param))
 # Training code
 ###############################################################################
 
-def evaluate(model, eval_iter):
+def evaluate(model, eval_iter, recorder=None):
     # Turn on evaluation mode which disables dropout.
     model.eval()
 
@@ -484,6 +496,8 @@ def evaluate(model, eval_iter):
                 break
             ret = model(data, target, *mems)
             loss, mems = ret[0], ret[1:]
+            if recorder is not None:
+                recorder.step()
             loss = loss.mean()
             total_loss += seq_len * loss.float().item()
             total_len += seq_len
@@ -532,16 +546,16 @@ def train():
                     loss.backward()
                 train_loss += loss.float().item()
         else:
-            ret = para_model(data, target, *mems)
+            # the balance loss comes back with the output, so that it is kept
+            # from the replicas of nn.DataParallel
+            ret = para_model(data, target, *mems,
+                             return_aux_loss=args.load_balance > 0)
             loss, mems = ret[0], ret[1:]
             loss = loss.float().mean().type_as(loss)
 
             if args.load_balance > 0:
-                balance_loss = 0
-                for name, m in model.named_modules():
-                    if isinstance(m, CustomNaiveGate_Balance):
-                        balance_loss += m.loss
-                loss += args.load_balance * balance_loss
+                aux_loss, mems = mems[-1], mems[:-1]
+                loss += args.load_balance * aux_loss.float().mean().type_as(loss)
 
             if args.fp16:
                 optimizer.backward(loss)
@@ -715,7 +729,15 @@ para_model = model.to(device)
 for gate_number in [1,2,4,8,16,32,64]:
     if gate_number <= args.moe_num_expert:
         set_top_k(model, gate_number)
-        test_loss = evaluate(model, te_iter)
+        recorder = None
+        if args.routing_trace is not None:
+            recorder = RoutingTraceRecorder(os.path.join(args.routing_trace,
+                'top-{}'.format(gate_number)), chunk_steps=args.trace_chunk_steps)
+            set_routing_trace(model, recorder)
+        test_loss = evaluate(model, te_iter, recorder)
+        if recorder is not None:
+            set_routing_trace(model, None)
+            recorder.close()
         print('=' * 100)
         if args.dataset in ['enwik8', 'text8']:
             print('Dense | End of training | Gate-Number {:.0f} | test loss {:5.2f} | test bpc {:9.3f}'.format(
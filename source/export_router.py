@@ -0,0 +1,120 @@
+r"""
+Fold the HyperNet gates of a trained model into plain linear gates.
+
+A frozen hypernetwork and a trained embedding only ever produce one router
+weight. Every `CustomNaiveGate_HyperNet` is evaluated once and replaced by a
+`CustomNaiveGate` holding the generated weight, and the router generator of
+`--hyper-batch` is dropped. The routing of the folded model is checked
+against the original one on a sample batch before the slimmer model is saved.
+
+Usage (from `source/`):
+    python export_router.py --work_dir <dir of model.pt> --cuda
+"""
+import argparse
+import io
+import os
+
+import torch
+
+from custom_gate import CustomNaiveGate, CustomNaiveGate_HyperNet
+
+parser = argparse.ArgumentParser(description='HyperNet router export')
+parser.add_argument('--work_dir', type=str, required=True,
+                    help='directory of the trained model.pt')
+parser.add_argument('--output', type=str, default='model-folded.pt',
+                    help='file name of the folded model, in work_dir')
+parser.add_argument('--batch_size', type=int, default=8,
+                    help='batch size of the sample batch')
+parser.add_argument('--tgt_len', type=int, default=128,
+                    help='length of the sample batch')
+parser.add_argument('--seed', type=int, default=1111)
+parser.add_argument('--atol', type=float, default=1e-5,
+                    help='tolerance of the gate scores')
+parser.add_argument('--cuda', action='store_true')
+
+def fold_hypernet_gates(model):
+    r"""
+    Replace every HyperNet gate of `model` by an equivalent `CustomNaiveGate`,
+    and return the names of the replaced gates.
+    """
+    modules = dict(model.named_modules())
+    names = [name for name, m in modules.items()
+            if isinstance(m, CustomNaiveGate_HyperNet)]
+    generator = getattr(model, 'router_generator', None)
+    generated_weights = None if generator is None else generator.router_weights()
+    for name in names:
+        gate = modules[name]
+        folded = CustomNaiveGate(gate.d_model, gate.num_expert, gate.world_size,
+                gate.top_k).to(gate.bias.device)
+        with torch.no_grad():
+            folded.gate.weight.copy_(gate.router_weight(generated_weights))
+            folded.gate.bias.copy_(gate.bias)
+        folded.dense_moe_flag = gate.dense_moe_flag
+        folded.fused_count = gate.fused_count
+        folded.train(gate.training)
+        parent, attr = name.rsplit('.', 1)
+        setattr(modules[parent], attr, folded)
+    if hasattr(model, 'router_generator'):
+        del model.router_generator
+    if hasattr(model, 'index_moe_gates'):
+        model.index_moe_gates()
+    return names
+
+def routing_of(model, names, data, target):
+    r"""
+    The indices and scores of the gates `names` of `model` on one batch.
+    """
+    routing = {}
+    modules = dict(model.named_modules())
+    handles = []
+    for name in names:
+        def hook(module, inp, out, name=name):
+            routing[name] = (out[0], out[1])
+        handles.append(modules[name].register_forward_hook(hook))
+    with torch.no_grad():
+        model(data, target)
+    for handle in handles:
+        handle.remove()
+    return routing
+
+def state_bytes(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+def main(args):
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    with open(os.path.join(args.work_dir, 'model.pt'), 'rb') as f:
+        model = torch.load(f, map_location=device)
+    model.eval()
+
+    torch.manual_seed(args.seed)
+    data = torch.randint(model.n_token, (args.tgt_len, args.batch_size),
+            device=device)
+    target = torch.randint(model.n_token, (args.tgt_len, args.batch_size),
+            device=device)
+
+    names = [name for name, m in model.named_modules()
+            if isinstance(m, CustomNaiveGate_HyperNet)]
+    assert len(names) > 0, 'the model has no CustomNaiveGate_HyperNet'
+    before_bytes = state_bytes(model)
+    before = routing_of(model, names, data, target)
+
+    fold_hypernet_gates(model)
+    after = routing_of(model, names, data, target)
+    for name in names:
+        idx, score = before[name]
+        folded_idx, folded_score = after[name]
+        assert torch.equal(idx, folded_idx), \
+                'routing of {} changed after folding'.format(name)
+        assert torch.allclose(score, folded_score, atol=args.atol), \
+                'gate scores of {} changed after folding'.format(name)
+        print('Layer name: {}, routing verified'.format(name))
+
+    with open(os.path.join(args.work_dir, args.output), 'wb') as f:
+        torch.save(model, f)
+    print('| folded {} gates | state {:.2f} MB -> {:.2f} MB'.format(len(names),
+        before_bytes / 2 ** 20, state_bytes(model) / 2 ** 20))
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -1,7 +1,17 @@
 import torch
 from torch.autograd import Function
-import fmoe_cuda
+from backends import fmoe_native
 from custom_utils import get_torch_default_comm
+from fastermoe.config import float_from_env
+
+try:
+    import torch.distributed._functional_collectives as _funcol
+    _funcol_all_gather = getattr(_funcol, 'all_gather_single', None) \
+            or _funcol.all_gather_tensor
+except (ImportError, AttributeError):
+    _funcol_all_gather = None
+_dist_all_gather = getattr(torch.distributed, 'all_gather_single', None) \
+        or getattr(torch.distributed, 'all_gather_into_tensor', None)
 
 _moe_group = None
 
@@ -10,21 +20,52 @@ def ensure_comm(t, comm):
         comm = get_torch_default_comm()
     global _moe_group
     _moe_group = comm
-    fmoe_cuda.ensure_nccl(comm, t)
+    fmoe_native.ensure_nccl(comm, t)
 
 def get_moe_group():
     return _moe_group
 
-def count_by_gate(gate, num_expert, world_size, require_pos=True):
+_host_sync_count = 0
+
+def record_host_sync(tensor, n=1):
+    r"""
+    Record `n` device-to-host synchronization points (`.item()`, `.cpu()`) of
+    `tensor` in the MoE dispatch path. Tensors already on the CPU are not
+    counted.
+    """
+    global _host_sync_count
+    if tensor.device.type != 'cpu':
+        _host_sync_count += n
+
+def get_host_sync_count(reset=False):
+    global _host_sync_count
+    count = _host_sync_count
+    if reset:
+        _host_sync_count = 0
+    return count
+
+def count_by_gate(gate, num_expert, world_size, require_pos=True,
+        pos_size=None, expert_count=None):
+    r"""
+    Count the samples routed to each expert and compute their positions.
+    If `pos_size` is given, `pos` is allocated with that size instead of
+    reading the number of valid samples back to the host. The valid positions
+    come first and the tail is left uninitialized.
+    If `expert_count` is given, e.g. by a gate that counts its samples while
+    routing them, it is used instead of counting the samples again.
+    """
     with torch.no_grad():
-        local_expert_count = torch.zeros(
-            num_expert * world_size, device=gate.device, dtype=torch.int32
-        )
-        fmoe_cuda.expert_count(gate, local_expert_count)
+        if expert_count is None:
+            local_expert_count = torch.zeros(
+                num_expert * world_size, device=gate.device, dtype=torch.int32
+            )
+            fmoe_native.expert_count(gate, local_expert_count)
+        else:
+            local_expert_count = expert_count
         local_expert_count = local_expert_count.long()
 
         if world_size > 1:
-            global_expert_count = fmoe_cuda.expert_exchange(
+            global_expert_count = fmoe_native.expert_exchange(
                 local_expert_count, num_expert, world_size
             )
         else:
@@ -33,12 +74,15 @@ def count_by_gate(gate, num_expert, world_size, require_pos=True):
             pos = None
         else:
             lec_cum = torch.cumsum(local_expert_count, dim=0).int()
-            pos_size = lec_cum[-1].item()
+            if pos_size is None:
+                pos_size = lec_cum[-1].item()
+                record_host_sync(lec_cum)
             pos = torch.empty((pos_size,), device=gate.device, dtype=torch.long)
-            fmoe_cuda.assign_pos(lec_cum, gate, pos)
+            fmoe_native.assign_pos(lec_cum, gate, pos)
     return pos, local_expert_count, global_expert_count
 
-def prepare_forward(gate, num_expert, world_size):
+def prepare_forward(gate, num_expert, world_size, sync_free=False,
+        expert_count=None):
     r"""
     Prepare necessary information from gate output for MoE computation.
 
@@ -47,14 +91,22 @@ def prepare_forward(gate, num_expert, world_size):
         sample.
         num_expert: number of experts on each worker.
         world_size: number of workers that hold different experts.
-        comm: the communicator of all workers in the expert-parallel group.
+        sync_free: size `pos` from the static upper bound `gate.numel()` and
+        keep the counts on the device until they are copied to the host in a
+        single transfer, which the grouped expert GEMM and the feature
+        exchange need anyway.
+        expert_count: the number of samples of each expert, if already known.
     """
+    if sync_free:
+        return _prepare_forward_sync_free(gate, num_expert, world_size,
+                expert_count=expert_count)
     pos, local_expert_count, global_expert_count = count_by_gate(gate, 
-            num_expert, world_size)
+            num_expert, world_size, expert_count=expert_count)
     with torch.no_grad():
         fwd_expert_count = global_expert_count.view(world_size,
                 num_expert).sum(dim=0)
         fwd_batch_size = int(fwd_expert_count.sum().item())
+    record_host_sync(global_expert_count, 4)
     return (
         pos,
         local_expert_count.cpu(),
@@ -63,6 +115,30 @@ def prepare_forward(gate, num_expert, world_size):
         fwd_batch_size,
     )
 
+def _prepare_forward_sync_free(gate, num_expert, world_size,
+        expert_count=None):
+    pos, local_expert_count, global_expert_count = count_by_gate(gate,
+            num_expert, world_size, pos_size=gate.numel(),
+            expert_count=expert_count)
+    with torch.no_grad():
+        fwd_expert_count = global_expert_count.view(world_size,
+                num_expert).sum(dim=0)
+        counts = torch.cat((local_expert_count, global_expert_count,
+            fwd_expert_count)).cpu()
+        record_host_sync(global_expert_count)
+        local_expert_count, global_expert_count, fwd_expert_count = \
+                counts.split([num_expert * world_size,
+                    num_expert * world_size, num_expert])
+        pos = pos[:int(local_expert_count.sum())]
+        fwd_batch_size = int(fwd_expert_count.sum())
+    return (
+        pos,
+        local_expert_count,
+        global_expert_count,
+        fwd_expert_count,
+        fwd_batch_size,
+    )
+
 def _local_scatter(inp, pos):
     inp_buf = torch.index_select(inp, 0, pos)
     return inp_buf
@@ -95,7 +171,7 @@ class MOEScatter(Function):
     ):
         local_input_buf = _local_scatter(inp, pos)
         if world_size > 1:
-            global_input_buf = fmoe_cuda.global_scatter(
+            global_input_buf = fmoe_native.global_scatter(
                 local_input_buf,
                 local_expert_count,
                 global_expert_count,
@@ -115,7 +191,7 @@ class MOEScatter(Function):
         (inp_batch_size, buf_batch_size, world_size) = ctx.moe_args
 
         if world_size > 1:
-            local_grad_in = fmoe_cuda.global_gather(
+            local_grad_in = fmoe_native.global_gather(
                 global_grad_in,
                 local_expert_count,
                 global_expert_count,
@@ -144,7 +220,7 @@ class MOEGather(Function):
         world_size,
     ):
         if world_size > 1:
-            local_output_buf = fmoe_cuda.global_gather(
+            local_output_buf = fmoe_native.global_gather(
                 global_output_buf,
                 local_expert_count,
                 global_expert_count,
@@ -167,7 +243,7 @@ class MOEGather(Function):
         fwd_batch_size, world_size = ctx.moe_args
         grad_out_buf = _local_scatter(grad_out.contiguous(), pos)
         if world_size > 1:
-            global_grad_out_buf = fmoe_cuda.global_scatter(
+            global_grad_out_buf = fmoe_native.global_scatter(
                 grad_out_buf,
                 local_expert_count,
                 global_expert_count,
@@ -178,17 +254,136 @@ class MOEGather(Function):
             global_grad_out_buf = grad_out_buf
         return global_grad_out_buf, None, None, None, None, None
 
+# rows of the expert output scaled at once in the combine
+fmoe_combine_chunk = int(float_from_env('FMOE_COMBINE_CHUNK', 8192))
+
+def _scaled_index_add(output, token_pos, buf, score, inplace=False):
+    r"""
+    Add every row of `buf`, scaled by `score`, to the row `token_pos` of
+    `output`. `buf` is scaled in place if `inplace`, otherwise by chunks of
+    `FMOE_COMBINE_CHUNK` rows into one reused buffer.
+    """
+    if inplace:
+        output.index_add_(0, token_pos, buf.mul_(score.unsqueeze(1)))
+        return
+    tmp = buf.new_empty(min(fmoe_combine_chunk, buf.shape[0]), buf.shape[1])
+    for start in range(0, buf.shape[0], fmoe_combine_chunk):
+        rows = buf[start:start + fmoe_combine_chunk]
+        scaled = tmp[:rows.shape[0]]
+        torch.mul(rows, score[start:start + fmoe_combine_chunk].unsqueeze(1),
+                out=scaled)
+        output.index_add_(0, token_pos[start:start + fmoe_combine_chunk],
+                scaled)
+
+class MOEGatherCombine(Function):
+    r"""
+    Gather output samples from the experts and combine them with the gate
+    scores in one step. Each row of the expert output is scaled by its gate
+    score and added to the row of its token, so that the `(N * top_k, d)`
+    buffer built by MOEGather is never materialized: the rows are scaled in
+    the buffer received from the other workers, or by chunks.
+    * `gate_score` is the flattened score of every (token, expert) pair.
+    * `token_pos` is the token of every entry of `pos`.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        global_output_buf,
+        gate_score,
+        pos,
+        token_pos,
+        local_expert_count,
+        global_expert_count,
+        local_batch_size,
+        world_size,
+    ):
+        if world_size > 1:
+            local_output_buf = fmoe_native.global_gather(
+                global_output_buf,
+                local_expert_count,
+                global_expert_count,
+                pos.shape[0],
+                world_size,
+            )
+        else:
+            local_output_buf = global_output_buf
+        score = gate_score[pos].to(local_output_buf.dtype)
+        output = torch.zeros(local_batch_size, local_output_buf.shape[-1],
+                dtype=local_output_buf.dtype, device=local_output_buf.device)
+        need_score_grad = ctx.needs_input_grad[1]
+        # the gathered buffer is only ours with several workers, and the
+        # gradient of the scores needs it unscaled
+        _scaled_index_add(output, token_pos, local_output_buf, score,
+                inplace=world_size > 1 and not need_score_grad)
+
+        ctx.moe_args = (global_output_buf.shape[0], gate_score.shape[0],
+                gate_score.dtype, world_size)
+        ctx.save_for_backward(
+            pos if need_score_grad else None,
+            token_pos,
+            local_expert_count if world_size > 1 else None,
+            global_expert_count if world_size > 1 else None,
+            score,
+            local_output_buf if need_score_grad else None,
+        )
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        (pos, token_pos, local_expert_count, global_expert_count, score,
+                local_output_buf) = ctx.saved_tensors
+        fwd_batch_size, num_score, score_dtype, world_size = ctx.moe_args
+        grad_out_buf = _local_scatter(grad_out.contiguous(), token_pos)
+        grad_score = None
+        if ctx.needs_input_grad[1]:
+            grad_score_buf = (grad_out_buf * local_output_buf).sum(dim=-1)
+            grad_score = torch.zeros(num_score, dtype=score_dtype,
+                    device=grad_score_buf.device)
+            grad_score.index_copy_(0, pos, grad_score_buf.to(score_dtype))
+        grad_out_buf.mul_(score.unsqueeze(1))
+        if world_size > 1:
+            global_grad_out_buf = fmoe_native.global_scatter(
+                grad_out_buf,
+                local_expert_count,
+                global_expert_count,
+                fwd_batch_size,
+                world_size,
+            )
+        else:
+            global_grad_out_buf = grad_out_buf
+        return (global_grad_out_buf, grad_score, None, None, None, None, None,
+                None)
+
+def _all_gather(inp, world_size, group):
+    r"""
+    Issue the all-gather of `inp` along the first dimension into a single
+    tensor, and return it with the work of the collective. With the
+    functional collectives, the work is None and the result waits for the
+    collective at its first use. Otherwise, the work is to be waited for
+    before the result is used.
+    """
+    inp = inp.contiguous()
+    if _funcol_all_gather is not None:
+        return _funcol_all_gather(inp, 0, group), None
+    output = inp.new_empty((world_size * inp.shape[0],) + tuple(inp.shape[1:]))
+    work = _dist_all_gather(output, inp, group=group, async_op=True)
+    return output, work
+
 class AllGather(Function):
     r"""
     A wrapper for the All-Gather function to support auto-differentiation.
+    With the functional collectives, the output is returned before the
+    all-gather completes, so that it can overlap with the following
+    computation until the output is used.
     """
 
     @staticmethod
     def forward(ctx, inp, rank, world_size, group):
-        tensor_list = [torch.empty_like(inp) for _ in range(world_size)]
-        torch.distributed.all_gather(tensor_list, inp, group=group)
-        torch.cuda.synchronize()
-        output = torch.cat(tensor_list, dim=0)
+        output, work = _all_gather(inp, world_size, group)
+        if work is not None:
+            # the output is used as soon as it is returned
+            work.wait()
         ctx.args = rank, inp.shape[0]
         return output
 
@@ -199,7 +394,8 @@ class AllGather(Function):
 
 class Slice(Function):
     r"""
-    A wrapper for the Slice function to support auto-differentiation.
+    A wrapper for the Slice function to support auto-differentiation. The
+    gradient is all-gathered as `AllGather` gathers its output.
     """
 
     @staticmethod
@@ -215,8 +411,7 @@ class Slice(Function):
     @staticmethod
     def backward(ctx, grad_out):
         world_size, group = ctx.args
-        tensor_list = [torch.empty_like(grad_out) for _ in range(world_size)]
-        torch.distributed.all_gather(tensor_list, grad_out, group=group)
-        torch.cuda.synchronize()
-        grad_out = torch.cat(tensor_list, dim=0)
-        return grad_out, None, None, None
\ No newline at end of file
+        grad_out, work = _all_gather(grad_out, world_size, group)
+        if work is not None:
+            work.wait()
+        return grad_out, None, None, None
@@ -5,12 +5,21 @@ from .naive_gate import NaiveGate
 from .utils import limit_by_capacity
 
 class GShardGate(NaiveGate):
+    r"""
+    The GShard gate. The samples exceeding the capacity of an expert are
+    dropped in order of appearance, or with the lowest scores first if
+    `capacity_policy` is `score`.
+    """
+
     def __init__(self, d_model, num_expert, world_size,
-            topk=2, capacity=(1.2, 2.4), random_routing=True):
+            topk=2, capacity=(1.2, 2.4), random_routing=True,
+            capacity_policy='first'):
         assert topk == 2, 'topk should be 2 in gshard'
+        assert capacity_policy in ['first', 'score']
         super().__init__(d_model, num_expert, world_size, top_k=2)
         self.capacity = capacity
         self.random_routing = random_routing
+        self.capacity_policy = capacity_policy
 
     def forward(self, x):
         naive_outs = super().forward(x, return_all_scores=True)
@@ -31,8 +40,10 @@ class GShardGate(NaiveGate):
 
         cap_rate = self.capacity[0 if self.training else 1]
         capacity = math.ceil(cap_rate * x.shape[0])
+        priority = topk_val if self.capacity_policy == 'score' else None
         _new_lec, _new_gec, topk_idx = limit_by_capacity(
-                topk_idx, self.num_expert, self.world_size, capacity)
+                topk_idx, self.num_expert, self.world_size, capacity,
+                priority=priority)
 
         if self.random_routing:
             rand_routing_prob = torch.rand(gate_score.size(0), device=x.device)
@@ -5,8 +5,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from .naive_gate import NaiveGate
 
-from fmoe.functions import count_by_gate
-import fmoe_cuda as fmoe_native
+from functions import count_by_gate
+from backends import fmoe_native
 
 class SwipeGate(NaiveGate):
     def __init__(self, d_model, num_expert, world_size, top_k=2):
@@ -7,15 +7,19 @@ from .utils import limit_by_capacity
 
 class SwitchGate(NaiveGate):
     r"""
-    A switch gate implementation
+    A switch gate implementation. The samples exceeding the capacity of an
+    expert are dropped in order of appearance, or with the lowest scores first
+    if `capacity_policy` is `score`.
     """
 
     def __init__(self, d_model, num_expert, world_size, topk=1,
-            switch_eps=.1, capacity=(1.2, 2.4)):
+            switch_eps=.1, capacity=(1.2, 2.4), capacity_policy='first'):
         assert topk == 1, 'topk should be 1 in switch'
+        assert capacity_policy in ['first', 'score']
         super().__init__(d_model, num_expert, world_size, top_k=1)
         self.switch_eps = switch_eps
         self.capacity = capacity
+        self.capacity_policy = capacity_policy
 
     def forward(self, inp):
         r"""
@@ -39,8 +43,10 @@ class SwitchGate(NaiveGate):
 
         cap_rate = self.capacity[0 if self.training else 1]
         capacity = math.ceil(cap_rate * inp.shape[0])
+        priority = top1_score if self.capacity_policy == 'score' else None
         _new_lec, _new_gec, top1_idx = limit_by_capacity(
-                top1_idx, self.num_expert, self.world_size, capacity)
+                top1_idx, self.num_expert, self.world_size, capacity,
+                priority=priority)
 
         valid_idx = top1_idx[top1_idx > -1]
         fraction_expert = torch.scatter_add(
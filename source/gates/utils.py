@@ -1,9 +1,22 @@
 import torch
-from fmoe.functions import count_by_gate
-import fmoe_cuda as fmoe_native
+from functions import count_by_gate
+from backends import fmoe_native
+from backends.torch_backend import prune_by_capacity
 
-def limit_by_capacity(topk_idx, num_expert, world_size, capacity):
+def limit_by_capacity(topk_idx, num_expert, world_size, capacity,
+        priority=None):
+    r"""
+    Drop the samples exceeding the capacity of their expert, see
+    `prune_by_capacity` of the torch backend. With a single worker, it only
+    uses plain tensor operations. Otherwise, the capacity of every expert is shared by the
+    workers, in the order of their ranks, with the native kernels.
+    """
     with torch.no_grad():
+        if world_size == 1:
+            topk_idx, new_lec = prune_by_capacity(topk_idx, capacity,
+                    num_expert, priority=priority)
+            return new_lec, new_lec, topk_idx
+
         capacity = torch.ones(num_expert, dtype=torch.int32,
                 device=topk_idx.device) * capacity
 
@@ -11,12 +24,12 @@ def limit_by_capacity(topk_idx, num_expert, world_size, capacity):
                 require_pos=False)
         new_gec = fmoe_native.limit_by_capacity(gec, capacity,
                 num_expert, world_size)
-        if world_size > 1:
-            new_lec = fmoe_native.expert_exchange(new_gec, num_expert,
-                    world_size)
-        else:
-            new_lec = new_gec
+        new_lec = fmoe_native.expert_exchange(new_gec, num_expert, world_size)
 
-        topk_idx = fmoe_native.prune_gate_by_capacity(topk_idx,
-                new_lec.to(torch.int32), num_expert, world_size)
-    return new_lec, new_gec, topk_idx
\ No newline at end of file
+        if priority is None:
+            topk_idx = fmoe_native.prune_gate_by_capacity(topk_idx,
+                    new_lec.to(torch.int32), num_expert, world_size)
+        else:
+            topk_idx, _ = prune_by_capacity(topk_idx, new_lec,
+                    num_expert * world_size, priority=priority)
+    return new_lec, new_gec, topk_idx
@@ -2,15 +2,24 @@ import copy
 import torch
 import numpy as np
 import torch.nn as nn 
-from fmoe.gates.base_gate import BaseGate
-from custom_gate import CustomNaiveGate_Attn
+from gates.base_gate import BaseGate
+from custom_gate import CustomNaiveGate_Attn, CustomBaseGate
+from custom_gate import CustomNaiveGate_HyperNet, HyperRouterGenerator, CustomDTSGate
+from custom_layers import FMoE, SharedRouting, fmoe_faster_schedule
+from custom_transformer import _Expert
+from routing_telemetry import RoutingTelemetry
+from routing_trace import _TraceHook
 
 import pdb
 import torch.nn.functional as F
 
 __all__ = ['set_top_k', 'set_router_mode', 'freeze_part_weight', 'adjust_moe_gate_number',
             'show_dts_gate_number', 'set_temperature', 'set_threshold', 
-            'SWA_Average', 'collect_top_k', 'THOR_Model']
+            'SWA_Average', 'collect_top_k', 'THOR_Model', 'set_sync_free',
+            'set_dispatch_mode', 'set_expert_checkpoint', 'measure_expert_memory',
+            'set_fused_count', 'set_count_non_finite', 'collect_non_finite_count',
+            'set_router_generator', 'set_routing_telemetry', 'set_routing_trace',
+            'set_shared_routing', 'set_expert_dp_comm']
 
 def set_top_k(model, num=2):
     for name, m in model.named_modules():
@@ -20,6 +29,206 @@ def set_top_k(model, num=2):
                 m.gate.top_k = num
                 print('Layer name: {}, Top-K = {}, {}'.format(name, m.top_k, m.gate.top_k))
 
+def set_expert_dp_comm(model, comm='dp'):
+    r"""
+    Tag the experts of the MoE layers of `model` that every worker holds in
+    full, i.e. with `world_size` 1, with the data parallel comm `comm`, so
+    that `DistributedGroupedDataParallel` reduces their gradients. The experts
+    sharded over the workers keep their own tag.
+    """
+    for name, m in model.named_modules():
+        if isinstance(m, FMoE) and m.world_size == 1:
+            m.mark_parallel_comm(comm)
+            print('Layer name: {}, Expert DP Comm = {}'.format(name, comm))
+
+def set_sync_free(model, flag=True):
+    for name, m in model.named_modules():
+        if isinstance(m, FMoE):
+            m.sync_free = flag
+            print('Layer name: {}, Sync-Free Dispatch = {}'.format(name, m.sync_free))
+
+def set_dispatch_mode(model, mode='sparse', capacity_factor=None):
+    for name, m in model.named_modules():
+        if isinstance(m, FMoE):
+            m.dispatch_mode = mode
+            if capacity_factor is not None:
+                m.capacity_factor = capacity_factor
+            print('Layer name: {}, Dispatch Mode = {}, Capacity Factor = {}'.format(
+                name, m.dispatch_mode, m.capacity_factor))
+
+def set_fused_count(model, flag=True):
+    for name, m in model.named_modules():
+        if isinstance(m, CustomBaseGate):
+            m.fused_count = flag
+            print('Layer name: {}, Fused Expert Count = {}'.format(name, m.fused_count))
+
+def set_count_non_finite(model, flag=True):
+    for name, m in model.named_modules():
+        if isinstance(m, CustomBaseGate):
+            m.count_non_finite = flag
+            m.non_finite_count = None
+            print('Layer name: {}, Count Non-Finite Scores = {}'.format(name, m.count_non_finite))
+
+def collect_non_finite_count(model, reset=True):
+    r"""
+    Total number of non-finite gate scores counted since the last reset, read
+    back to the host in a single transfer.
+    """
+    counts = []
+    for m in model.modules():
+        if isinstance(m, CustomBaseGate) and m.non_finite_count is not None:
+            counts.append(m.non_finite_count)
+            if reset:
+                m.non_finite_count = None
+    if len(counts) == 0:
+        return 0
+    return int(torch.stack(counts).sum())
+
+def set_router_generator(model, rank=None):
+    r"""
+    Generate the router weights of all the HyperNet gates of `model` with one
+    `HyperRouterGenerator`, registered as `model.router_generator`. `rank`
+    selects its low-rank output head.
+    """
+    gates = [m for m in model.modules() if isinstance(m, CustomNaiveGate_HyperNet)
+            and m.router_index is None]
+    if len(gates) == 0:
+        return None
+    model.router_generator = HyperRouterGenerator.from_gates(gates, rank=rank)
+    print('Router generator: {} layers, rank = {}, {} parameters'.format(
+        len(gates), rank, sum(p.numel() for p in model.router_generator.parameters())))
+    return model.router_generator
+
+def set_routing_telemetry(model, training_only=True):
+    r"""
+    Attach one `RoutingTelemetry` as the `gate_hook` of every MoE layer of
+    `model`, and return it.
+    """
+    telemetry = RoutingTelemetry(training_only=training_only)
+    for name, m in model.named_modules():
+        if isinstance(m, FMoE):
+            m.gate_hook = telemetry.hook(name, m.num_expert * m.world_size)
+            print('Layer name: {}, Routing Telemetry = True'.format(name))
+    return telemetry
+
+def set_routing_trace(model, recorder):
+    r"""
+    Record the routing of every MoE layer of `model` with the
+    `RoutingTraceRecorder` `recorder`, after their current `gate_hook`, or
+    detach the previous recorder if `recorder` is None.
+    """
+    for name, m in model.named_modules():
+        if isinstance(m, FMoE):
+            hook = m.gate_hook
+            if isinstance(hook, _TraceHook):
+                hook = hook.prev
+            if recorder is not None:
+                hook = recorder.hook(name, m.num_expert * m.world_size, prev=hook)
+            m.gate_hook = hook
+
+def set_shared_routing(model, group_size=2):
+    r"""
+    Split the MoE layers of `model`, in order, into groups of `group_size`
+    consecutive layers that share the routing of the first layer of the group.
+    The gates of the other layers are no longer run, and are frozen.
+    `group_size` 1 gives every layer its own routing, and trainable gate, back.
+    """
+    layers = [(name, m) for name, m in model.named_modules() if isinstance(m, FMoE)]
+    for i, (name, m) in enumerate(layers):
+        leader_name, leader = layers[i - i % group_size]
+        if getattr(m, 'routing_group_index', 0) > 0:
+            m.gate.requires_grad_(True)
+        m.routing_group_index = i % group_size if group_size > 1 else 0
+        if group_size > 1:
+            assert m.world_size == 1 or (m.pipeline_chunks <= 1
+                    and not fmoe_faster_schedule), \
+                    'the pipelined and the faster schedule dispatch cannot share a routing'
+        if group_size > 1 and m.routing_group_index == 0:
+            m.shared_routing = SharedRouting()
+        elif group_size > 1:
+            assert (m.num_expert, m.world_size) == (leader.num_expert, leader.world_size), \
+                    'layers sharing a routing must have the same experts'
+            m.shared_routing = leader.shared_routing
+            # no stale load-balance loss, nor gradient, from a gate that does not run
+            m.gate.loss = None
+            m.gate.requires_grad_(False)
+        else:
+            m.shared_routing = None
+        print('Layer name: {}, Routing from {}'.format(name, leader_name))
+
+def set_expert_checkpoint(model, flag=True):
+    for name, m in model.named_modules():
+        if isinstance(m, _Expert):
+            m.checkpoint = flag
+            print('Layer name: {}, Expert Checkpoint = {}'.format(name, m.checkpoint))
+
+def _expert_saved_bytes(model, inputs):
+    r"""
+    Bytes of the tensors saved for backward inside every `_Expert` during one
+    forward of `model`, parameters excluded. A checkpointed expert only keeps
+    its input.
+    """
+    param_ptrs = set(p.untyped_storage().data_ptr() for p in model.parameters())
+    saved = {}
+    current = []
+
+    def pre_hook(name):
+        def hook(module, args):
+            current.append(name)
+            saved.setdefault(name, {})
+            if module.checkpoint:
+                inp = args[0]
+                saved[name][inp.untyped_storage().data_ptr()] = \
+                        inp.untyped_storage().nbytes()
+        return hook
+
+    def post_hook(module, args, output):
+        current.pop()
+
+    def pack_hook(tensor):
+        if current:
+            ptr = tensor.untyped_storage().data_ptr()
+            if ptr not in param_ptrs:
+                saved[current[-1]][ptr] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    handles = []
+    for name, m in model.named_modules():
+        if isinstance(m, _Expert):
+            handles.append(m.register_forward_pre_hook(pre_hook(name)))
+            handles.append(m.register_forward_hook(post_hook))
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda t: t):
+            model(*inputs)
+    finally:
+        for h in handles:
+            h.remove()
+    return {name: sum(v.values()) for name, v in saved.items()}
+
+def measure_expert_memory(model, *inputs):
+    r"""
+    Run one forward of a copy of `model` on `inputs` with and without expert
+    checkpointing, and print for every MoE layer the activation memory kept by
+    its experts in both cases. The state of `model`, e.g. of its gates, and
+    the random generators are left as they were.
+    """
+    model = copy.deepcopy(model)
+    devices = [torch.cuda.current_device()] if torch.cuda.is_available() else []
+    with torch.random.fork_rng(devices=devices):
+        for m in model.modules():
+            if isinstance(m, _Expert):
+                m.checkpoint = False
+        full = _expert_saved_bytes(model, inputs)
+        for m in model.modules():
+            if isinstance(m, _Expert):
+                m.checkpoint = True
+        ckpt = _expert_saved_bytes(model, inputs)
+    for name in full:
+        print('Layer name: {}, Expert Activations = {:.2f} MB, Checkpointed = {:.2f} MB, '
+              'Saved = {:.2f} MB'.format(name, full[name] / 2 ** 20,
+                  ckpt.get(name, 0) / 2 ** 20, (full[name] - ckpt.get(name, 0)) / 2 ** 20))
+    return full, ckpt
+
 def collect_top_k(model):
     top_k = None
     for name, m in model.named_modules():
@@ -132,23 +341,23 @@ def adjust_moe_gate_number(model, steps, args, current_gate):
 ## Dense to Sparse
 def show_dts_gate_number(model):
     for name, m in model.named_modules():
-        if isinstance(m, BaseGate):
+        if isinstance(m, CustomDTSGate):
             mean_experts = m.sum_top_k / m.forward_n
             layer_temp = m.temperature
             layer_threshold = m.threshold
-            print('* Mean-Experts = {:.0f}, Temperature = {:.4f}, Threshold = {:.4f}'.format(mean_experts, layer_temp, layer_threshold))
+            print('* Mean-Experts = {:.2f}, Temperature = {:.4f}, Threshold = {:.4f}'.format(mean_experts, layer_temp, layer_threshold))
 
 def set_temperature(model, iterations, all_iteration, max_temp, min_temp):
     temp = max_temp + iterations * (min_temp - max_temp) / all_iteration
     for name, m in model.named_modules():
-        if isinstance(m, BaseGate):
+        if isinstance(m, CustomDTSGate):
             m.temperature = temp
 
 def set_threshold(model, args):
     if args.gate_name == 'CustomDTSGate':
         print('* Set threshold for DTS Gate')
         for name, m in model.named_modules():
-            if isinstance(m, BaseGate):
+            if isinstance(m, CustomDTSGate):
                 m.threshold = args.threshold
 
 ## Weight Average
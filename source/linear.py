@@ -3,7 +3,7 @@ import torch.nn as nn
 from torch.autograd import Function
 import math
 
-import fmoe_cuda
+from backends import fmoe_native
 
 class MOELinear(Function):
     r"""
@@ -12,7 +12,7 @@ class MOELinear(Function):
 
     @staticmethod
     def forward(ctx, global_input_buf, fwd_expert_count, weight, bias=None):
-        global_output_buf = fmoe_cuda.linear_forward(
+        global_output_buf = fmoe_native.linear_forward(
             global_input_buf, fwd_expert_count, weight, bias
         )
         variables = (global_input_buf, fwd_expert_count, weight, bias)
@@ -22,7 +22,7 @@ class MOELinear(Function):
     @staticmethod
     def backward(ctx, grad_out):
         (input_buf, fwd_expert_count, weight, bias) = ctx.saved_tensors
-        grad_inp_buf, grad_weight, grad_bias = fmoe_cuda.linear_backward(
+        grad_inp_buf, grad_weight, grad_bias = fmoe_native.linear_backward(
             grad_out, input_buf, fwd_expert_count, weight, bias
         )
 
@@ -67,6 +67,23 @@ class FMoELinear(nn.Module):
         x = MOELinear.apply(inp, fwd_expert_count, self.weight, self.bias)
         return x
 
+    def forward_dense(self, inp):
+        r"""
+        Apply every expert to every sample. `inp` is either `N x in_feat`,
+        shared by all experts, or `N x num_expert x in_feat`. The output is
+        `N x num_expert x out_feat`. A shared input is multiplied by all the
+        experts in a single matmul, without being duplicated.
+        """
+        if inp.dim() == 2:
+            weight = self.weight.view(-1, self.in_feat)
+            x = torch.matmul(inp, weight.t())
+            x = x.view(inp.shape[0], self.num_expert, self.out_feat)
+        else:
+            x = torch.einsum("nei,eoi->neo", inp, self.weight)
+        if self.bias is not None:
+            x = x + self.bias
+        return x
+
     def extra_repr(self) -> str:
         return "num_expert={}, in_features={}, \
         out_features={}, bias={}, rank={}".format(
@@ -281,7 +281,7 @@ class RelMultiHeadAttn(nn.Module):
 from custom_transformer import FMoETransformerMLP2 as moe_qkv
 from custom_transformer import FMoETransformerMLP
 from custom_gate import *
-from fmoe.gates import NaiveGate
+from gates import NaiveGate
 
 class RelMultiHeadAttn_MoE(nn.Module):
     def __init__(self, n_head, d_model, d_head, dropout, dropatt=0,
@@ -791,6 +791,10 @@ class AdaptiveEmbedding(nn.Module):
         return embed
 
 class MemTransformerLM(nn.Module):
+    # also the defaults of the models pickled before the options
+    aux_loss_all_gates = False
+    _moe_gate_names = None
+
     def __init__(self, n_token, n_layer, n_head, d_model, d_head, d_inner,
                  dropout, dropatt, tie_weight=True, d_embed=None,
                  div_val=1, tie_projs=[False], pre_lnorm=False,
@@ -895,10 +899,81 @@ class MemTransformerLM(nn.Module):
         self.clamp_len = clamp_len
 
         self._create_params()
+        self.index_moe_gates()
 
     def backward_compatible(self):
         self.sample_softmax = -1
 
+    def _set_moe_token_ids(self, token_ids):
+        # the table gates route the tokens by their ids
+        for gate in self._moe_gates('table'):
+            gate.token_ids = token_ids
+
+    def _set_router_weights(self, weights):
+        # the HyperNet gates attached to `router_generator` take its weights
+        # from the forward, so that the replicas of nn.DataParallel use those
+        # of their own generator
+        for gate in self._moe_gates('hyper'):
+            if gate.router_index is not None:
+                gate.generated_weights = weights
+
+    def index_moe_gates(self):
+        r"""
+        Look up, once, the names of the gates that `collect_aux_losses` and
+        the forward use. Names, unlike the modules, also resolve in the
+        replicas of nn.DataParallel. It runs at construction, and must run
+        again after gates are replaced.
+        """
+        names = {'balance': [], 'balance_all': [], 'custom': [], 'table': [],
+                'hyper': []}
+        for name, m in self.named_modules():
+            if not isinstance(m, CustomBaseGate):
+                continue
+            names['custom'].append(name)
+            if isinstance(m, CustomTableGate):
+                names['table'].append(name)
+            if isinstance(m, CustomNaiveGate_HyperNet):
+                names['hyper'].append(name)
+            if isinstance(m, CustomNaiveGate_Balance):
+                names['balance'].append(name)
+            if m.balance_temperature is not None:
+                names['balance_all'].append(name)
+        self._moe_gate_names = names
+        return names
+
+    def _moe_gates(self, kind):
+        names = self._moe_gate_names
+        if names is None or kind not in names:
+            # a model pickled before the index
+            names = self.index_moe_gates()
+        return [self.get_submodule(name) for name in names[kind]]
+
+    def collect_aux_losses(self):
+        r"""
+        Sum of the load-balance losses of the `CustomNaiveGate_Balance` gates
+        in the last training forward, or 0 if there is none. With
+        `aux_loss_all_gates`, the losses of the XMoE and StableMoE gates are
+        added too.
+        """
+        gates = self._moe_gates('balance_all' if self.aux_loss_all_gates
+                else 'balance')
+        losses = [g.loss for g in gates if g.loss is not None]
+        if len(losses) == 0:
+            return 0
+        return torch.stack(losses).sum()
+
+    def _pop_non_finite_count(self):
+        # the non-finite scores counted by the gates since the last call, on
+        # the device, or None if there is none
+        counts = []
+        for gate in self._moe_gates('custom'):
+            if gate.non_finite_count is not None:
+                counts.append(gate.non_finite_count)
+                gate.non_finite_count = None
+        if len(counts) == 0:
+            return None
+        return torch.stack(counts).sum()
+
     def _create_params(self):
         if self.attn_type == 0: # default attention
             self.pos_emb = PositionalEmbedding(self.d_model)
@@ -1051,15 +1126,28 @@ class MemTransformerLM(nn.Module):
 
         return core_out, new_mems
 
-    def forward(self, data, target, *mems):
+    def forward(self, data, target, *mems, return_aux_loss=False,
+                return_non_finite_count=False):
         # nn.DataParallel does not allow size(0) tensors to be broadcasted.
         # So, have to initialize size(0) mems inside the model forward.
         # Moreover, have to return new_mems to allow nn.DataParallel to piece
         # them together.
+        # With return_aux_loss, the load-balance loss of this forward is also
+        # returned, and with return_non_finite_count the number of non-finite
+        # gate scores, after the mems and in this order. They are 1 x 1
+        # tensors that nn.DataParallel gathers along dim 1 as well, since the
+        # gates of its replicas are dropped after it.
         if not mems: mems = self.init_mems(data)
 
         tgt_len = target.size(0)
+        generator = getattr(self, 'router_generator', None)
+        if generator is not None:
+            self._set_router_weights(generator.router_weights())
+        self._set_moe_token_ids(data)
         hidden, new_mems = self._forward(data, mems=mems)
+        self._set_moe_token_ids(None)
+        if generator is not None:
+            self._set_router_weights(None)
 
         pred_hid = hidden[-tgt_len:]
         if self.sample_softmax > 0 and self.training:
@@ -1071,10 +1159,18 @@ class MemTransformerLM(nn.Module):
             loss = self.crit(pred_hid.view(-1, pred_hid.size(-1)), target.contiguous().view(-1))
             loss = loss.view(tgt_len, -1)
 
-        if new_mems is None:
-            return [loss]
-        else:
-            return [loss] + new_mems
+        ret = [loss] if new_mems is None else [loss] + new_mems
+        if return_aux_loss:
+            aux_loss = self.collect_aux_losses()
+            if not torch.is_tensor(aux_loss):
+                aux_loss = loss.new_zeros(())
+            ret.append(aux_loss.view(1, 1))
+        if return_non_finite_count:
+            count = self._pop_non_finite_count()
+            if count is None:
+                count = torch.zeros((), dtype=torch.long, device=loss.device)
+            ret.append(count.view(1, 1))
+        return ret
 
 if __name__ == '__main__':
     import argparse
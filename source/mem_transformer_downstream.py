@@ -451,9 +451,10 @@ class RelLearnableMultiHeadAttn(RelMultiHeadAttn):
 
         return output
 
+from custom_layers import FMoE
 from custom_transformer import FMoETransformerMLP
 from custom_gate import *
-from fmoe.gates import NaiveGate
+from gates import NaiveGate
 
 class CustomizedMoEPositionwiseFF(FMoETransformerMLP):
     def __init__(self, d_model, d_inner, dropout, pre_lnorm=False, moe_num_expert=64, moe_top_k=2, gate_name=NaiveGate):
@@ -643,6 +644,10 @@ class AdaptiveEmbedding(nn.Module):
         return embed
 
 class MemTransformerLM(nn.Module):
+    # also the defaults of the models pickled before the options
+    aux_loss_all_gates = False
+    _moe_gate_names = None
+
     def __init__(self, n_token, n_layer, n_head, d_model, d_head, d_inner,
                  dropout, dropatt, tie_weight=True, d_embed=None,
                  div_val=1, tie_projs=[False], pre_lnorm=False,
@@ -752,10 +757,45 @@ class MemTransformerLM(nn.Module):
         self.clamp_len = clamp_len
 
         self._create_params()
+        self.index_moe_gates()
 
     def backward_compatible(self):
         self.sample_softmax = -1
 
+    def index_moe_gates(self):
+        r"""
+        Look up, once, the names of the gates that `collect_aux_losses` uses.
+        Names, unlike the modules, also resolve in the replicas of
+        nn.DataParallel. It runs at construction, and must run again after
+        gates are replaced.
+        """
+        names = {'balance': [], 'balance_all': []}
+        for name, m in self.named_modules():
+            if isinstance(m, CustomNaiveGate_Balance):
+                names['balance'].append(name)
+            if isinstance(m, CustomBaseGate) and m.balance_temperature is not None:
+                names['balance_all'].append(name)
+        self._moe_gate_names = names
+        return names
+
+    def collect_aux_losses(self):
+        r"""
+        Sum of the load-balance losses of the `CustomNaiveGate_Balance` gates
+        in the last training forward, or 0 if there is none. With
+        `aux_loss_all_gates`, the losses of the XMoE and StableMoE gates are
+        added too.
+        """
+        names = self._moe_gate_names
+        if names is None:
+            # a model pickled before the index
+            names = self.index_moe_gates()
+        names = names['balance_all' if self.aux_loss_all_gates else 'balance']
+        losses = [self.get_submodule(name).loss for name in names]
+        losses = [loss for loss in losses if loss is not None]
+        if len(losses) == 0:
+            return 0
+        return torch.stack(losses).sum()
+
     def _create_params(self):
         if self.attn_type == 0: # default attention
             self.pos_emb = PositionalEmbedding(self.d_model)
@@ -790,6 +830,11 @@ class MemTransformerLM(nn.Module):
         else:
             return None
 
+    def _set_moe_mask(self, token_mask):
+        for layer in self.layers:
+            if isinstance(getattr(layer, 'pos_ff', None), FMoE):
+                layer.pos_ff.mask = token_mask
+
     def _update_mems(self, hids, mems, qlen, mlen, attn_mask):
         # does not deal with None
         if mems is None: return None
@@ -844,6 +889,10 @@ class MemTransformerLM(nn.Module):
                 attn_mems = attn_mems.eq(0).float().mean(dim=0).eq(0).byte().repeat(qlen, 1, 1)
                 dec_attn_mask = torch.cat([attn_mems, dec_attn_mask], dim=1).byte()
 
+        # padding tokens are masked on their own position, skip them in the moe layers
+        token_mask = attn_mask.diagonal(dim1=0, dim2=1).t()
+        self._set_moe_mask(token_mask)
+
         hids = []
         if self.attn_type == 0: # default
             pos_seq = torch.arange(klen-1, -1, -1.0, device=word_emb.device,
@@ -916,6 +965,7 @@ class MemTransformerLM(nn.Module):
                 hids.append(core_out)
 
         core_out = self.drop(core_out)
+        self._set_moe_mask(None)
 
         new_mems, new_attn_mask = self._update_mems(hids, mems, mlen, qlen, dec_attn_mask)
 
@@ -0,0 +1,256 @@
+r"""
+Chunked expert-parallel MoE computation, in which the exchange of the samples
+of one chunk overlaps with the computation of the experts on another.
+
+The samples that every worker sends to each (worker, expert) pair are split
+into `num_chunks` chunks. Each chunk is exchanged with an asynchronous
+`torch.distributed.all_to_all_single`. The exchange of chunk i + 1 and the
+return of the outputs of chunk i - 1 are in flight while the experts run on
+chunk i. Backward is scheduled the same way.
+"""
+import tree
+import torch
+import torch.distributed as dist
+from torch.autograd import Function
+
+from functions import prepare_forward, get_moe_group
+from backends.torch_backend import _worker_splits, _transpose_chunks
+
+def _split_counts(counts, num_chunks):
+    r"""
+    Split every count into `num_chunks` parts that differ by at most one, the
+    larger parts first.
+    """
+    return [
+        [c // num_chunks + (1 if k < c % num_chunks else 0) for c in counts]
+        for k in range(num_chunks)
+    ]
+
+def _chunk_perm(counts, num_chunks):
+    r"""
+    Permutation that turns a buffer ordered by (worker, expert) into the
+    concatenation of the chunks, each ordered by (worker, expert).
+    """
+    counts = torch.tensor(counts, dtype=torch.long)
+    num_slot = counts.numel()
+    slot = torch.repeat_interleave(torch.arange(num_slot), counts)
+    offset = torch.cumsum(counts, dim=0) - counts
+    rank = torch.arange(slot.numel()) - offset[slot]
+    base = (counts // num_chunks)[slot]
+    rem = (counts % num_chunks)[slot]
+    cut = rem * (base + 1)
+    chunk = torch.where(
+        rank < cut,
+        rank // (base + 1),
+        rem + (rank - cut) // base.clamp(min=1),
+    )
+    return torch.sort(chunk * num_slot + slot, stable=True)[1]
+
+def _exchange(buf, send_counts, recv_counts, world_size, group):
+    recv_buf = buf.new_empty((sum(recv_counts),) + tuple(buf.shape[1:]))
+    work = dist.all_to_all_single(
+        recv_buf,
+        buf.contiguous(),
+        _worker_splits(recv_counts, world_size)[0],
+        _worker_splits(send_counts, world_size)[0],
+        group=group,
+        async_op=True,
+    )
+    return recv_buf, work
+
+class MOEPipeline(Function):
+    r"""
+    Exchange the chunks of the `num_inp` tensors `local_input_bufs`, run the
+    experts on them and send the outputs back, overlapping the communication
+    of every chunk with the computation of its neighbours. The inputs are
+    given to `expert_fn` with the nested structure of `structure[0]`, and
+    the structure of its outputs is stored in `structure[1]`. The experts
+    are run with their own autograd graph, which is back-propagated chunk by
+    chunk in backward. `params` are the trainable parameters of the experts,
+    whose gradients are returned.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        expert_fn,
+        structure,
+        local_chunk_counts,
+        global_chunk_counts,
+        world_size,
+        group,
+        requires_grad,
+        num_inp,
+        *bufs_and_params
+    ):
+        local_input_bufs = bufs_and_params[:num_inp]
+        params = bufs_and_params[num_inp:]
+        num_chunks = len(local_chunk_counts)
+        num_expert = len(global_chunk_counts[0]) // world_size
+        chunk_sizes = [sum(c) for c in local_chunk_counts]
+        send_bufs = [buf.split(chunk_sizes) for buf in local_input_bufs]
+
+        def exchange_inputs(k):
+            return [_exchange(bufs[k], local_chunk_counts[k],
+                global_chunk_counts[k], world_size, group) for bufs in send_bufs]
+
+        ctx.gibs = [None] * num_chunks
+        ctx.gobs = [None] * num_chunks
+        outputs = [None] * num_chunks
+        works = []
+        pending = exchange_inputs(0)
+        for k in range(num_chunks):
+            received = pending
+            if k + 1 < num_chunks:
+                pending = exchange_inputs(k + 1)
+            xs = []
+            for recv_buf, work in received:
+                work.wait()
+                xs.append(_transpose_chunks(recv_buf, global_chunk_counts[k],
+                    num_expert, world_size, to_expert_major=True))
+
+            fwd_expert_count = torch.tensor(global_chunk_counts[k]).view(
+                    world_size, num_expert).sum(dim=0)
+            if requires_grad:
+                for x in xs:
+                    x.requires_grad = x.is_floating_point()
+                with torch.enable_grad():
+                    y = expert_fn(tree.unflatten_as(structure[0], xs),
+                            fwd_expert_count)
+                ys = tree.flatten(y)
+                ctx.gibs[k] = xs
+                ctx.gobs[k] = ys
+                ys = [t.detach() for t in ys]
+            else:
+                y = expert_fn(tree.unflatten_as(structure[0], xs),
+                        fwd_expert_count)
+                ys = tree.flatten(y)
+            structure[1] = y
+
+            outputs[k] = []
+            for t in ys:
+                t = _transpose_chunks(t, global_chunk_counts[k], num_expert,
+                        world_size, to_expert_major=False)
+                out, work = _exchange(t, global_chunk_counts[k],
+                        local_chunk_counts[k], world_size, group)
+                outputs[k].append(out)
+                works.append(work)
+        for work in works:
+            work.wait()
+
+        ctx.moe_args = (local_chunk_counts, global_chunk_counts, world_size,
+                group, num_inp)
+        ctx.params = params
+        return tuple(torch.cat([outputs[k][i] for k in range(num_chunks)], dim=0)
+                for i in range(len(outputs[0])))
+
+    @staticmethod
+    def backward(ctx, *grad_outs):
+        (local_chunk_counts, global_chunk_counts, world_size,
+                group, num_inp) = ctx.moe_args
+        num_chunks = len(local_chunk_counts)
+        num_expert = len(global_chunk_counts[0]) // world_size
+        chunk_sizes = [sum(c) for c in local_chunk_counts]
+        grad_bufs = [g.split(chunk_sizes) for g in grad_outs]
+
+        def exchange_grads(k):
+            return [_exchange(bufs[k], local_chunk_counts[k],
+                global_chunk_counts[k], world_size, group) for bufs in grad_bufs]
+
+        grad_ins = [[None] * num_chunks for _ in range(num_inp)]
+        grad_params = [None] * len(ctx.params)
+        works = []
+        pending = exchange_grads(0)
+        for k in range(num_chunks):
+            received = pending
+            if k + 1 < num_chunks:
+                pending = exchange_grads(k + 1)
+            grad_ys = []
+            for recv_buf, work in received:
+                work.wait()
+                grad_ys.append(_transpose_chunks(recv_buf,
+                    global_chunk_counts[k], num_expert, world_size,
+                    to_expert_major=True))
+
+            xs, ys = ctx.gibs[k], ctx.gobs[k]
+            diff_xs = [x for x in xs if x.requires_grad]
+            grads = torch.autograd.grad(ys, diff_xs + list(ctx.params),
+                    grad_ys, allow_unused=True)
+            grad_xs = iter(grads[:len(diff_xs)])
+            for i, g in enumerate(grads[len(diff_xs):]):
+                if g is not None:
+                    grad_params[i] = g if grad_params[i] is None \
+                            else grad_params[i] + g
+            ctx.gibs[k] = ctx.gobs[k] = None
+
+            for i, x in enumerate(xs):
+                if not x.requires_grad:
+                    continue
+                grad_x = next(grad_xs)
+                if grad_x is None:
+                    grad_x = torch.zeros_like(x)
+                grad_x = _transpose_chunks(grad_x, global_chunk_counts[k],
+                        num_expert, world_size, to_expert_major=False)
+                grad_ins[i][k], work = _exchange(grad_x, global_chunk_counts[k],
+                        local_chunk_counts[k], world_size, group)
+                works.append(work)
+        for work in works:
+            work.wait()
+
+        grad_inps = [torch.cat(g, dim=0) if g[0] is not None else None
+                for g in grad_ins]
+        return (None, None, None, None, None, None, None, None,
+                *grad_inps, *grad_params)
+
+def _fmoe_pipeline_forward(inp, gate, gate_score, expert_fn, num_expert,
+        world_size, num_chunks, experts=None, sync_free=False):
+    r"""
+    A private function with the same role as `_fmoe_general_global_forward`,
+    which exchanges the samples in `num_chunks` overlapped chunks. It returns
+    the outputs of the experts combined with `gate_score`, one row per token.
+    `inp` may be a nested structure of tensors, as the outputs of the experts.
+    """
+    (
+        pos,
+        local_expert_count,
+        global_expert_count,
+        fwd_expert_count,
+        fwd_batch_size,
+    ) = prepare_forward(gate, num_expert, world_size, sync_free=sync_free)
+    topk = 1
+    if len(gate.shape) == 2:
+        topk = gate.shape[1]
+
+    local_expert_count = local_expert_count.tolist()
+    global_expert_count = global_expert_count.tolist()
+    local_chunk_counts = _split_counts(local_expert_count, num_chunks)
+    global_chunk_counts = _split_counts(global_expert_count, num_chunks)
+    pos = pos[_chunk_perm(local_expert_count, num_chunks).to(pos.device)]
+    token_pos = torch.div(pos, topk, rounding_mode='floor')
+    score = gate_score.reshape(-1)[pos]
+
+    inps = tree.flatten(inp)
+    structure = [inp, None]
+    local_output_bufs = MOEPipeline.apply(
+        expert_fn,
+        structure,
+        local_chunk_counts,
+        global_chunk_counts,
+        world_size,
+        get_moe_group(),
+        torch.is_grad_enabled(),
+        len(inps),
+        *[t.index_select(0, token_pos) for t in inps],
+        *[p for p in experts.parameters() if p.requires_grad]
+    )
+
+    def combine(local_output_buf, batch_size):
+        local_output_buf = local_output_buf * score.unsqueeze(1).to(
+                local_output_buf.dtype)
+        output = local_output_buf.new_zeros(batch_size,
+                local_output_buf.shape[-1])
+        return output.index_add(0, token_pos, local_output_buf)
+
+    batch_size = inps[0].shape[0]
+    return tree.unflatten_as(structure[1],
+            [combine(t, batch_size) for t in local_output_bufs])
@@ -0,0 +1,158 @@
+r"""
+Routing statistics of the MoE layers, accumulated on the device by the
+`gate_hook` of `FMoE` and read back to the host only when flushed.
+"""
+import threading
+
+import torch
+
+
+class RoutingTelemetry(object):
+    r"""
+    Per layer, the number of routings of every expert, the number of dropped
+    routings (index -1), and the sums of the top-k entropy and of the top-1 /
+    top-2 score margin of every token. Both only see the scores of the
+    selected experts of a token: the top-k entropy is the entropy of these
+    scores once normalized, i.e. how evenly the output of the token mixes its
+    experts, between 0 (always, with `top_k` 1) and log(top_k), and not the
+    entropy of the router over all the experts. All of them
+    are updated in place on the device, so a step costs no host sync; `flush`
+    copies the statistics of all the layers in one transfer.
+    With `training_only`, the routing run without grad, e.g. evaluation, is
+    not counted.
+    The statistics are kept per layer and device, as the replicas of
+    `nn.DataParallel` share the hooks and run in threads, and summed when
+    flushed.
+    """
+
+    def __init__(self, training_only=True):
+        self.training_only = training_only
+        self.layers = {}
+        self._accum = {}
+        self._lock = threading.Lock()
+
+    def hook(self, name, tot_expert):
+        r"""
+        The `gate_hook` of the layer `name`, with `tot_expert` experts.
+        """
+        self.layers[name] = tot_expert
+        return _TelemetryHook(self, name)
+
+    def _stats(self, name, device):
+        key = (name, device)
+        stats = self._accum.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._accum.get(key)
+                if stats is None:
+                    # slot 0 of the counts holds the dropped routings; the sums
+                    # hold the top-k entropy, the margin, the tokens scored and
+                    # those with a margin
+                    stats = (
+                        torch.zeros(self.layers[name] + 1, dtype=torch.long,
+                            device=device),
+                        torch.zeros(4, dtype=torch.float, device=device),
+                    )
+                    self._accum[key] = stats
+        return stats
+
+    def record(self, name, gate_top_k_idx, gate_score):
+        if self.training_only and not torch.is_grad_enabled():
+            return
+        with torch.no_grad():
+            counts, sums = self._stats(name, gate_top_k_idx.device)
+            idx = gate_top_k_idx.reshape(-1).to(torch.long)
+            counts.scatter_add_(0, idx + 1, torch.ones_like(idx))
+
+            # ragged routing has no per-token scores, only the counts are kept
+            if gate_top_k_idx.dim() != 2 or gate_score.numel() != idx.numel():
+                return
+            score = gate_score.detach().reshape(gate_top_k_idx.shape).float()
+            prob = score / score.sum(dim=-1, keepdim=True).clamp(min=1e-9)
+            entropy = -(prob * prob.clamp(min=1e-9).log()).sum(dim=-1)
+            sums[0] += entropy.sum()
+            sums[2] += score.shape[0]
+            if score.shape[1] > 1:
+                top2 = torch.topk(score, k=2, dim=-1)[0]
+                sums[1] += (top2[:, 0] - top2[:, 1]).sum()
+                sums[3] += score.shape[0]
+
+    def flush(self, reset=True):
+        r"""
+        The statistics of every layer since the last reset, as a dict of
+        `count` (routings per expert), `dropped`, `topk_entropy` and `margin`
+        (means per token, None without per-token scores), read back in a
+        single transfer.
+        """
+        with self._lock:
+            stats = self._accum
+            if reset:
+                self._accum = {}
+        if len(stats) == 0:
+            return {}
+        # the statistics of the other devices are summed on the first one
+        device = next(iter(stats))[1]
+        merged = {}
+        for (n, _), (counts, sums) in stats.items():
+            flat = torch.cat([counts.double(), sums.double()]).to(device)
+            merged[n] = flat if n not in merged else merged[n] + flat
+        names = list(merged.keys())
+        flat = torch.cat([merged[n] for n in names]).cpu()
+
+        out = {}
+        start = 0
+        for n in names:
+            size = self.layers[n] + 1
+            counts, sums = flat[start:start + size], flat[start + size:start + size + 4]
+            start += size + 4
+            out[n] = {
+                'count': counts[1:].long(),
+                'dropped': int(counts[0]),
+                'topk_entropy': float(sums[0] / sums[2]) if sums[2] > 0 else None,
+                'margin': float(sums[1] / sums[3]) if sums[3] > 0 else None,
+            }
+        return out
+
+    @staticmethod
+    def summary(stats):
+        r"""
+        One log line of the flushed `stats`: the worst and mean ratio of the
+        busiest expert load to the mean load of a layer, and the means of the
+        top-k entropy, the margin and the fraction of dropped routings.
+        """
+        if len(stats) == 0:
+            return ''
+        def mean(key):
+            values = [s[key] for s in stats.values() if s[key] is not None]
+            return sum(values) / len(values) if len(values) > 0 else float('nan')
+
+        imbalance, dropped = [], []
+        for s in stats.values():
+            count = s['count'].float()
+            imbalance.append(float(count.max() / count.mean().clamp(min=1e-9)))
+            dropped.append(s['dropped'] / max(int(count.sum()) + s['dropped'], 1))
+        n = len(stats)
+        return 'load max/mean {:.2f} (worst) {:.2f} (avg) | top-k entropy {:.3f} ' \
+               '| margin {:.3f} | dropped {:.2%}'.format(
+            max(imbalance), sum(imbalance) / n, mean('topk_entropy'), mean('margin'),
+            sum(dropped) / n)
+
+    def __getstate__(self):
+        # the accumulated statistics are not saved with the model
+        state = self.__dict__.copy()
+        state['_accum'] = {}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class _TelemetryHook(object):
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __call__(self, gate_top_k_idx, gate_score, token_idx):
+        self.telemetry.record(self.name, gate_top_k_idx, gate_score)
@@ -0,0 +1,325 @@
+r"""
+On-disk traces of the routing of the MoE layers.
+
+`RoutingTraceRecorder` is attached as the `gate_hook` of every `FMoE` layer.
+For every forward, it stores the expert indices as uint8 (or uint16 with more
+than 254 experts, the dropped routings being the largest value) and the gate
+scores quantized to uint8. The gates routing every token to a variable
+number of experts return flat lists of entries, whose tokens are stored too,
+as int32. The arrays are copied to the host asynchronously, and a background
+thread writes them into chunks of `chunk_steps` steps of compressed `.npz`
+files, plus an index of the rows of every step and layer.
+
+`RoutingTrace` loads a trace: the chunks of a layer are unpacked once into
+plain `.npy` files next to them, which are then memory-mapped.
+
+Layout of a trace directory:
+    meta.json           layer names, index and score dtypes, score scale,
+                        ragged layers
+    index.npy           int64 rows of (step, layer, chunk, start, tokens, k),
+                        `start` being the offset in the arrays of the chunk,
+                        `tokens` the number of entries of a ragged layer
+    chunk_00000.npz     `idx_<layer>` and `score_<layer>`, flat, per chunk,
+                        and `token_<layer>` for a ragged layer
+    idx_<layer>.npy     the unpacked arrays of a layer, made by the loader
+    score_<layer>.npy
+    token_<layer>.npy
+"""
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+
+SCORE_SCALE = 255
+
+# columns of index.npy
+STEP, LAYER, CHUNK, START, TOKENS, TOP_K = range(6)
+
+
+class RoutingTraceRecorder(object):
+    r"""
+    Record the routing of the layers given to `hook` into the directory
+    `path`. `step` must be called after every forward of the model, and
+    `close` once the trace is complete. At most `max_pending` records wait
+    for the writer thread before `record` blocks.
+    """
+
+    def __init__(self, path, chunk_steps=256, max_pending=256):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_steps = chunk_steps
+        self.layers = []
+        self.tot_expert = []
+        self.ragged = []
+        self.current_step = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def hook(self, name, tot_expert, prev=None):
+        r"""
+        The `gate_hook` of the layer `name`, with `tot_expert` experts. `prev`
+        is the hook the layer had, called first.
+        """
+        assert tot_expert < 2 ** 16 - 1, 'too many experts for a uint16 trace'
+        self.layers.append(name)
+        self.tot_expert.append(tot_expert)
+        self.ragged.append(None)
+        return _TraceHook(self, len(self.layers) - 1, prev)
+
+    def _index_dtype(self, layer):
+        return np.uint8 if self.tot_expert[layer] < 2 ** 8 - 1 else np.uint16
+
+    def record(self, layer, gate_top_k_idx, gate_score, token_idx=None):
+        r"""
+        Record one routing of `layer`, with the `token_idx` of every entry if
+        it is ragged.
+        """
+        if self._error is not None:
+            raise self._error
+        ragged = token_idx is not None
+        if self.ragged[layer] is None:
+            self.ragged[layer] = ragged
+        assert self.ragged[layer] == ragged, \
+                'the routing of {} changed between ragged and top-k'.format(
+                        self.layers[layer])
+        with torch.no_grad():
+            k = gate_top_k_idx.shape[-1] if gate_top_k_idx.dim() > 1 else 1
+            idx = gate_top_k_idx.reshape(-1)
+            if self._index_dtype(layer) == np.uint8:
+                idx = idx.masked_fill(idx < 0, 2 ** 8 - 1).to(torch.uint8)
+            else:
+                # -1 is read back as the largest uint16
+                idx = idx.to(torch.int16)
+            score = (gate_score.detach().reshape(-1).float().clamp(0, 1)
+                    * SCORE_SCALE).round_().to(torch.uint8)
+
+            if ragged:
+                token_idx = token_idx.reshape(-1).to(torch.int32)
+
+            event = None
+            if idx.is_cuda:
+                idx = _to_pinned(idx)
+                score = _to_pinned(score)
+                if ragged:
+                    token_idx = _to_pinned(token_idx)
+                event = torch.cuda.Event()
+                event.record()
+            else:
+                idx, score = idx.clone(), score.clone()
+                if ragged:
+                    token_idx = token_idx.clone()
+        self._queue.put((self.current_step, layer, k, idx, score, token_idx,
+            event))
+
+    def step(self):
+        self.current_step += 1
+
+    def close(self):
+        r"""
+        Write the last chunk and the index, and stop the writer thread.
+        """
+        self._queue.put(None)
+        self._writer.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_chunk(self, chunk, parts):
+        if len(parts) == 0:
+            return
+        arrays = {}
+        for layer, layer_parts in parts.items():
+            arrays['idx_{}'.format(layer)] = np.concatenate(
+                    [p[0] for p in layer_parts])
+            arrays['score_{}'.format(layer)] = np.concatenate(
+                    [p[1] for p in layer_parts])
+            if self.ragged[layer]:
+                arrays['token_{}'.format(layer)] = np.concatenate(
+                        [p[2] for p in layer_parts])
+        np.savez_compressed(os.path.join(self.path,
+            'chunk_{:05d}.npz'.format(chunk)), **arrays)
+
+    def _write_loop(self):
+        chunk, parts, offset, index = 0, {}, {}, []
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None or item[0] // self.chunk_steps != chunk:
+                    self._write_chunk(chunk, parts)
+                    parts, offset = {}, {}
+                    if item is None:
+                        break
+                    chunk = item[0] // self.chunk_steps
+
+                step, layer, k, idx, score, token_idx, event = item
+                if event is not None:
+                    event.synchronize()
+                idx = idx.numpy()
+                if idx.dtype == np.int16:
+                    idx = idx.view(np.uint16)
+                start = offset.get(layer, 0)
+                if token_idx is not None:
+                    token_idx = token_idx.numpy()
+                parts.setdefault(layer, []).append((idx, score.numpy(),
+                    token_idx))
+                offset[layer] = start + idx.shape[0]
+                index.append((step, layer, chunk, start, idx.shape[0] // k, k))
+        except Exception as e:
+            self._error = e
+            # unblock the producer until close
+            while self._queue.get() is not None:
+                pass
+            return
+
+        np.save(os.path.join(self.path, 'index.npy'),
+                np.array(index, dtype=np.int64).reshape(-1, 6))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({
+                'layers': self.layers,
+                'tot_expert': self.tot_expert,
+                'index_dtype': [np.dtype(self._index_dtype(i)).name
+                    for i in range(len(self.layers))],
+                'score_scale': SCORE_SCALE,
+                'chunk_steps': self.chunk_steps,
+                'ragged': [bool(r) for r in self.ragged],
+            }, f)
+
+    def __getstate__(self):
+        raise TypeError('a RoutingTraceRecorder cannot be saved, detach it '
+                'with set_routing_trace(model, None) first')
+
+
+def _to_pinned(tensor):
+    out = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    out.copy_(tensor, non_blocking=True)
+    return out
+
+
+class _TraceHook(object):
+    def __init__(self, recorder, layer, prev=None):
+        self.recorder = recorder
+        self.layer = layer
+        self.prev = prev
+
+    def __call__(self, gate_top_k_idx, gate_score, token_idx):
+        if self.prev is not None:
+            self.prev(gate_top_k_idx, gate_score, token_idx)
+        self.recorder.record(self.layer, gate_top_k_idx, gate_score, token_idx)
+
+
+class RoutingTrace(object):
+    r"""
+    A routing trace written by `RoutingTraceRecorder` in `path`.
+    `indices(layer)` and `scores(layer)` are the memory-mapped flat arrays of
+    all the steps of a layer, given by name or number, and `step(layer, i)`
+    the `tokens x k` indices and scores, dequantized, of one step. A ragged
+    layer has one row per entry, and `tokens(layer)` and
+    `step_tokens(layer, i)` give the token of every entry.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.layers = self.meta['layers']
+        self.index = np.load(os.path.join(path, 'index.npy'))
+        self._arrays = {}
+
+    def _layer_id(self, layer):
+        return self.layers.index(layer) if isinstance(layer, str) else layer
+
+    def _unpack(self, layer):
+        rows = self.index[self.index[:, LAYER] == layer]
+        chunks = np.unique(rows[:, CHUNK])
+        size = int((rows[:, TOKENS] * rows[:, TOP_K]).sum())
+        out = {'token': None}
+        keys = [('idx', self.meta['index_dtype'][layer]), ('score', 'uint8')]
+        if self._is_ragged(layer):
+            keys.append(('token', 'int32'))
+        for key, dtype in keys:
+            fname = os.path.join(self.path, '{}_{}.npy'.format(key, layer))
+            if not os.path.exists(fname):
+                tmp = fname + '.tmp'
+                arr = np.lib.format.open_memmap(tmp, mode='w+',
+                        dtype=np.dtype(dtype), shape=(size,))
+                pos = 0
+                for chunk in chunks:
+                    with np.load(os.path.join(self.path,
+                            'chunk_{:05d}.npz'.format(chunk))) as f:
+                        part = f['{}_{}'.format(key, layer)]
+                    arr[pos:pos + part.shape[0]] = part
+                    pos += part.shape[0]
+                arr.flush()
+                del arr
+                os.replace(tmp, fname)
+            out[key] = np.load(fname, mmap_mode='r')
+
+        # start of every row in the flat arrays of the layer
+        sizes = rows[:, TOKENS] * rows[:, TOP_K]
+        starts = np.cumsum(sizes) - sizes
+        self._arrays[layer] = (out['idx'], out['score'], rows, starts,
+                out['token'])
+        return self._arrays[layer]
+
+    def _is_ragged(self, layer):
+        # traces written before the token ids were recorded have no flags
+        return self.meta.get('ragged', [False] * len(self.layers))[layer]
+
+    def _layer(self, layer):
+        layer = self._layer_id(layer)
+        if layer not in self._arrays:
+            self._unpack(layer)
+        return self._arrays[layer]
+
+    def indices(self, layer):
+        return self._layer(layer)[0]
+
+    def scores(self, layer):
+        return self._layer(layer)[1]
+
+    def tokens(self, layer):
+        return self._layer(layer)[4]
+
+    def steps(self, layer):
+        return self._layer(layer)[2][:, STEP]
+
+    def step(self, layer, i):
+        r"""
+        The indices and float scores of every forward of `layer` at step `i`,
+        concatenated.
+        """
+        idx, score, rows, starts, _ = self._layer(layer)
+        sel = np.nonzero(rows[:, STEP] == i)[0]
+        out_idx, out_score = [], []
+        for r in sel:
+            k = rows[r, TOP_K]
+            s = slice(starts[r], starts[r] + rows[r, TOKENS] * k)
+            out_idx.append(np.asarray(idx[s]).reshape(-1, k))
+            out_score.append(np.asarray(score[s]).reshape(-1, k)
+                    / self.meta['score_scale'])
+        if len(sel) == 0:
+            return None, None
+        return np.concatenate(out_idx), np.concatenate(out_score)
+
+    def step_tokens(self, layer, i):
+        r"""
+        The token of every entry of a ragged `layer` at step `i`, in the order
+        of `step(layer, i)`, the tokens of every forward counted from 0.
+        """
+        _, _, rows, starts, token = self._layer(layer)
+        assert token is not None, 'the layer is not ragged'
+        sel = np.nonzero(rows[:, STEP] == i)[0]
+        if len(sel) == 0:
+            return None
+        return np.concatenate([np.asarray(token[starts[r]:starts[r]
+            + rows[r, TOKENS]]) for r in sel])
@@ -0,0 +1,125 @@
+r"""
+Parity of the dispatch paths of `FMoE` on a single worker: the sparse, the
+sync-free, the einsum and the dense forward against a per-token reference,
+for the outputs and the gradients of the input, the scores and the experts.
+
+Usage (from `source/`):
+    python -m pytest -q tests/test_dispatch.py
+"""
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_gate import CustomNaiveGate
+from custom_transformer import FMoETransformerMLP
+
+NUM_EXPERT, D_MODEL, D_HIDDEN, NUM_TOKEN = 4, 8, 16, 24
+
+
+def _layer(top_k):
+    torch.manual_seed(0)
+    layer = FMoETransformerMLP(num_expert=NUM_EXPERT, d_model=D_MODEL,
+            d_hidden=D_HIDDEN, top_k=top_k, gate=CustomNaiveGate,
+            activation=torch.nn.ReLU()).double()
+    # no token is dropped by the capacity of the einsum path
+    layer.capacity_factor = float(NUM_EXPERT)
+    return layer
+
+
+def _routing(layer, top_k, drop):
+    x = torch.randn(NUM_TOKEN, D_MODEL, dtype=torch.double)
+    with torch.no_grad():
+        idx, score = layer.gate(x)
+    if drop:
+        idx = idx.clone()
+        idx[::5, -1] = -1
+    return x, idx, score.reshape(idx.shape).clone()
+
+
+def _reference(layer, x, idx, score):
+    experts = layer.experts
+    out = []
+    for t in range(x.shape[0]):
+        y = x.new_zeros(D_MODEL)
+        for k in range(idx.shape[1]):
+            e = int(idx[t, k])
+            if e < 0:
+                continue
+            h = experts.activation(experts.htoh4.weight[e].mv(x[t])
+                    + experts.htoh4.bias[e])
+            y = y + score[t, k] * (experts.h4toh.weight[e].mv(h)
+                    + experts.h4toh.bias[e])
+        out.append(y)
+    return torch.stack(out)
+
+
+def _forward(layer, path, x, idx, score):
+    if path == 'dense':
+        assert layer._use_dense_forward(idx)
+        return layer._dense_forward(x, idx, score)
+    if path == 'einsum':
+        return layer._einsum_forward(x, idx, score)
+    layer.sync_free = path == 'sync_free'
+    return layer._sparse_forward(x, idx, score)
+
+
+def _grads(layer, out, x, score, grad_out):
+    params = [layer.experts.htoh4.weight, layer.experts.htoh4.bias,
+            layer.experts.h4toh.weight, layer.experts.h4toh.bias]
+    return torch.autograd.grad(out, [x, score] + params, grad_out)
+
+
+@pytest.mark.parametrize('drop', [False, True])
+@pytest.mark.parametrize('path', ['sparse', 'sync_free', 'einsum', 'dense'])
+def test_dispatch_matches_reference(path, drop):
+    top_k = NUM_EXPERT if path == 'dense' else 2
+    layer = _layer(top_k)
+    x, idx, score = _routing(layer, top_k, drop)
+    x.requires_grad_(True)
+    score.requires_grad_(True)
+    grad_out = torch.randn(NUM_TOKEN, D_MODEL, dtype=torch.double)
+
+    ref = _reference(layer, x, idx, score)
+    ref_grads = _grads(layer, ref, x, score, grad_out)
+    out = _forward(layer, path, x, idx, score)
+    grads = _grads(layer, out, x, score, grad_out)
+
+    assert torch.allclose(out, ref, atol=1e-10)
+    for g, r in zip(grads, ref_grads):
+        assert torch.allclose(g, r, atol=1e-10)
+
+
+def test_layer_paths_agree():
+    # the whole layer, with the gate, gives the same output and gate gradient
+    # whichever path the dispatch takes
+    x = torch.randn(NUM_TOKEN, D_MODEL, dtype=torch.double)
+    results = []
+    for mode, sync_free in [('sparse', False), ('sparse', True), ('einsum', False)]:
+        layer = _layer(2)
+        layer.dispatch_mode, layer.sync_free = mode, sync_free
+        out = layer(x)
+        grad, = torch.autograd.grad(out.pow(2).sum(), [layer.gate.gate.weight])
+        results.append((out, grad))
+    for out, grad in results[1:]:
+        assert torch.allclose(out, results[0][0], atol=1e-10)
+        assert torch.allclose(grad, results[0][1], atol=1e-10)
+
+
+def test_auto_einsum_drops_no_token():
+    # all the tokens on the same two experts, far above the capacity factor
+    layer = _layer(2)
+    layer.capacity_factor = 1.0
+    x = torch.randn(NUM_TOKEN, D_MODEL, dtype=torch.double)
+    idx = torch.tensor([[0, 1]]).repeat(NUM_TOKEN, 1)
+    score = torch.full((NUM_TOKEN, 2), 0.5, dtype=torch.double)
+    ref = _reference(layer, x, idx, score)
+
+    layer.dispatch_mode = 'einsum'
+    assert not torch.allclose(layer._einsum_forward(x, idx, score), ref)
+    layer.dispatch_mode = 'auto'
+    assert layer._use_einsum_forward(idx)
+    assert torch.allclose(layer._einsum_forward(x, idx, score), ref, atol=1e-10)
@@ -0,0 +1,186 @@
+r"""
+Smoke test of the distributed paths on two CPU processes over gloo: the
+expert exchange by all-to-all, the chunked pipeline, and the gradient
+all-reduce of `DistributedGroupedDataParallel`, also with the experts held
+by every worker as in `train.py --distributed`, the batch sliced over a
+`slice_group` and the SWIPE balancing of the torch backend.
+
+Usage (from `source/`):
+    python -m pytest -q tests/test_distributed.py
+"""
+import os
+import socket
+import sys
+import warnings
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import functions
+from backends import torch_backend
+from custom_gate import CustomNaiveGate
+from custom_transformer import FMoETransformerMLP
+from distributed import DistributedGroupedDataParallel
+from latest_utils import set_expert_dp_comm
+
+WORLD_SIZE, NUM_EXPERT, D_MODEL, D_HIDDEN = 2, 2, 8, 16
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _layer(num_expert, world_size, **kwargs):
+    return FMoETransformerMLP(num_expert=num_expert, d_model=D_MODEL,
+            d_hidden=D_HIDDEN, top_k=2, world_size=world_size,
+            gate=CustomNaiveGate, activation=torch.nn.ReLU(), **kwargs).double()
+
+
+def _expert_grads(layer):
+    return [p.grad for p in layer.experts.parameters()]
+
+
+def _check_expert_parallel(rank, pipeline_chunks):
+    # the experts sharded over the workers against all of them on every worker
+    torch.manual_seed(0)
+    ref = _layer(NUM_EXPERT * WORLD_SIZE, 1)
+    layer = _layer(NUM_EXPERT, WORLD_SIZE, pipeline_chunks=pipeline_chunks)
+    shard = slice(rank * NUM_EXPERT, (rank + 1) * NUM_EXPERT)
+    with torch.no_grad():
+        layer.gate.load_state_dict(ref.gate.state_dict())
+        for p, r in zip(layer.experts.parameters(), ref.experts.parameters()):
+            p.copy_(r[shard])
+
+    torch.manual_seed(1 + rank)
+    # a different number of tokens on every worker
+    x = torch.randn(7 + 3 * rank, D_MODEL, dtype=torch.double, requires_grad=True)
+    out = layer(x)
+    out.pow(2).sum().backward()
+    grad_x, x.grad = x.grad, None
+    ref_out = ref(x)
+    ref_out.pow(2).sum().backward()
+
+    assert torch.allclose(out, ref_out, atol=1e-10)
+    assert torch.allclose(grad_x, x.grad, atol=1e-10)
+    # the reference expert gradients only hold the tokens of this worker
+    for g, r in zip(_expert_grads(layer), _expert_grads(ref)):
+        r = r.clone()
+        dist.all_reduce(r)
+        assert torch.allclose(g, r[shard], atol=1e-10)
+
+
+def _all_equal(tensor):
+    tensors = [torch.empty_like(tensor) for _ in range(WORLD_SIZE)]
+    dist.all_gather(tensors, tensor)
+    return all(torch.equal(t, tensors[0]) for t in tensors)
+
+
+def _check_grouped_data_parallel(rank, expert_dp):
+    # the gate is synchronized; the experts only with set_expert_dp_comm
+    torch.manual_seed(rank)
+    world_size = 1 if expert_dp else WORLD_SIZE
+    layer = _layer(NUM_EXPERT, world_size)
+    if expert_dp:
+        set_expert_dp_comm(layer)
+    model = DistributedGroupedDataParallel(layer)
+    assert _all_equal(layer.gate.gate.weight)
+    assert _all_equal(layer.experts.htoh4.weight) == expert_dp
+
+    x = torch.randn(9, D_MODEL, dtype=torch.double)
+    model(x).pow(2).sum().backward()
+    grads = {n: p.grad.clone() for n, p in layer.named_parameters()}
+    model.allreduce_params()
+    for n, p in layer.named_parameters():
+        if n.startswith('gate.') or expert_dp:
+            mean = grads[n].clone()
+            dist.all_reduce(mean)
+            assert torch.allclose(p.grad, mean / WORLD_SIZE, atol=1e-10), n
+        else:
+            assert torch.equal(p.grad, grads[n]), n
+
+
+def _check_replicated_experts(rank):
+    # as train.py --distributed: every worker holds all the experts, which
+    # stay identical over a step on different data
+    torch.manual_seed(rank)
+    layer = _layer(NUM_EXPERT, 1)
+    with pytest.raises(AssertionError):
+        DistributedGroupedDataParallel(layer)
+    set_expert_dp_comm(layer)
+    model = DistributedGroupedDataParallel(layer)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+
+    x = torch.randn(9, D_MODEL, dtype=torch.double)
+    model(x).pow(2).sum().backward()
+    model.allreduce_params()
+    optimizer.step()
+    for n, p in layer.named_parameters():
+        assert _all_equal(p.data), n
+
+
+def _check_slice(rank, funcol):
+    # every worker computes its slice of the same batch, and all-gathers the
+    # outputs, and the gradients of the input
+    functions._funcol_all_gather = funcol
+    torch.manual_seed(0)
+    ref = _layer(NUM_EXPERT, 1)
+    layer = _layer(NUM_EXPERT, 1, slice_group=dist.new_group())
+    layer.load_state_dict(ref.state_dict())
+    assert (layer.slice_size, layer.slice_rank) == (WORLD_SIZE, rank)
+
+    x = torch.randn(10, D_MODEL, dtype=torch.double, requires_grad=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        out = layer(x)
+        out.pow(2).sum().backward()
+    grad_x, x.grad = x.grad, None
+    ref_out = ref(x)
+    ref_out.pow(2).sum().backward()
+
+    assert torch.allclose(out, ref_out, atol=1e-10)
+    assert torch.allclose(grad_x, x.grad, atol=1e-10)
+    # the experts only see the slice of their worker
+    for g, r in zip(_expert_grads(layer), _expert_grads(ref)):
+        g = g.clone()
+        dist.all_reduce(g)
+        assert torch.allclose(g, r, atol=1e-10)
+
+
+def _check_swipe(rank):
+    # one expert per worker taking 3 samples: the sample worker 0 rejects
+    # from rank 0 fills worker 1, those from rank 1 are dropped
+    idx = torch.tensor([[0, 0, 0, 0, 1], [0, 0, 1]][rank])
+    new_idx, capacity = torch_backend.swipe_once(idx, torch.scalar_tensor(3,
+        dtype=torch.long), 1, WORLD_SIZE, 0)
+    assert new_idx.tolist() == [[0, 0, 0, 1, 1], [-1, -1, 1]][rank]
+    assert capacity.item() == 0
+
+
+def _worker(rank, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=WORLD_SIZE)
+    try:
+        _check_expert_parallel(rank, pipeline_chunks=1)
+        _check_expert_parallel(rank, pipeline_chunks=2)
+        _check_grouped_data_parallel(rank, expert_dp=False)
+        _check_grouped_data_parallel(rank, expert_dp=True)
+        _check_replicated_experts(rank)
+        _check_slice(rank, functions._funcol_all_gather)
+        # without the functional collectives
+        _check_slice(rank, None)
+        _check_swipe(rank)
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available() or not dist.is_gloo_available(),
+        reason='needs torch.distributed with gloo')
+def test_two_workers():
+    mp.spawn(_worker, args=(_free_port(),), nprocs=WORLD_SIZE)
@@ -0,0 +1,223 @@
+r"""
+Behaviour of the gates: the shared routing core of the custom gates, their
+cached and finite scores, the HyperNet router weights and the capacity of
+the GShard and Switch gates.
+
+Usage (from `source/`):
+    python -m pytest -q tests/test_gates.py
+"""
+import math
+import os
+import sys
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_gate import (CustomNaiveGate, CustomNaiveGate_Distill,
+        CustomNaiveGate_HyperNet, CustomTableGate, HyperRouterGenerator,
+        fused_route)
+from custom_transformer import FMoETransformerMLP
+from backends.torch_backend import prune_by_capacity
+from gates import GShardGate, SwitchGate
+
+NUM_EXPERT, D_MODEL, NUM_TOKEN = 4, 8, 10
+
+
+def _input():
+    torch.manual_seed(1)
+    return torch.randn(NUM_TOKEN, D_MODEL)
+
+
+@pytest.mark.parametrize('top_k', [1, 2, NUM_EXPERT])
+def test_fused_route(top_k):
+    torch.manual_seed(0)
+    logits = torch.randn(NUM_TOKEN, NUM_EXPERT)
+    idx, score, count = fused_route(logits, top_k, return_count=True)
+    # the experts of the highest logits, with the softmax of their logits
+    ref_val, ref_idx = torch.topk(logits, k=top_k, dim=-1)
+    assert torch.equal(idx.sort(dim=-1)[0], ref_idx.sort(dim=-1)[0])
+    assert torch.allclose(score, F.softmax(logits.gather(1, idx), dim=-1))
+    assert torch.equal(count, torch.bincount(idx.reshape(-1), minlength=NUM_EXPERT))
+
+    idx, score = fused_route(logits, top_k, dense=True)
+    assert torch.equal(idx, torch.arange(NUM_EXPERT).repeat(NUM_TOKEN, 1))
+    assert torch.equal(score, torch.full((NUM_TOKEN, NUM_EXPERT), 1 / NUM_EXPERT))
+
+
+def test_fused_count():
+    torch.manual_seed(0)
+    layer = FMoETransformerMLP(num_expert=NUM_EXPERT, d_model=D_MODEL,
+            d_hidden=16, top_k=2, gate=CustomNaiveGate)
+    ref = layer(_input())
+    gate = layer.gate
+    gate.fused_count = True
+    idx, _ = gate(_input())
+    assert torch.equal(gate.expert_count,
+            torch.bincount(idx.reshape(-1), minlength=NUM_EXPERT))
+    # the dispatcher takes the counts of the gate, and drops them
+    assert torch.allclose(layer(_input()), ref)
+    assert gate.expert_count is None
+
+
+def test_embedding_cache():
+    gate = CustomNaiveGate_Distill(D_MODEL, NUM_EXPERT, 1, 2)
+    optimizer = torch.optim.SGD(gate.parameters(), lr=0.1)
+
+    def ref():
+        return F.normalize(gate.expert_embeddings.float(), dim=1, eps=1e-4).t()
+
+    # with a gradient, the embeddings are normalized on every call
+    cached = gate._normalized_embeddings()
+    assert cached.requires_grad and torch.allclose(cached, ref())
+    gate(_input())[1].sum().backward()
+    assert gate.expert_embeddings.grad is not None
+
+    # without, once until they change
+    with torch.no_grad():
+        cached = gate._normalized_embeddings()
+        assert gate._normalized_embeddings() is cached
+        assert torch.allclose(cached, ref())
+    optimizer.step()
+    with torch.no_grad():
+        assert gate._normalized_embeddings() is not cached
+        assert torch.allclose(gate._normalized_embeddings(), ref())
+    gate.load_state_dict({'expert_embeddings': torch.randn(NUM_EXPERT, D_MODEL)})
+    with torch.no_grad():
+        assert torch.allclose(gate._normalized_embeddings(), ref())
+
+
+def test_make_finite():
+    gate = CustomNaiveGate_Distill(D_MODEL, NUM_EXPERT, 1, 2)
+    gate.count_non_finite = True
+    scores = torch.tensor([[0.5, float('nan'), -0.2], [float('inf'), 0.1,
+        -float('inf')]])
+    out = gate._make_finite(scores)
+    # the non-finite scores take the smallest finite one
+    assert torch.equal(out, torch.tensor([[0.5, -0.2, -0.2], [-0.2, 0.1, -0.2]]))
+    assert gate.non_finite_count.item() == 3
+    gate._make_finite(scores)
+    assert gate.non_finite_count.item() == 6
+    finite = torch.randn(3, 4)
+    assert torch.equal(gate._make_finite(finite), finite)
+
+
+def test_table_gate_state():
+    torch.manual_seed(0)
+    gate = CustomTableGate(None, NUM_EXPERT, 1, 2)
+    expert_table = torch.stack([torch.randperm(NUM_EXPERT)[:2] for _ in range(5)])
+    score_table = torch.rand(5, 2)
+    gate.set_table(expert_table, score_table)
+    # the empty tables of a new gate take the size of the loaded ones
+    loaded = CustomTableGate(None, NUM_EXPERT, 1, 2)
+    loaded.load_state_dict(gate.state_dict())
+    loaded.fused_count = True
+
+    token_ids = torch.tensor([[4, 0], [2, 2]])
+    loaded.token_ids = token_ids
+    idx, score, dense = loaded(torch.randn(4, D_MODEL), return_all_scores=True)
+    assert torch.equal(idx, expert_table[token_ids.reshape(-1)])
+    assert torch.equal(score, score_table[token_ids.reshape(-1)])
+    assert torch.equal(dense.gather(1, idx), score)
+    assert torch.equal(loaded.expert_count,
+            torch.bincount(idx.reshape(-1), minlength=NUM_EXPERT))
+
+
+def _hypernet_gate():
+    torch.manual_seed(0)
+    gate = CustomNaiveGate_HyperNet(D_MODEL, NUM_EXPERT, 1, 2, hyper_size=16)
+    # train.py freezes the hypernetwork
+    gate.hypernet.requires_grad_(False)
+    return gate
+
+
+def test_hypernet_weight_cache():
+    gate = _hypernet_gate()
+    calls = []
+    generate_weight = gate.generate_weight
+    gate.generate_weight = lambda: calls.append(1) or generate_weight()
+    x = _input()
+
+    # generated once for two forwards and backwards of the same step
+    for _ in range(2):
+        gate(x)[1].pow(2).sum().backward()
+    assert len(calls) == 1
+    ref = _hypernet_gate()
+    ref_x = _input()
+    for _ in range(2):
+        idx, score = ref(ref_x)
+        score.pow(2).sum().backward()
+    assert torch.allclose(gate.hyper_embedding.grad, ref.hyper_embedding.grad)
+    assert torch.equal(gate(x)[0], idx)
+
+    # once more after the step, which eval reuses
+    torch.optim.SGD([gate.hyper_embedding], lr=0.1).step()
+    gate(x)
+    gate.eval()
+    with torch.no_grad():
+        gate(x)
+        gate(x)
+    assert len(calls) == 2
+    with torch.no_grad():
+        assert torch.allclose(gate.router_weight(), generate_weight())
+
+
+def test_router_generator():
+    gates = [_hypernet_gate() for _ in range(3)]
+    for i, gate in enumerate(gates):
+        with torch.no_grad():
+            gate.hyper_embedding.normal_(generator=torch.manual_seed(i))
+    weights = [gate.generate_weight() for gate in gates]
+    generator = HyperRouterGenerator.from_gates(gates)
+    generated = generator.router_weights()
+    # one batched call gives the weights of all the gates
+    for i, gate in enumerate(gates):
+        assert not hasattr(gate, 'hyper_embedding')
+        assert torch.allclose(generated[i], weights[i], atol=1e-6)
+        assert torch.equal(gate.router_weight(generated), generated[i])
+
+    low_rank = HyperRouterGenerator(3, D_MODEL, NUM_EXPERT, hyper_size=16, rank=2)
+    assert low_rank.router_weights().shape == (3, NUM_EXPERT, D_MODEL)
+    assert torch.linalg.matrix_rank(low_rank.router_weights()[0]) <= 2
+
+
+def test_prune_by_capacity():
+    idx = torch.tensor([[0, 1], [0, 2], [-1, 0], [1, 0], [0, 1]])
+    pruned, count = prune_by_capacity(idx, 2, 3)
+    # the first two samples of every expert, in order of appearance
+    assert pruned.tolist() == [[0, 1], [0, 2], [-1, -1], [1, -1], [-1, -1]]
+    assert count.tolist() == [2, 2, 1]
+
+    priority = torch.tensor([[0.1, 0.2], [0.3, 0.4], [0.5, 0.6], [0.7, 0.8],
+        [0.9, 0.1]])
+    pruned, count = prune_by_capacity(idx, torch.tensor([1, 2, 0]), 3,
+            priority=priority)
+    # or the highest priorities first
+    assert pruned.tolist() == [[-1, 1], [-1, -1], [-1, -1], [1, -1], [0, -1]]
+    assert count.tolist() == [1, 2, 0]
+
+
+@pytest.mark.parametrize('gate_cls', [GShardGate, SwitchGate])
+@pytest.mark.parametrize('policy', ['first', 'score'])
+def test_gate_capacity(gate_cls, policy):
+    torch.manual_seed(0)
+    kwargs = dict(random_routing=False) if gate_cls is GShardGate else {}
+    gate = gate_cls(D_MODEL, NUM_EXPERT, 1, capacity_policy=policy, **kwargs)
+    gate.eval()
+    x = torch.randn(NUM_TOKEN * 4, D_MODEL)
+    gate.capacity = (100, 100)
+    full_idx, full_score = gate(x)
+    gate.capacity = (0.1, 0.1)
+    idx, score = gate(x)
+
+    # the samples beyond the capacity are dropped, the first or the best
+    # ones of every expert are kept
+    capacity = math.ceil(0.1 * x.shape[0])
+    assert torch.equal(score, full_score)
+    assert (torch.bincount(idx[idx > -1], minlength=NUM_EXPERT) <= capacity).all()
+    priority = full_score if policy == 'score' else None
+    assert torch.equal(idx, prune_by_capacity(full_idx, capacity, NUM_EXPERT,
+        priority=priority)[0])
+    assert (idx == -1).any()
@@ -0,0 +1,151 @@
+r"""
+Behaviour of the options of `FMoE` on a single worker: the masked samples,
+the checkpointed experts, the routing shared between layers and the gates
+routing every token to any number of experts.
+
+Usage (from `source/`):
+    python -m pytest -q tests/test_layers.py
+"""
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_gate import CustomDTSGate, CustomExpertChoiceGate, CustomNaiveGate
+from custom_transformer import FMoETransformerMLP
+from latest_utils import measure_expert_memory, set_shared_routing
+
+NUM_EXPERT, D_MODEL, D_HIDDEN, NUM_TOKEN = 4, 8, 16, 12
+
+
+def _layer(seed=0, gate=CustomNaiveGate, **kwargs):
+    torch.manual_seed(seed)
+    return FMoETransformerMLP(num_expert=NUM_EXPERT, d_model=D_MODEL,
+            d_hidden=D_HIDDEN, top_k=2, gate=gate,
+            activation=torch.nn.ReLU(), **kwargs).double()
+
+
+def _input():
+    torch.manual_seed(1)
+    return torch.randn(NUM_TOKEN, D_MODEL, dtype=torch.double, requires_grad=True)
+
+
+def test_mask_drops_samples():
+    layer = _layer()
+    x = _input()
+    mask = torch.zeros(NUM_TOKEN, dtype=torch.long)
+    mask[2::3] = 1
+    mask[3] = 2
+    layer.mask = mask
+    layer.mask_dict = {2: torch.full((D_MODEL,), 0.5)}
+    out = layer(x)
+    out.sum().backward()
+
+    # the kept samples are routed as if they were alone
+    keep = mask == 0
+    layer.mask, layer.mask_dict = None, None
+    assert torch.allclose(out[keep], layer(x[keep]), atol=1e-10)
+    assert torch.equal(out[mask == 1], torch.zeros(int((mask == 1).sum()), D_MODEL,
+        dtype=torch.double))
+    assert torch.equal(out[3], torch.full((D_MODEL,), 0.5, dtype=torch.double))
+    # and the masked ones get no gradient
+    assert torch.equal(x.grad[~keep], torch.zeros_like(x.grad[~keep]))
+
+
+def test_expert_checkpoint():
+    # the same outputs and gradients, with only the input of the experts kept
+    results = []
+    for flag in [False, True]:
+        layer = _layer(expert_checkpoint=flag)
+        x = _input()
+        out = layer(x)
+        out.pow(2).sum().backward()
+        results.append([out, x.grad] + [p.grad for p in layer.parameters()])
+    for g, r in zip(results[1], results[0]):
+        assert torch.allclose(g, r, atol=1e-10)
+
+    full, ckpt = measure_expert_memory(layer, _input())
+    assert 0 < ckpt['experts'] < full['experts']
+
+
+def test_shared_routing():
+    model = torch.nn.Sequential(_layer(0), _layer(1))
+    set_shared_routing(model, group_size=2)
+    assert not any(p.requires_grad for p in model[1].gate.parameters())
+    x = _input()
+    h = model[0](x)
+    out = model[1](h)
+
+    # the second layer routes as the gate of the first one
+    with torch.no_grad():
+        idx, score = model[0].gate(x)
+    ref = model[1]._sparse_forward(h, idx, score)
+    assert torch.allclose(out, ref, atol=1e-10)
+    out.sum().backward()
+    assert model[0].gate.gate.weight.grad is not None
+
+    # and on other tokens, the first layer must run first
+    with pytest.raises(AssertionError):
+        model[1](x[:-1])
+
+    set_shared_routing(model, group_size=1)
+    assert model[1].shared_routing is None
+    assert all(p.requires_grad for p in model[1].gate.parameters())
+
+
+def _ragged_reference(layer, x, idx, score, token_idx):
+    experts = layer.experts
+    out = torch.zeros_like(x)
+    for e, s, t in zip(idx.tolist(), score, token_idx.tolist()):
+        h = experts.activation(experts.htoh4.weight[e].mv(x[t])
+                + experts.htoh4.bias[e])
+        out[t] = out[t] + s * (experts.h4toh.weight[e].mv(h)
+                + experts.h4toh.bias[e])
+    return out
+
+
+def _check_ragged(layer, x):
+    routing = []
+    layer.gate_hook = lambda *args: routing.append(args)
+    out = layer(x)
+    idx, score, token_idx = routing[0]
+    assert layer.gate.token_idx is None
+    ref = _ragged_reference(layer, x, idx, score, token_idx)
+    assert torch.allclose(out, ref, atol=1e-10)
+    grad, = torch.autograd.grad(out.pow(2).sum(), [x], retain_graph=True)
+    ref_grad, = torch.autograd.grad(ref.pow(2).sum(), [x])
+    assert torch.allclose(grad, ref_grad, atol=1e-10)
+    return idx, score, token_idx
+
+
+def test_expert_choice():
+    layer = _layer(gate=CustomExpertChoiceGate)
+    idx, score, token_idx = _check_ragged(layer, _input())
+    # every expert takes the same number of distinct tokens
+    capacity = NUM_TOKEN * 2 // NUM_EXPERT
+    assert torch.equal(idx, torch.arange(NUM_EXPERT).repeat_interleave(capacity))
+    for e in range(NUM_EXPERT):
+        assert token_idx[idx == e].unique().numel() == capacity
+
+
+def test_dense_to_sparse():
+    layer = _layer(gate=CustomDTSGate)
+    layer.gate.threshold = 0.2
+    layer.eval()
+    x = _input()
+    idx, score, token_idx = _check_ragged(layer, x)
+    # the experts above the threshold, and at least the best one
+    with torch.no_grad():
+        probs = torch.softmax(layer.gate.gate(x), dim=-1)
+    keep = probs > 0.2
+    keep[torch.arange(NUM_TOKEN), probs.argmax(dim=-1)] = True
+    assert torch.equal(torch.stack([token_idx, idx]), keep.nonzero().t())
+    assert torch.allclose(score, probs[keep])
+
+    # and all of them when the gate is dense
+    layer.gate.dense_moe_flag = True
+    idx, score, token_idx = _check_ragged(layer, x)
+    assert idx.numel() == NUM_TOKEN * NUM_EXPERT
@@ -0,0 +1,163 @@
+r"""
+Tests of the MoE side channels of `MemTransformerLM`: the load-balance loss
+and the non-finite count returned by the forward, the token ids of the
+table gates, the weights of the router generator and the folding of the
+HyperNet gates.
+
+Usage (from `source/`):
+    python -m pytest -q tests/test_mem_transformer.py
+"""
+import os
+import sys
+
+import pytest
+import torch
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [SOURCE, os.path.join(SOURCE, 'utils')]
+
+from custom_gate import CustomBaseGate, CustomNaiveGate_HyperNet, CustomTableGate
+from export_router import fold_hypernet_gates, routing_of
+from latest_utils import set_count_non_finite, set_router_generator
+from mem_transformer import MemTransformerLM
+
+N_TOKEN, TGT_LEN, BSZ = 50, 8, 3
+
+
+def _model(gate_name, **kwargs):
+    torch.manual_seed(0)
+    model = MemTransformerLM(N_TOKEN, 2, 2, 16, 8, 32, 0.0, 0.0,
+            tgt_len=TGT_LEN, ext_len=0, mem_len=TGT_LEN, moe=True,
+            moe_num_expert=4, moe_top_k=2, gate_name=gate_name, **kwargs)
+    # some parameters are left uninitialized for the weights_init of train.py
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.1)
+    return model
+
+
+def _batch():
+    torch.manual_seed(1)
+    return (torch.randint(0, N_TOKEN, (TGT_LEN, BSZ)),
+            torch.randint(0, N_TOKEN, (TGT_LEN, BSZ)))
+
+
+@pytest.mark.parametrize('gate_name,all_gates,has_loss', [
+    ('CustomNaiveGate_Balance', False, True),
+    ('CustomNaiveGate_XMoE', False, False),
+    ('CustomNaiveGate_XMoE', True, True),
+    ('CustomNaiveGate', True, False),
+])
+def test_aux_loss(gate_name, all_gates, has_loss):
+    model = _model(gate_name)
+    model.aux_loss_all_gates = all_gates
+    data, target = _batch()
+    ret = model(data, target, return_aux_loss=True)
+    # loss, the three mems and the aux loss
+    assert len(ret) == 5 and ret[-1].shape == (1, 1)
+    assert (ret[-1].item() > 0) == has_loss
+    if has_loss:
+        assert torch.allclose(ret[-1].view(()), model.collect_aux_losses())
+        ret[-1].sum().backward()
+    else:
+        assert model.collect_aux_losses() == 0
+
+    model.eval()
+    with torch.no_grad():
+        assert model(data, target, return_aux_loss=True)[-1].item() == 0
+
+
+def test_aux_loss_after_gates_replaced():
+    model = _model('CustomNaiveGate_Balance')
+    layer = model.layers[0].pos_ff
+    layer.gate = type(layer.gate)(16, 4, 1, 2)
+    model.index_moe_gates()
+    data, target = _batch()
+    model(data, target)
+    assert torch.allclose(model.collect_aux_losses(),
+            model.layers[0].pos_ff.gate.loss + model.layers[1].pos_ff.gate.loss)
+
+
+def test_non_finite_count():
+    model = _model('CustomNaiveGate_XMoE')
+    set_count_non_finite(model)
+    data, target = _batch()
+    assert model(data, target, return_non_finite_count=True)[-1].item() == 0
+
+    gate = model.layers[0].pos_ff.gate
+    with torch.no_grad():
+        gate.inp_reduction.weight[0, 0] = float('nan')
+    count = model(data, target, return_non_finite_count=True)[-1]
+    # all the scores of both layers, as the NaNs reach the second one
+    assert count.item() == 2 * TGT_LEN * BSZ * gate.tot_expert
+    # read once, and not counted in eval
+    assert all(g.non_finite_count is None for g in model.modules()
+            if isinstance(g, CustomBaseGate))
+    model.eval()
+    with torch.no_grad():
+        assert model(data, target, return_non_finite_count=True)[-1].item() == 0
+
+
+def test_table_gates_route_by_token_id():
+    model = _model('CustomNaiveGate')
+    tables = []
+    for layer in model.layers:
+        torch.manual_seed(len(tables))
+        gate = CustomTableGate(None, 4, 1, 2)
+        expert_table = torch.stack([torch.randperm(4)[:2] for _ in range(N_TOKEN)])
+        gate.set_table(expert_table, torch.full((N_TOKEN, 2), 0.5))
+        layer.pos_ff.gate = gate
+        tables.append(expert_table)
+    model.index_moe_gates()
+
+    routed = []
+    for layer in model.layers:
+        layer.pos_ff.gate_hook = lambda idx, score, _: routed.append(idx)
+    data, target = _batch()
+    model(data, target)
+    for idx, expert_table in zip(routed, tables):
+        assert torch.equal(idx, expert_table[data.reshape(-1)])
+    # the ids are not kept after the forward
+    assert all(layer.pos_ff.gate.token_ids is None for layer in model.layers)
+
+
+def test_router_generator_matches_gates():
+    model = _model('CustomNaiveGate_HyperNet')
+    data, target = _batch()
+    model.eval()
+    with torch.no_grad():
+        ref = model(data, target)[0]
+    set_router_generator(model)
+    with torch.no_grad():
+        out = model(data, target)[0]
+    assert torch.allclose(out, ref, atol=1e-5)
+    assert all(layer.pos_ff.gate.generated_weights is None
+            for layer in model.layers)
+
+    model.train()
+    model(data, target)[0].mean().backward()
+    assert model.router_generator.hyper_embedding.grad is not None
+
+
+@pytest.mark.parametrize('generator', [False, True])
+def test_fold_hypernet_gates(generator):
+    model = _model('CustomNaiveGate_HyperNet')
+    if generator:
+        set_router_generator(model)
+    model.eval()
+    data, target = _batch()
+    names = [name for name, m in model.named_modules()
+            if isinstance(m, CustomNaiveGate_HyperNet)]
+    before = routing_of(model, names, data, target)
+    with torch.no_grad():
+        ref = model(data, target)[0]
+
+    assert fold_hypernet_gates(model) == names
+    assert not any(isinstance(m, CustomNaiveGate_HyperNet) for m in model.modules())
+    assert not hasattr(model, 'router_generator')
+    after = routing_of(model, names, data, target)
+    for name in names:
+        assert torch.equal(before[name][0], after[name][0])
+        assert torch.allclose(before[name][1], after[name][1], atol=1e-5)
+    with torch.no_grad():
+        assert torch.allclose(model(data, target)[0], ref, atol=1e-5)
@@ -0,0 +1,67 @@
+r"""
+Statistics of `RoutingTelemetry`, as accumulated by the `gate_hook` of the
+MoE layers and flushed.
+
+Usage (from `source/`):
+    python -m pytest -q tests/test_routing_telemetry.py
+"""
+import math
+import os
+import pickle
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_gate import CustomNaiveGate
+from custom_transformer import FMoETransformerMLP
+from latest_utils import set_routing_telemetry
+from routing_telemetry import RoutingTelemetry
+
+
+def test_record_and_flush():
+    telemetry = RoutingTelemetry()
+    hook = telemetry.hook('layer', 3)
+    idx = torch.tensor([[0, 2], [2, -1], [1, 2]])
+    score = torch.tensor([[0.5, 0.5], [0.75, 0.25], [1.0, 0.0]])
+    hook(idx, score, None)
+    hook(idx, score, None)
+    with torch.no_grad():
+        # not counted outside of training
+        hook(idx, score, None)
+
+    stats = telemetry.flush()['layer']
+    assert stats['count'].tolist() == [2, 2, 6]
+    assert stats['dropped'] == 2
+    entropy = [math.log(2), -0.75 * math.log(0.75) - 0.25 * math.log(0.25), 0]
+    assert math.isclose(stats['topk_entropy'], sum(entropy) / 3, rel_tol=1e-5)
+    assert math.isclose(stats['margin'], 1.5 / 3, rel_tol=1e-5)
+    assert 'load max/mean 1.80' in RoutingTelemetry.summary({'layer': stats})
+    assert telemetry.flush() == {}
+
+    # ragged routing only has the counts, and top-1 routing no margin
+    hook(torch.tensor([0, 0, 1]), torch.rand(3), None)
+    hook(torch.tensor([[1], [1]]), torch.ones(2, 1), None)
+    stats = telemetry.flush()['layer']
+    assert stats['count'].tolist() == [2, 3, 0]
+    assert stats['topk_entropy'] == 0 and stats['margin'] is None
+
+
+def test_model_telemetry():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(*[FMoETransformerMLP(num_expert=4, d_model=8,
+        d_hidden=16, top_k=2, gate=CustomNaiveGate) for _ in range(2)])
+    telemetry = set_routing_telemetry(model)
+    x = torch.randn(5, 8)
+    model(x)
+    model(x)
+    stats = telemetry.flush()
+    assert sorted(stats) == ['0', '1']
+    for s in stats.values():
+        assert s['count'].sum() == 2 * 5 * 2 and s['dropped'] == 0
+
+    # the statistics are not pickled with the model
+    model(x)
+    telemetry = pickle.loads(pickle.dumps(telemetry))
+    assert telemetry.flush() == {}
@@ -0,0 +1,83 @@
+r"""
+Round trip of the routing of the MoE layers through `RoutingTraceRecorder`
+and `RoutingTrace`, for top-k and ragged routing.
+
+Usage (from `source/`):
+    python -m pytest -q tests/test_routing_trace.py
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_gate import CustomExpertChoiceGate, CustomNaiveGate
+from custom_transformer import FMoETransformerMLP
+from latest_utils import set_routing_trace
+from routing_trace import RoutingTrace, RoutingTraceRecorder, SCORE_SCALE
+
+
+def _model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(*[FMoETransformerMLP(num_expert=4, d_model=8,
+        d_hidden=16, top_k=2, gate=gate) for gate in [CustomNaiveGate,
+            CustomExpertChoiceGate]])
+
+
+def test_trace_round_trip(tmp_path):
+    model = _model()
+    routing = {}
+    for name in ['0', '1']:
+        def record(idx, score, token_idx, name=name):
+            routing.setdefault(name, []).append((idx, score, token_idx))
+        model.get_submodule(name).gate_hook = record
+    hooks = [layer.gate_hook for layer in model]
+
+    recorder = RoutingTraceRecorder(str(tmp_path), chunk_steps=2)
+    set_routing_trace(model, recorder)
+    with torch.no_grad():
+        for step in range(5):
+            model(torch.randn(6 + step, 8))
+            recorder.step()
+    set_routing_trace(model, None)
+    recorder.close()
+    # the previous hooks are run, and given back
+    assert [layer.gate_hook for layer in model] == hooks
+    assert all(len(r) == 5 for r in routing.values())
+
+    trace = RoutingTrace(str(tmp_path))
+    assert trace.layers == ['0', '1'] and trace.meta['ragged'] == [False, True]
+    assert sorted(set(trace.steps('0'))) == list(range(5))
+    for step in range(5):
+        idx, score, _ = routing['0'][step]
+        trace_idx, trace_score = trace.step('0', step)
+        assert np.array_equal(trace_idx, idx.numpy())
+        assert np.abs(trace_score - score.numpy()).max() <= 0.5 / SCORE_SCALE
+
+        # the token of every entry of the ragged layer
+        idx, score, token_idx = routing['1'][step]
+        trace_idx, trace_score = trace.step('1', step)
+        assert np.array_equal(trace_idx.reshape(-1), idx.numpy())
+        assert np.array_equal(trace.step_tokens('1', step), token_idx.numpy())
+    assert trace.tokens('0') is None
+    assert trace.tokens('1').shape == trace.indices('1').shape
+    with pytest.raises(AssertionError):
+        trace.step_tokens('0', 0)
+
+
+def test_dropped_routing(tmp_path):
+    with RoutingTraceRecorder(str(tmp_path)) as recorder:
+        hook = recorder.hook('layer', 300)
+        hook(torch.tensor([[299, -1], [-1, 0]]), torch.tensor([[1.0, 0.0],
+            [0.0, 0.5]]), None)
+        recorder.step()
+    trace = RoutingTrace(str(tmp_path))
+    idx, score = trace.step('layer', 0)
+    # uint16 above 254 experts, -1 being the largest value
+    assert trace.indices('layer').dtype == np.uint16
+    assert idx.tolist() == [[299, 2 ** 16 - 1], [2 ** 16 - 1, 0]]
+    assert np.allclose(score, [[1.0, 0.0], [0.0, 0.5]], atol=0.5 / SCORE_SCALE)
+    assert trace.step('layer', 1) == (None, None)
@@ -13,10 +13,12 @@ import torch.optim as optim
 
 from data_utils import get_lm_corpus
 from mem_transformer import MemTransformerLM
-from utils.exp_utils import create_exp_dir
+from utils.exp_utils import create_exp_dir, get_logger
 from utils.data_parallel import BalancedDataParallel
-from fmoe.gates.base_gate import BaseGate
-from custom_gate import CustomNaiveGate_Balance, CustomNaiveGate_Distill
+from distributed import DistributedGroupedDataParallel
+from gates.base_gate import BaseGate
+from custom_gate import CustomNaiveGate_Distill
+from functions import get_host_sync_count
 from latest_utils import *
 
 import warnings 
@@ -41,6 +43,9 @@ parser.add_argument('--d_model', type=int, default=500,
 parser.add_argument('--d_inner', type=int, default=1000,
                     help='inner dimension in FF')
 parser.add_argument('--load_balance', type=float, default=0)
+parser.add_argument('--load_balance_all_gates', action='store_true',
+                    help='also add the load-balance losses of the XMoE and '
+                    'StableMoE gates, not only of CustomNaiveGate_Balance')
 parser.add_argument('--dropout', type=float, default=0.0,
                     help='global dropout rate')
 parser.add_argument('--dropatt', type=float, default=0.0,
@@ -107,6 +112,9 @@ parser.add_argument('--varlen', action='store_true',
                     help='use variable length')
 parser.add_argument('--multi_gpu', action='store_true',
                     help='use multiple GPU')
+parser.add_argument('--distributed', action='store_true',
+                    help='data parallel over torch.distributed, one process per '
+                    'device (launch with torchrun)')
 parser.add_argument('--log-interval', type=int, default=200,
                     help='report interval')
 parser.add_argument('--eval-interval', type=int, default=4000,
@@ -156,6 +164,34 @@ parser.add_argument('--moe-num-expert', type=int, default=64,
 
 parser.add_argument('--moe-top-k', type=int, default=2,
                     help='top_k experts in hard gate of moe')
+parser.add_argument('--moe-sync-free', action='store_true',
+                    help='copy the expert counts to the host once per moe layer')
+parser.add_argument('--moe-fused-count', action='store_true',
+                    help='count the tokens of every expert in the custom gates')
+parser.add_argument('--moe-count-non-finite', action='store_true',
+                    help='count the non-finite scores of the cosine gates')
+parser.add_argument('--moe-telemetry', action='store_true',
+                    help='log the expert load, and the entropy and margins of '
+                    'the scores of the selected experts')
+parser.add_argument('--moe-shared-routing', type=int, default=1,
+                    help='number of consecutive moe layers sharing the routing '
+                    'of the first one, 1 to route every layer')
+parser.add_argument('--hyper-batch', action='store_true',
+                    help='generate the routers of all the HyperNet gates at once')
+parser.add_argument('--hyper-rank', type=int, default=None,
+                    help='rank of the low-rank output head of the router generator')
+parser.add_argument('--moe-dispatch', type=str, default=None,
+                    choices=['sparse', 'einsum', 'auto'],
+                    help='dispatch engine of the moe layers: einsum drops the '
+                    'tokens beyond the capacity of an expert, auto uses it '
+                    'without dropping any when it is small enough')
+parser.add_argument('--moe-capacity-factor', type=float, default=None,
+                    help='expert capacity factor of the einsum dispatch')
+parser.add_argument('--moe-expert-checkpoint', action='store_true',
+                    help='recompute the hidden activations of the experts in backward')
+parser.add_argument('--moe-measure-expert-memory', action='store_true',
+                    help='print the activation memory of the experts, with and '
+                    'without checkpointing, before the first step')
 
 ## other settings
 parser.add_argument('--gate_name', type=str, default='NaiveGate',
@@ -174,9 +210,9 @@ parser.add_argument('--moe-top-k-min', type=int, default=2)
 parser.add_argument('--moe-top-k-max', type=int, default=16)
 
 ## Dense to Sparse
-parser.add_argument('--min_temp', type=int, default=0.3)
-parser.add_argument('--max_temp', type=int, default=2)
-parser.add_argument('--threshold', type=int, default=0.001)
+parser.add_argument('--min_temp', type=float, default=0.3)
+parser.add_argument('--max_temp', type=float, default=2)
+parser.add_argument('--threshold', type=float, default=0.001)
 ## Dense Dropout
 parser.add_argument('--dense_drop', action='store_true')
 parser.add_argument('--expert_drop', type=float, default=0.5)
@@ -198,10 +234,27 @@ if args.d_embed < 0:
 assert args.ext_len >= 0, 'extended context length must be non-negative'
 assert args.batch_size % args.batch_chunk == 0
 
+args.rank, args.world_size = 0, 1
+if args.distributed:
+    torch.distributed.init_process_group(backend='nccl' if args.cuda else 'gloo')
+    args.rank = torch.distributed.get_rank()
+    args.world_size = torch.distributed.get_world_size()
+    if args.cuda:
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+
 args.work_dir = '{}-{}'.format(args.work_dir, args.dataset)
 args.work_dir = os.path.join(args.work_dir, time.strftime('%Y%m%d-%H%M%S'))
-logging = create_exp_dir(args.work_dir,
-    scripts_to_save=['train.py', 'mem_transformer.py'], debug=args.debug)
+if args.distributed:
+    # every rank uses the work dir of the first one
+    work_dir = [args.work_dir]
+    torch.distributed.broadcast_object_list(work_dir, src=0)
+    args.work_dir = work_dir[0]
+if args.rank == 0:
+    logging = create_exp_dir(args.work_dir,
+        scripts_to_save=['train.py', 'mem_transformer.py'], debug=args.debug)
+else:
+    # only the first rank writes the log and the checkpoints
+    logging = get_logger(None, print_=False, log_=False)
 
 # Set the random seed manually for reproducibility.
 np.random.seed(args.seed)
@@ -321,6 +374,8 @@ else:
 if args.restart:
     with open(os.path.join(args.restart_dir, 'model.pt'), 'rb') as f:
         model = torch.load(f)
+    # the gates are indexed on the model, not in the replicas of DataParallel
+    model.index_moe_gates()
     if not args.fp16:
         model = model.float()
     model.apply(update_dropout)
@@ -340,8 +395,27 @@ else:
 args.n_all_param = sum([p.nelement() for p in model.parameters()])
 args.n_nonemb_param = sum([p.nelement() for p in model.layers.parameters()])
 
+model.aux_loss_all_gates = args.load_balance_all_gates
+
 # for Dense to Sparse Method
 set_threshold(model, args)
+if args.moe_sync_free:
+    set_sync_free(model)
+if args.moe_fused_count:
+    set_fused_count(model)
+if args.moe_count_non_finite:
+    set_count_non_finite(model)
+if args.moe_shared_routing > 1:
+    set_shared_routing(model, args.moe_shared_routing)
+routing_telemetry = None
+if args.moe_telemetry:
+    routing_telemetry = set_routing_telemetry(model)
+if args.hyper_batch:
+    set_router_generator(model, rank=args.hyper_rank)
+if args.moe_dispatch is not None:
+    set_dispatch_mode(model, args.moe_dispatch, args.moe_capacity_factor)
+if args.moe_expert_checkpoint:
+    set_expert_checkpoint(model)
 freeze_part_weight(model, args)
 
 print(model)
@@ -362,6 +436,10 @@ if args.multi_gpu:
                                           model, dim=1).to(device)
     else:
         para_model = nn.DataParallel(model, dim=1).to(device)
+elif args.distributed:
+    # every worker holds all the experts, whose gradients are averaged too
+    set_expert_dp_comm(model)
+    para_model = DistributedGroupedDataParallel(model.to(device))
 else:
     para_model = model.to(device)
 
@@ -495,7 +573,7 @@ def evaluate(model, eval_iter):
 
 def train():
     # Turn on training mode which enables dropout.
-    global train_step, train_loss, best_val_loss, best_val_loss_dense, eval_start_time, log_start_time, current_gate, all_top_k
+    global train_step, train_loss, non_finite_count, best_val_loss, best_val_loss_dense, eval_start_time, log_start_time, current_gate, all_top_k
     model.train()
 
     if args.batch_chunk > 1:
@@ -506,6 +584,11 @@ def train():
 
     for batch, (data, target, seq_len) in enumerate(train_iter):
 
+        if args.distributed:
+            # every worker trains on its share of the batch
+            data = torch.chunk(data, args.world_size, 1)[args.rank].contiguous()
+            target = torch.chunk(target, args.world_size, 1)[args.rank].contiguous()
+
         if args.gate_name == "CustomNaiveGate_Distill":
             if batch > int(0.2*args.max_step):
                 for name, p in model.named_parameters():
@@ -521,6 +604,12 @@ def train():
         current_top_k = collect_top_k(model)
         all_top_k.append(current_top_k)
 
+        if args.moe_measure_expert_memory and train_step == 0:
+            # memory kept by the experts of every layer for one forward
+            measure_expert_memory(model,
+                torch.chunk(data, args.batch_chunk, 1)[0].contiguous(),
+                torch.chunk(target, args.batch_chunk, 1)[0].contiguous())
+
         model.zero_grad()
         if args.batch_chunk > 1:
             data_chunks = torch.chunk(data, args.batch_chunk, 1)
@@ -528,8 +617,12 @@ def train():
             for i in range(args.batch_chunk):
                 data_i = data_chunks[i].contiguous()
                 target_i = target_chunks[i].contiguous()
-                ret = para_model(data_i, target_i, *mems[i])
+                ret = para_model(data_i, target_i, *mems[i],
+                                 return_non_finite_count=args.moe_count_non_finite)
                 loss, mems[i] = ret[0], ret[1:]
+                if args.moe_count_non_finite:
+                    non_finite_count += mems[i][-1].sum()
+                    mems[i] = mems[i][:-1]
                 loss = loss.float().mean().type_as(loss) / args.batch_chunk
                 if args.fp16:
                     optimizer.backward(loss)
@@ -537,16 +630,21 @@ def train():
                     loss.backward()
                 train_loss += loss.float().item()
         else:
-            ret = para_model(data, target, *mems)
+            # the balance loss and the non-finite count come back with the
+            # output, so that they are kept from the replicas of nn.DataParallel
+            ret = para_model(data, target, *mems,
+                             return_aux_loss=args.load_balance > 0,
+                             return_non_finite_count=args.moe_count_non_finite)
             loss, mems = ret[0], ret[1:]
             loss = loss.float().mean().type_as(loss)
 
+            if args.moe_count_non_finite:
+                non_finite_count += mems[-1].sum()
+                mems = mems[:-1]
+
             if args.load_balance > 0:
-                balance_loss = 0
-                for name, m in model.named_modules():
-                    if isinstance(m, CustomNaiveGate_Balance):
-                        balance_loss += m.loss
-                loss += args.load_balance * balance_loss
+                aux_loss, mems = mems[-1], mems[:-1]
+                loss += args.load_balance * aux_loss.float().mean().type_as(loss)
 
             if args.fp16:
                 optimizer.backward(loss)
@@ -554,6 +652,9 @@ def train():
                 loss.backward()
             train_loss += loss.float().item()
 
+        if args.distributed:
+            para_model.allreduce_params()
+
         if args.fp16:
             optimizer.clip_master_grads(args.clip)
         else:
@@ -595,6 +696,17 @@ def train():
                 log_str += ' | bpc {:9.3f}'.format(cur_loss / math.log(2))
             else:
                 log_str += ' | ppl {:9.3f}'.format(math.exp(cur_loss))
+            if args.moe:
+                log_str += ' | host syncs/step {:.1f}'.format(
+                    get_host_sync_count(reset=True) / args.log_interval)
+            if args.moe_count_non_finite:
+                log_str += ' | non-finite scores {:d}'.format(
+                    int(non_finite_count))
+                non_finite_count = 0
+            if routing_telemetry is not None:
+                stats = routing_telemetry.flush()
+                if len(stats) > 0:
+                    log_str += ' | ' + routing_telemetry.summary(stats)
             logging(log_str)
             train_loss = 0
             log_start_time = time.time()
@@ -633,8 +745,9 @@ def train():
                     log_str_dense += ' | valid ppl {:9.3f}'.format(math.exp(val_loss_dense_swa))
                 logging(log_str_dense)
                 logging('-' * 100)
-                with open(os.path.join(args.work_dir, 'model_swa.pt'), 'wb') as f:
-                    torch.save(swa_model.average_model, f)
+                if args.rank == 0:
+                    with open(os.path.join(args.work_dir, 'model_swa.pt'), 'wb') as f:
+                        torch.save(swa_model.average_model, f)
 
             logging('-' * 100)
             log_str = '| Eval {:3d} at step {:>8d} | time: {:5.2f}s ' \
@@ -659,7 +772,7 @@ def train():
             logging('-' * 100)
             # Save the model if the validation loss is the best we've seen so far.
             if not best_val_loss or val_loss < best_val_loss:
-                if not args.debug:
+                if not args.debug and args.rank == 0:
                     with open(os.path.join(args.work_dir, 'model.pt'), 'wb') as f:
                         torch.save(model, f)
                     with open(os.path.join(args.work_dir, 'optimizer.pt'), 'wb') as f:
@@ -667,7 +780,7 @@ def train():
                 best_val_loss = val_loss
 
             if not best_val_loss_dense or val_loss_dense < best_val_loss_dense:
-                if not args.debug:
+                if not args.debug and args.rank == 0:
                     with open(os.path.join(args.work_dir, 'model_dense.pt'), 'wb') as f:
                         torch.save(model, f)
                     with open(os.path.join(args.work_dir, 'optimizer_dense.pt'), 'wb') as f:
@@ -681,6 +794,7 @@ def train():
                     scheduler_sparse.step(val_loss)
 
             eval_start_time = time.time()
+            get_host_sync_count(reset=True)
 
         if train_step == args.dynamic_router_start:
             args.freeze_gate = True
@@ -692,6 +806,7 @@ def train():
 # Loop over epochs.
 train_step = 0
 train_loss = 0
+non_finite_count = 0
 best_val_loss = None
 best_val_loss_dense = None
 current_gate = args.moe_top_k
@@ -712,6 +827,9 @@ except KeyboardInterrupt:
     logging('Exiting from training early')
 
 # Load the best saved model.
+if args.distributed:
+    # wait for the first rank to write it
+    torch.distributed.barrier()
 with open(os.path.join(args.work_dir, 'model_dense.pt'), 'rb') as f:
     model = torch.load(f)
 para_model = model.to(device)
@@ -15,7 +15,7 @@ from data_utils import get_lm_corpus
 from mem_transformer_downstream import MemTransformerLM
 from utils.exp_utils import create_exp_dir
 from utils.data_parallel import BalancedDataParallel
-from fmoe.gates.base_gate import BaseGate
+from gates.base_gate import BaseGate
 
 from latest_utils import *
 
@@ -175,9 +175,9 @@ parser.add_argument('--moe-top-k-min', type=int, default=2)
 parser.add_argument('--moe-top-k-max', type=int, default=16)
 
 ## Dense to Sparse
-parser.add_argument('--min_temp', type=int, default=0.3)
-parser.add_argument('--max_temp', type=int, default=2)
-parser.add_argument('--threshold', type=int, default=0.001)
+parser.add_argument('--min_temp', type=float, default=0.3)
+parser.add_argument('--max_temp', type=float, default=2)
+parser.add_argument('--threshold', type=float, default=0.001)
 ## Dense Dropout
 parser.add_argument('--dense_drop', action='store_true')
 parser.add_argument('--expert_drop', type=float, default=0.5)